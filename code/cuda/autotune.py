@@ -0,0 +1,181 @@
+'''
+Choosing the block sizes of kernels by benchmarking.
+
+For every kernel and launch size (the total number of threads
+in x, y and z), `Autotuner.block_size` times the kernel with each
+candidate block size on the device, and the fastest one is recorded
+in a tuning file (JSON), keyed by the device name, the kernel name,
+the launch size, and the types of the values and of the flat indices
+the kernel is built for:
+
+    {"<device name>": {"computeRHS 64x64x64 float64 int32": [32, 4, 1], ...}, ...}
+
+Later runs on the same device read the recorded
+block sizes from the file instead of benchmarking again.
+
+The tuning file is TUNING_FILE, which can be set
+with the environment variable COMPACT_TUNING_FILE
+(the same file as for the OpenCL implementation).
+'''
+import os
+import json
+import time
+import fcntl
+import socket
+from contextlib import contextmanager
+import numpy as np
+import pycuda.driver as cuda
+
+TUNING_FILE = os.environ.get('COMPACT_TUNING_FILE',
+        os.path.expanduser('~/.compact_tuning.json'))
+
+# every candidate is timed REPEATS times (after a first,
+# untimed launch), and the best time is kept:
+REPEATS = 3
+
+class Autotuner:
+
+    def __init__(self, device=None, filename=TUNING_FILE):
+        '''
+        :param device: the device that the kernels run on
+            (default: the device of the current context)
+        :type device: pycuda.driver.Device
+        :param filename: the tuning file
+        :type filename: str
+        '''
+        if device is None:
+            device = cuda.Context.get_device()
+        self.device = device
+        self.device_name = device.name().strip()
+        self.filename = filename
+        self.records = _load(filename).get(self.device_name, {})
+
+    def block_size(self, kernel, size, dtype, index_dtype, run, default):
+        '''
+        The block size to launch `kernel` with,
+        for a launch of `size` threads (the grid is `size`
+        divided by the block size).
+
+        If no block size is recorded for this device, kernel,
+        size and types, every candidate is passed to `run`,
+        which must launch the kernel with it and wait for it
+        to complete; the fastest is recorded and returned.
+        Candidates that the kernel cannot be launched with
+        (raising pycuda.driver.Error) are skipped, and if none
+        can be, `default` is recorded.
+
+        :param kernel: the name the block size is recorded under
+        :type kernel: str
+        :param size: the number of threads in x, y and z
+        :type size: tuple
+        :param dtype: the type of the values the kernel is built for
+        :type dtype: numpy.dtype
+        :param index_dtype: the type of its flat indices
+        :type index_dtype: numpy.dtype
+        :param run: callable taking a block size
+        :param default: the block size if none can be launched
+
+        Returns:
+            out (tuple): the block size
+        '''
+        key = _key(kernel, size, dtype, index_dtype)
+        if key not in self.records:
+            best, best_time = default, np.inf
+            for candidate in self.candidates(size):
+                try:
+                    t = _time(run, candidate)
+                except cuda.Error:
+                    continue
+                if t < best_time:
+                    best, best_time = candidate, t
+            self.records[key] = list(best)
+            self.save()
+        return tuple(self.records[key])
+
+    def candidates(self, size):
+        '''
+        The candidate block sizes for a launch of `size` threads:
+        all block sizes of powers of 2 that divide the size,
+        within the limits of the device, of at least
+        1/16 of the maximum number of threads per block
+        (so that blocks are not too small to be efficient).
+        '''
+        attribute = cuda.device_attribute
+        max_threads = self.device.get_attribute(attribute.MAX_THREADS_PER_BLOCK)
+        max_block_dims = [self.device.get_attribute(attribute.MAX_BLOCK_DIM_X),
+                self.device.get_attribute(attribute.MAX_BLOCK_DIM_Y),
+                self.device.get_attribute(attribute.MAX_BLOCK_DIM_Z)]
+        min_threads = min(max_threads//16, int(np.prod(size)))
+        blocks = [()]
+        for n, max_block_dim in zip(size, max_block_dims):
+            blocks = [block + (m,) for block in blocks
+                    for m in powers_of_2(n) if m <= max_block_dim]
+        return [block for block in blocks
+                if min_threads <= np.prod(block) <= max_threads]
+
+    def save(self):
+        '''
+        Write the records for this device to the tuning file,
+        keeping those of other devices in it, and those that other
+        processes have saved since it was read. As several processes
+        (possibly on several nodes) may be writing it, they take turns
+        under a lock (see `_locked`), and the file is replaced atomically.
+        '''
+        with _locked(self.filename):
+            all_records = _load(self.filename)
+            records = all_records.setdefault(self.device_name, {})
+            records.update(self.records)
+            self.records = dict(records)
+            tmp_filename = '{0}.{1}.{2}'.format(self.filename, socket.gethostname(),
+                    os.getpid())
+            with open(tmp_filename, 'w') as f:
+                json.dump(all_records, f, indent=1, sort_keys=True)
+            os.rename(tmp_filename, self.filename)
+
+def grid_size(size, block):
+    '''
+    The grid for a launch of `size` threads in blocks of `block`
+    '''
+    return tuple(n/b for n, b in zip(size, block))
+
+def powers_of_2(n):
+    '''
+    The powers of 2 that divide n
+    '''
+    powers = [1]
+    while n % (2*powers[-1]) == 0:
+        powers.append(2*powers[-1])
+    return powers
+
+def _key(kernel, size, dtype, index_dtype):
+    return '{0} {1} {2} {3}'.format(kernel, 'x'.join(str(n) for n in size),
+            np.dtype(dtype).name, np.dtype(index_dtype).name)
+
+def _time(run, block):
+    run(block)
+    times = []
+    for i in range(REPEATS):
+        t1 = time.time()
+        run(block)
+        times.append(time.time() - t1)
+    return min(times)
+
+@contextmanager
+def _locked(filename):
+    '''
+    Hold an exclusive lock of the file `filename` + '.lock'
+    (a POSIX record lock, which also holds across nodes
+    on file systems supporting them, such as NFS)
+    '''
+    with open(filename + '.lock', 'a') as lock_file:
+        fcntl.lockf(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.lockf(lock_file, fcntl.LOCK_UN)
+
+def _load(filename):
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as f:
+        return json.load(f)
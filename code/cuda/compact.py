@@ -7,6 +7,8 @@ from gpuDA import *
 import os
 import time
 from timer import *
+from workspace import Workspace
+from autotune import Autotuner, grid_size
 
 import kernels
 from reduced import *
@@ -15,16 +17,45 @@ import solvers.templated.near_toeplitz
 
 class CompactFiniteDifferenceSolver:
 
-    def __init__(self, line_da, solver='templated'):
+    def __init__(self, line_da, solver='templated', reduced_dtype=None, autotune=False,
+            index_dtype=None):
         '''
         :param line_da: DA object carrying the grid information along
-            the line
+            the line. Function values, derivatives and all messages
+            have the floating-point type of the DA (`line_da.dtype`).
         :type line_da: gpuDA.DA
+        :param reduced_dtype: floating-point type in which the
+            reduced system is built and solved (default: `line_da.dtype`).
+            With a numpy.float32 DA and numpy.float64 here,
+            the solver runs in "mixed" precision.
+        :type reduced_dtype: numpy.dtype
+        :param autotune: set True to launch the kernels with the
+            block sizes found fastest for this device and problem
+            size (see `tune`), instead of the defaults
+        :type autotune: bool
+        :param index_dtype: integer type of the flat indices in the
+            kernels: numpy.int32, or numpy.int64 for blocks that
+            (with ghost points) have 2**31 elements or more.
+            By default, chosen by the size of the block.
+        :type index_dtype: numpy.dtype
         '''
         self.line_da = line_da
         self.solver = solver
+        self.dtype = line_da.dtype
+        if reduced_dtype is None:
+            reduced_dtype = line_da.dtype
+        self.reduced_dtype = np.dtype(reduced_dtype)
+        if index_dtype is None:
+            sw = line_da.stencil_width
+            index_dtype = kernels.index_dtype(
+                    (line_da.nz+2*sw)*(line_da.ny+2*sw)*(line_da.nx+2*sw))
+        self.index_dtype = np.dtype(index_dtype)
+        self.workspace = Workspace()
+        self.blocks = {}
         self.init_cu()
         self.init_solvers()
+        if autotune:
+            self.tune()
 
     def dfdx(self, f_d, dx, x_d, f_local_d):
         '''
@@ -46,14 +77,16 @@ class CompactFiniteDifferenceSolver:
     @timeit
     def compute_RHS(self, f_d, dx, x_d, f_local_d):
         self.line_da.global_to_local(f_d, f_local_d)
-        self.compute_RHS_kernel.prepared_call((self.line_da.nx/8, self.line_da.ny/8, self.line_da.nz/8), (8, 8, 8),
-                    f_local_d.gpudata, x_d.gpudata, np.float64(dx),
+        grid, block = self._launch_config('computeRHS',
+                (self.line_da.nx, self.line_da.ny, self.line_da.nz), (8, 8, 8))
+        self.compute_RHS_kernel.prepared_call(grid, block,
+                    f_local_d.gpudata, x_d.gpudata, self.dtype.type(dx),
                         np.int32(self.line_da.rank), np.int32(self.line_da.size))
     @timeit 
     def sum_solutions(self, x_UH_d, x_LH_d, x_R_d, alpha_d, beta_d):
-        self.sum_solutions_kernel.prepared_call(
-                (self.line_da.nx/8, self.line_da.ny/8, self.line_da.nz/8),
-                    (8, 8, 8),
+        grid, block = self._launch_config('sumSolutions',
+                (self.line_da.nx, self.line_da.ny, self.line_da.nz), (8, 8, 8))
+        self.sum_solutions_kernel.prepared_call(grid, block,
                         x_R_d.gpudata, x_UH_d.gpudata,
                         x_LH_d.gpudata, alpha_d.gpudata, beta_d.gpudata,
                             np.int32(self.line_da.nx),
@@ -75,28 +108,33 @@ class CompactFiniteDifferenceSolver:
         x_LH_line = np.zeros(2*line_size, dtype=np.float64)
 
         self.line_da.gather(
-                [np.array([x_UH[0], x_UH[-1]]), 2, MPI.DOUBLE],
+                [np.array([x_UH[0], x_UH[-1]], dtype=np.float64), 2, MPI.DOUBLE],
                 [x_UH_line, 2, MPI.DOUBLE])
         self.line_da.gather(
-                [np.array([x_LH[0], x_LH[-1]]), 2, MPI.DOUBLE],
+                [np.array([x_LH[0], x_LH[-1]], dtype=np.float64), 2, MPI.DOUBLE],
                 [x_LH_line, 2, MPI.DOUBLE])
 
         
-        x_R_faces_d = gpuarray.zeros((2, nz, ny), np.float64)
+        x_R_faces_d = self.workspace.get('x_R_faces', (2, nz, ny), self.dtype)
         
-        self.copy_faces_kernel.prepared_call((ny/16, nz/16, 1), (16, 16, 1),
+        grid, block = self._launch_config('negateAndCopyFaces', (ny, nz, 1), (16, 16, 1))
+        self.copy_faces_kernel.prepared_call(grid, block,
                 x_R_d.gpudata, x_R_faces_d.gpudata,
                     np.int32(nx), np.int32(ny), np.int32(nz),
                         np.int32(self.line_da.mx), np.int32(self.line_da.npx))
-        x_R_faces_line_d = gpuarray.zeros((2*line_size, nz, ny), dtype=np.float64)
+        x_R_faces_line_d = self.workspace.get('x_R_faces_line', (2*line_size, nz, ny), self.dtype)
 
-        self.line_da.gather([x_R_faces_d.gpudata.as_buffer(x_R_faces_d.nbytes), 2*nz*ny, MPI.DOUBLE],
-                [x_R_faces_line_d.gpudata.as_buffer(x_R_faces_line_d.nbytes), 2*nz*ny, MPI.DOUBLE])
+        mpi_type = self.line_da.mpi_type
+        self.line_da.gather([x_R_faces_d.gpudata.as_buffer(x_R_faces_d.nbytes), 2*nz*ny, mpi_type],
+                [x_R_faces_line_d.gpudata.as_buffer(x_R_faces_line_d.nbytes), 2*nz*ny, mpi_type])
 
         if line_rank == 0:
-            a_reduced = np.zeros(2*line_size, dtype=np.float64)
-            b_reduced = np.zeros(2*line_size, dtype=np.float64)
-            c_reduced = np.zeros(2*line_size, dtype=np.float64)
+            # the reduced system is built and solved in `reduced_dtype`,
+            # which may be wider than the type it is communicated in:
+            reduced_dtype = self.reduced_dtype
+            a_reduced = np.zeros(2*line_size, dtype=reduced_dtype)
+            b_reduced = np.zeros(2*line_size, dtype=reduced_dtype)
+            c_reduced = np.zeros(2*line_size, dtype=reduced_dtype)
             a_reduced[0::2] = -1.
             a_reduced[1::2] = x_UH_line[1::2]
             b_reduced[0::2] = x_UH_line[0::2]
@@ -110,16 +148,24 @@ class CompactFiniteDifferenceSolver:
             a_reduced[1] = 0.
             c_reduced[-2] = 0.
 
-            a_reduced_d = gpuarray.to_gpu(a_reduced)
-            b_reduced_d = gpuarray.to_gpu(b_reduced)
-            c_reduced_d = gpuarray.to_gpu(c_reduced)
-            c2_reduced_d = gpuarray.to_gpu(c_reduced)
+            a_reduced_d = self.workspace.to_gpu('a_reduced', a_reduced)
+            b_reduced_d = self.workspace.to_gpu('b_reduced', b_reduced)
+            c_reduced_d = self.workspace.to_gpu('c_reduced', c_reduced)
+            c2_reduced_d = self.workspace.to_gpu('c2_reduced', c_reduced)
 
-            self._reduced_solver.solve(a_reduced_d, b_reduced_d,
-                    c_reduced_d, c2_reduced_d, x_R_faces_line_d)
+            if reduced_dtype == self.dtype:
+                self._reduced_solver.solve(a_reduced_d, b_reduced_d,
+                        c_reduced_d, c2_reduced_d, x_R_faces_line_d)
+            else:
+                d_reduced_d = x_R_faces_line_d.astype(reduced_dtype)
+                self._reduced_solver.solve(a_reduced_d, b_reduced_d,
+                        c_reduced_d, c2_reduced_d, d_reduced_d)
+                # GPUArray.set takes a host array: copy on the device
+                cuda.memcpy_dtod(x_R_faces_line_d.gpudata,
+                        d_reduced_d.astype(self.dtype).gpudata, x_R_faces_line_d.nbytes)
 
-        self.line_da.scatter([x_R_faces_line_d.gpudata.as_buffer(x_R_faces_line_d.nbytes), 2*nz*ny, MPI.DOUBLE],
-                [x_R_faces_d.gpudata.as_buffer(x_R_faces_d.nbytes), 2*nz*ny, MPI.DOUBLE])
+        self.line_da.scatter([x_R_faces_line_d.gpudata.as_buffer(x_R_faces_line_d.nbytes), 2*nz*ny, mpi_type],
+                [x_R_faces_d.gpudata.as_buffer(x_R_faces_d.nbytes), 2*nz*ny, mpi_type])
 
         alpha_d = x_R_faces_d[0, :, :]
         beta_d = x_R_faces_d[1, :, :]
@@ -149,12 +195,70 @@ class CompactFiniteDifferenceSolver:
 
         x_UH = scipy_solve_banded(a, b, c, r_UH)
         x_LH = scipy_solve_banded(a, b, c, r_LH)
-        x_UH_d = gpuarray.to_gpu(x_UH)
-        x_LH_d = gpuarray.to_gpu(x_LH)
+        x_UH_d = self.workspace.to_gpu('x_UH', x_UH.astype(self.dtype))
+        x_LH_d = self.workspace.to_gpu('x_LH', x_LH.astype(self.dtype))
         return x_UH_d, x_LH_d
 
+    def tune(self, tuner=None):
+        '''
+        Benchmark the block sizes of the kernels (or look them
+        up in the tuning file), and launch the kernels with the
+        fastest from now on. The reduced solver is tuned
+        likewise (see ReducedSolver.tune); the near-Toeplitz
+        solvers keep their own launch configuration.
+        The benchmark runs on scratch arrays.
+
+        :param tuner: the tuner (default: an autotune.Autotuner
+            for the current device, with the default tuning file)
+        :type tuner: autotune.Autotuner
+        '''
+        if tuner is None:
+            tuner = Autotuner()
+        line_da = self.line_da
+        nz, ny, nx = line_da.nz, line_da.ny, line_da.nx
+        f_local_d = line_da.create_local_vector()
+        x_d = line_da.create_global_vector()
+        x_UH_d = gpuarray.zeros(nx, self.dtype)
+        alpha_d = gpuarray.zeros((nz, ny), self.dtype)
+        x_faces_d = gpuarray.zeros((2, nz, ny), self.dtype)
+        launches = [
+            (self.compute_RHS_kernel, 'computeRHS', (nx, ny, nz), (8, 8, 8),
+                (f_local_d.gpudata, x_d.gpudata, self.dtype.type(1.0),
+                    np.int32(line_da.rank), np.int32(line_da.size))),
+            (self.sum_solutions_kernel, 'sumSolutions', (nx, ny, nz), (8, 8, 8),
+                (x_d.gpudata, x_UH_d.gpudata, x_UH_d.gpudata, alpha_d.gpudata, alpha_d.gpudata,
+                    np.int32(nx), np.int32(ny), np.int32(nz))),
+            (self.copy_faces_kernel, 'negateAndCopyFaces', (ny, nz, 1), (16, 16, 1),
+                (x_d.gpudata, x_faces_d.gpudata, np.int32(nx), np.int32(ny), np.int32(nz),
+                    np.int32(line_da.mx), np.int32(line_da.npx)))]
+        for kernel, name, size, default, args in launches:
+            def run(block):
+                kernel.prepared_call(grid_size(size, block), block, *args)
+                cuda.Context.synchronize()
+            self.blocks[name, size] = tuner.block_size(name, size, self.dtype,
+                    self.index_dtype, run, default)
+        self._reduced_solver.tune(tuner)
+
+    def _launch_config(self, name, size, default):
+        '''
+        The grid and block to launch kernel `name` with,
+        for `size` threads: the tuned block, if any,
+        or else `default`.
+        '''
+        block = self.blocks.get((name, size), default)
+        return grid_size(size, block), block
+
+    def workspace_nbytes(self):
+        '''
+        The number of bytes of device memory held for temporaries
+        (see workspace.Workspace): as the workspace only grows,
+        this is also its peak size so far.
+        '''
+        return self.workspace.nbytes
+
     def setup_reduced_solver(self):
-       return ReducedSolver((2*self.line_da.npx, self.line_da.nz, self.line_da.ny))
+       return ReducedSolver((2*self.line_da.npx, self.line_da.nz, self.line_da.ny),
+               dtype=self.reduced_dtype, index_dtype=self.index_dtype)
 
     def setup_primary_solver(self):
         line_rank = self.line_da.rank
@@ -167,16 +271,19 @@ class CompactFiniteDifferenceSolver:
         
         if self.solver == 'globalmem':
             return solvers.globalmem.near_toeplitz.NearToeplitzSolver(
-                    (self.line_da.nz, self.line_da.ny, self.line_da.nx), coeffs)
+                    (self.line_da.nz, self.line_da.ny, self.line_da.nx), coeffs,
+                        dtype=self.dtype, index_dtype=self.index_dtype)
         else:
             return solvers.templated.near_toeplitz.NearToeplitzSolver(
-                    (self.line_da.nz, self.line_da.ny, self.line_da.nx), coeffs)
+                    (self.line_da.nz, self.line_da.ny, self.line_da.nx), coeffs,
+                        dtype=self.dtype, index_dtype=self.index_dtype)
         
     def init_cu(self):
         thisdir = os.path.dirname(os.path.realpath(__file__))
         self.compute_RHS_kernel, self.sum_solutions_kernel, self.copy_faces_kernel, = kernels.get_funcs(
-                thisdir + '/' + 'kernels.cu', 'computeRHS', 'sumSolutions', 'negateAndCopyFaces')
-        self.compute_RHS_kernel.prepare('PPdii')
+                thisdir + '/' + 'kernels.cu', 'computeRHS', 'sumSolutions', 'negateAndCopyFaces',
+                    dtype=self.dtype, index_dtype=self.index_dtype)
+        self.compute_RHS_kernel.prepare('PP' + self.dtype.char + 'ii')
         self.sum_solutions_kernel.prepare('PPPPPiii')
         self.copy_faces_kernel.prepare('PPiiiii')
         self.start = cuda.Event()
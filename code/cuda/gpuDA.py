@@ -4,9 +4,16 @@ import pycuda.driver as cuda
 import pycuda.gpuarray as gpuarray
 import time
 
+# Files written by DA.write start with this header,
+# followed by the global array in C order:
+FILE_MAGIC = 'DAFIELD1'
+FILE_HEADER = np.dtype([('magic', 'S8'), ('dtype', 'S8'),
+    ('shape', '<i8', (3,)), ('proc_sizes', '<i8', (3,))])
+
 class DA:
 
-    def __init__(self, comm, local_dims, proc_sizes, stencil_width):        
+    def __init__(self, comm, local_dims, proc_sizes, stencil_width, dtype=np.float64,
+            reorder=False):
         """
         DA: a class for handling structured grid information
 
@@ -22,12 +29,21 @@ class DA:
         :param stencil_width: The width of boundary information
                 that may be exchanged between processes
         :type stencil_width: int
+        :param dtype: The floating-point type (numpy.float64 or
+                numpy.float32) of the vectors and halos
+        :type dtype: numpy.dtype
+        :param reorder: Allow MPI to reorder the ranks of the
+                processes in the grid (for example, to place
+                neighbours on the same node). See also `create_DA`.
+        :type reorder: bool
         """
-        comm = comm.Create_cart(proc_sizes)
+        comm = comm.Create_cart(proc_sizes, reorder=reorder)
         self.comm = comm
         self.local_dims = local_dims
         self.proc_sizes = proc_sizes
         self.stencil_width = stencil_width
+        self.dtype = np.dtype(dtype)
+        self.mpi_type = mpi_type(self.dtype)
         self.rank = comm.Get_rank()
         self.size = comm.Get_size()
         
@@ -46,7 +62,7 @@ class DA:
         """
         return gpuarray.zeros((self.nz,
             self.ny,
-            self.nx), dtype=np.float64)
+            self.nx), dtype=self.dtype)
 
     def create_local_vector(self):
         """
@@ -56,7 +72,7 @@ class DA:
         """
         return gpuarray.zeros([self.nz+2*self.stencil_width,
             self.ny+2*self.stencil_width,
-            self.nx+2*self.stencil_width], dtype=np.float64)
+            self.nx+2*self.stencil_width], dtype=self.dtype)
 
     def global_to_local(self, global_array, local_array):
         """
@@ -83,30 +99,30 @@ class DA:
         self._copy_array_to_halo(global_array, self.back_send_halo, [sw, ny, nx], [nz-sw, 0, 0])
 
         # perform swaps in x-direction
-        sendbuf = [self.right_send_halo.gpudata.as_buffer(self.right_send_halo.nbytes), MPI.DOUBLE]
-        recvbuf = [self.left_recv_halo.gpudata.as_buffer(self.left_recv_halo.nbytes), MPI.DOUBLE]
+        sendbuf = [self.right_send_halo.gpudata.as_buffer(self.right_send_halo.nbytes), self.mpi_type]
+        recvbuf = [self.left_recv_halo.gpudata.as_buffer(self.left_recv_halo.nbytes), self.mpi_type]
         req1 = self._forward_swap(sendbuf, recvbuf, self.rank-1, self.rank+1, mx, npx, 10)
 
-        sendbuf = [self.left_send_halo.gpudata.as_buffer(self.left_send_halo.nbytes), MPI.DOUBLE]
-        recvbuf = [self.right_recv_halo.gpudata.as_buffer(self.right_recv_halo.nbytes), MPI.DOUBLE]
+        sendbuf = [self.left_send_halo.gpudata.as_buffer(self.left_send_halo.nbytes), self.mpi_type]
+        recvbuf = [self.right_recv_halo.gpudata.as_buffer(self.right_recv_halo.nbytes), self.mpi_type]
         req2 = self._backward_swap(sendbuf, recvbuf, self.rank+1, self.rank-1, mx, npx, 20)
 
         # perform swaps in y-direction:
-        sendbuf = [self.top_send_halo.gpudata.as_buffer(self.top_send_halo.nbytes), MPI.DOUBLE]
-        recvbuf = [self.bottom_recv_halo.gpudata.as_buffer(self.bottom_recv_halo.nbytes), MPI.DOUBLE]
+        sendbuf = [self.top_send_halo.gpudata.as_buffer(self.top_send_halo.nbytes), self.mpi_type]
+        recvbuf = [self.bottom_recv_halo.gpudata.as_buffer(self.bottom_recv_halo.nbytes), self.mpi_type]
         req3 = self._forward_swap(sendbuf, recvbuf, self.rank-npx, self.rank+npx, my, npy, 30)
        
-        sendbuf = [self.bottom_send_halo.gpudata.as_buffer(self.bottom_send_halo.nbytes), MPI.DOUBLE]
-        recvbuf = [self.top_recv_halo.gpudata.as_buffer(self.top_recv_halo.nbytes), MPI.DOUBLE]
+        sendbuf = [self.bottom_send_halo.gpudata.as_buffer(self.bottom_send_halo.nbytes), self.mpi_type]
+        recvbuf = [self.top_recv_halo.gpudata.as_buffer(self.top_recv_halo.nbytes), self.mpi_type]
         req4 = self._backward_swap(sendbuf, recvbuf, self.rank+npx, self.rank-npx, my, npy, 40)
 
         # perform swaps in z-direction:
-        sendbuf = [self.back_send_halo.gpudata.as_buffer(self.back_send_halo.nbytes), MPI.DOUBLE]
-        recvbuf = [self.front_recv_halo.gpudata.as_buffer(self.front_recv_halo.nbytes), MPI.DOUBLE]
+        sendbuf = [self.back_send_halo.gpudata.as_buffer(self.back_send_halo.nbytes), self.mpi_type]
+        recvbuf = [self.front_recv_halo.gpudata.as_buffer(self.front_recv_halo.nbytes), self.mpi_type]
         req5 = self._forward_swap(sendbuf, recvbuf, self.rank-npx*npy, self.rank+npx*npy, mz, npz, 50)
        
-        sendbuf = [self.front_send_halo.gpudata.as_buffer(self.front_send_halo.nbytes), MPI.DOUBLE]
-        recvbuf = [self.back_recv_halo.gpudata.as_buffer(self.back_recv_halo.nbytes), MPI.DOUBLE]
+        sendbuf = [self.front_send_halo.gpudata.as_buffer(self.front_send_halo.nbytes), self.mpi_type]
+        recvbuf = [self.back_recv_halo.gpudata.as_buffer(self.back_recv_halo.nbytes), self.mpi_type]
         req6 = self._backward_swap(sendbuf, recvbuf, self.rank+npx*npy, self.rank-npx*npy, mz, npz, 60)
 
         requests = [req for req in  [req1, req2, req3, req4, req5, req6] if req != None]
@@ -177,7 +193,108 @@ class DA:
             line_proc_sizes = [1, 1, self.npz]
             line_local_dims = [self.ny, self.nx, self.nz]
         line_comm = self.comm.Create(line_group)
-        return self.__class__(line_comm, line_local_dims, line_proc_sizes, self.stencil_width)
+        return self.__class__(line_comm, line_local_dims, line_proc_sizes, self.stencil_width,
+                self.dtype)
+
+    def write(self, filename, x):
+        """
+        Write the global vector `x` of every process
+        to its block of the shared file `filename`, using
+        collective MPI-IO (every process must call this).
+
+        The file holds a header (see FILE_HEADER) with the
+        global shape, dtype and process grid, followed by the
+        global array in C order, so that it can be read back
+        by `read` under any process grid of the same global shape.
+
+        :param x: An array sized (nz, ny, nx)
+        :type x: numpy.ndarray or pycuda.gpuarray.GPUArray
+        """
+        if isinstance(x, gpuarray.GPUArray):
+            x = x.get()
+        x = np.ascontiguousarray(x, dtype=self.dtype)
+        assert(x.shape == (self.nz, self.ny, self.nx))
+        fh = MPI.File.Open(self.comm, filename, MPI.MODE_WRONLY | MPI.MODE_CREATE)
+        try:
+            fh.Set_size(0)
+            if self.rank == 0:
+                header = np.zeros(1, dtype=FILE_HEADER)
+                header['magic'] = FILE_MAGIC
+                header['dtype'] = self.dtype.str
+                header['shape'] = self.get_global_dims()
+                header['proc_sizes'] = self.proc_sizes
+                fh.Write_at(0, [header.view(np.uint8), MPI.BYTE])
+            filetype = self._create_block_subarray(self.mpi_type)
+            fh.Set_view(FILE_HEADER.itemsize, self.mpi_type, filetype)
+            fh.Write_all([x, self.mpi_type])
+            filetype.Free()
+        finally:
+            fh.Close()
+
+    def read(self, filename, x=None):
+        """
+        Read the block of every process from the file `filename`
+        written by `write`, using collective MPI-IO (every process
+        must call this). The file may have been written
+        under a different process grid.
+
+        :param x: (optional) An array sized (nz, ny, nx) to read into
+        :type x: numpy.ndarray or pycuda.gpuarray.GPUArray
+
+        Returns:
+            out: `x`, or a new global vector if `x` is None
+        """
+        fh = MPI.File.Open(self.comm, filename, MPI.MODE_RDONLY)
+        try:
+            header = np.zeros(1, dtype=FILE_HEADER)
+            if self.rank == 0:
+                fh.Read_at(0, [header.view(np.uint8), MPI.BYTE])
+            self.comm.Bcast([header.view(np.uint8), MPI.BYTE], root=0)
+            if header['magic'][0] != FILE_MAGIC:
+                raise ValueError('{0} was not written by DA.write'.format(filename))
+            shape = tuple(header['shape'][0])
+            if shape != self.get_global_dims():
+                raise ValueError('{0} holds an array of shape {1}, expected {2}'.format(
+                    filename, shape, self.get_global_dims()))
+            file_dtype = np.dtype(header['dtype'][0])
+            file_mpi_type = mpi_type(file_dtype)
+            if (x is not None and not isinstance(x, gpuarray.GPUArray)
+                    and x.dtype == file_dtype and x.flags['C_CONTIGUOUS']):
+                buf = x
+            else:
+                buf = np.empty([self.nz, self.ny, self.nx], dtype=file_dtype)
+            filetype = self._create_block_subarray(file_mpi_type)
+            fh.Set_view(FILE_HEADER.itemsize, file_mpi_type, filetype)
+            fh.Read_all([buf, file_mpi_type])
+            filetype.Free()
+        finally:
+            fh.Close()
+        if x is None:
+            x = self.create_global_vector()
+        if isinstance(x, gpuarray.GPUArray):
+            x.set(buf.astype(x.dtype, copy=False))
+        elif x is not buf:
+            x[...] = buf
+        return x
+
+    def get_global_dims(self):
+        """
+        Returns:
+            out (tuple): dimensions (NZ, NY, NX) of the global problem
+        """
+        return (self.npz*self.nz, self.npy*self.ny, self.npx*self.nx)
+
+    def _create_block_subarray(self, datatype):
+        """
+        Create (and commit) the subarray type selecting
+        the block of this process in the global array.
+        """
+        NZ, NY, NX = self.get_global_dims()
+        subarray = datatype.Create_subarray([NZ, NY, NX],
+                [self.nz, self.ny, self.nx],
+                    [self.mz*self.nz, self.my*self.ny, self.mx*self.nx])
+        subarray.Commit()
+        return subarray
 
     def _forward_swap(self, sendbuf, recvbuf, src, dest, loc, dimprocs, tag):
         
@@ -226,17 +343,17 @@ class DA:
         # the halo values to send, and the other holding
         # the halo values to receive.
 
-        self.left_recv_halo = gpuarray.empty([nz, ny, sw], dtype=np.float64)
+        self.left_recv_halo = gpuarray.empty([nz, ny, sw], dtype=self.dtype)
         self.left_send_halo = self.left_recv_halo.copy()
         self.right_recv_halo = self.left_recv_halo.copy()
         self.right_send_halo = self.left_recv_halo.copy()
     
-        self.bottom_recv_halo = gpuarray.empty([nz, sw, nx], dtype=np.float64)
+        self.bottom_recv_halo = gpuarray.empty([nz, sw, nx], dtype=self.dtype)
         self.bottom_send_halo = self.bottom_recv_halo.copy()
         self.top_recv_halo = self.bottom_recv_halo.copy()
         self.top_send_halo = self.bottom_recv_halo.copy()
 
-        self.back_recv_halo = gpuarray.empty([sw, ny, nx], dtype=np.float64)
+        self.back_recv_halo = gpuarray.empty([sw, ny, nx], dtype=self.dtype)
         self.back_send_halo = self.back_recv_halo.copy()
         self.front_recv_halo = self.back_recv_halo.copy()
         self.front_send_halo = self.back_recv_halo.copy()
@@ -399,6 +516,144 @@ class DA:
         else:
             return False
 
+def mpi_type(dtype):
+    '''
+    The MPI datatype for the numpy dtype `dtype`
+    '''
+    dtype = np.dtype(dtype)
+    if dtype == np.float32:
+        return MPI.FLOAT
+    elif dtype == np.float64:
+        return MPI.DOUBLE
+    raise ValueError('Unsupported dtype: {0}'.format(dtype))
+
+# the shortest local line length planned for a derivative direction
+# (the near-Toeplitz solvers also need a power of 2):
+MIN_LINE_LENGTH = 4
+
+def plan_proc_sizes(global_dims, nprocs, directions=(0, 1, 2), stencil_width=1):
+    '''
+    Choose the process grid (npz, npy, npx) for
+    a problem of size `global_dims` (NZ, NY, NX) on `nprocs` processes.
+
+    Of all grids that divide the problem evenly, and leave
+    local lines in the derivative `directions` (0, 1, 2 for x, y, z)
+    a power of 2 long (and at least MIN_LINE_LENGTH),
+    the one with the smallest `decomposition_cost` is chosen.
+
+    Raises ValueError if there is no such grid.
+    '''
+    candidates = []
+    for npz in _divisors(nprocs):
+        for npy in _divisors(nprocs//npz):
+            npx = nprocs//(npz*npy)
+            proc_sizes = (npz, npy, npx)
+            if _is_valid_decomposition(global_dims, proc_sizes, directions):
+                candidates.append(proc_sizes)
+    if not candidates:
+        raise ValueError('Cannot decompose {0} on {1} processes'.format(
+            tuple(global_dims), nprocs))
+    return min(candidates, key=lambda proc_sizes:
+            decomposition_cost(global_dims, proc_sizes, directions, stencil_width))
+
+def decomposition_cost(global_dims, proc_sizes, directions=(0, 1, 2), stencil_width=1):
+    '''
+    The number of elements every process communicates for
+    a derivative in each of `directions` with the grid `proc_sizes`:
+    for lines split among processes, the halos exchanged with
+    its two neighbours along the lines (the derivative in one
+    direction exchanges no others), and its share of the
+    reduced systems, of 2*np unknowns per line, gathered
+    on one process per line.
+    '''
+    local_dims = [n//p for n, p in zip(global_dims, proc_sizes)]
+    cost = 0
+    for direction in directions:
+        # in (z, y, x) order:
+        axis = 2 - direction
+        if proc_sizes[axis] > 1:
+            nlines = np.prod([local_dims[a] for a in range(3) if a != axis])
+            cost += 2*stencil_width*nlines
+            cost += 2*proc_sizes[axis]*nlines
+    return cost
+
+def create_DA(comm, global_dims, stencil_width=1, dtype=np.float64,
+        directions=(0, 1, 2), node_aware=True):
+    '''
+    Create a DA for a problem of size `global_dims`
+    on all processes of `comm`, with the process grid
+    chosen by `plan_proc_sizes`.
+
+    With `node_aware`, processes sharing memory (a node)
+    are given a compact sub-grid of the process grid
+    (see `node_ordered_comm`). MPI is not allowed
+    to reorder the ranks again (in Create_cart), which
+    could undo that placement.
+    '''
+    proc_sizes = plan_proc_sizes(global_dims, comm.Get_size(), directions, stencil_width)
+    local_dims = [n//p for n, p in zip(global_dims, proc_sizes)]
+    if node_aware:
+        comm = node_ordered_comm(comm, proc_sizes, local_dims)
+    return DA(comm, local_dims, proc_sizes, stencil_width, dtype)
+
+def node_ordered_comm(comm, proc_sizes, local_dims):
+    '''
+    A copy of `comm`, with processes ranked so that the
+    processes of every node (sharing memory) form a block of
+    the process grid `proc_sizes` (ranked in row-major order,
+    as by Create_cart), of the smallest surface.
+    If nodes have different numbers of processes,
+    or no block shape fits, the ranks are unchanged.
+    '''
+    node_comm = comm.Split_type(MPI.COMM_TYPE_SHARED)
+    ppn = node_comm.Get_size()
+    node_rank = node_comm.Get_rank()
+    if len(set(comm.allgather(ppn))) != 1 or ppn == 1 or ppn == comm.Get_size():
+        return comm.Dup()
+    blocks = [block for block in _factorizations(ppn, 3)
+            if all(p % b == 0 for p, b in zip(proc_sizes, block))]
+    if not blocks:
+        return comm.Dup()
+    block = min(blocks, key=lambda block: _surface(
+        [b*n for b, n in zip(block, local_dims)]))
+    # number the nodes in the order of their first process:
+    is_leader = node_rank == 0
+    leaders = comm.allgather(comm.Get_rank() if is_leader else None)
+    leaders = [rank for rank in leaders if rank is not None]
+    node = node_comm.bcast(leaders.index(comm.Get_rank()) if is_leader else None)
+    node_grid = [p//b for p, b in zip(proc_sizes, block)]
+    node_coords = np.unravel_index(node, node_grid)
+    local_coords = np.unravel_index(node_rank, block)
+    coords = [n*b + l for n, b, l in zip(node_coords, block, local_coords)]
+    key = int(np.ravel_multi_index(coords, proc_sizes))
+    return comm.Split(0, key)
+
+def _is_valid_decomposition(global_dims, proc_sizes, directions):
+    for n, p in zip(global_dims, proc_sizes):
+        if n % p != 0:
+            return False
+    for direction in directions:
+        axis = 2 - direction
+        line_length = global_dims[axis]//proc_sizes[axis]
+        if line_length < MIN_LINE_LENGTH or line_length & (line_length-1):
+            return False
+    return True
+
+def _divisors(n):
+    return [d for d in range(1, n+1) if n % d == 0]
+
+def _factorizations(n, k):
+    '''
+    All ordered k-tuples of positive integers with product n
+    '''
+    if k == 1:
+        return [(n,)]
+    return [(d,) + rest for d in _divisors(n) for rest in _factorizations(n//d, k-1)]
+
+def _surface(dims):
+    nz, ny, nx = dims
+    return 2*(nz*ny + nz*nx + ny*nx)
+
 def DA_arange(da, x_range, y_range, z_range):
     '''
     Return x, y and z arrays
@@ -414,6 +669,29 @@ def DA_arange(da, x_range, y_range, z_range):
         x, y, z (np.ndarrays): coordinate arrays,
             all sized (nz, ny, nx)
     '''
+    (x, y, z), spacing = DA_arange_sparse(da, x_range, y_range, z_range)
+    z, y, x = np.meshgrid(z.ravel(), y.ravel(), x.ravel(), indexing='ij')
+    return x, y, z
+
+def DA_arange_sparse(da, x_range, y_range, z_range):
+    '''
+    Like `DA_arange`, but return the coordinates
+    as "sparse" arrays (as from np.ix_), which
+    broadcast against each other to the local block:
+    functions of the coordinates, such as np.sin(x)*y,
+    then cost no more memory than the result.
+    The grid spacings are returned too.
+
+    Args:
+        x_range (tuple): (xmin, xmax)
+        y_range (tuple): (ymin, ymax)
+        z_range (tuple): (zmin, zmax)
+
+    Returns:
+        (x, y, z), (dx, dy, dz): coordinate arrays
+            sized (1, 1, nx), (1, ny, 1) and (nz, 1, 1),
+            and the spacings
+    '''
     nz, ny, nx = da.nz, da.ny, da.nx
     npz, npy, npx = da.npz, da.npy, da.npx
     mz, my, mx = da.mz, da.my, da.mx
@@ -424,12 +702,11 @@ def DA_arange(da, x_range, y_range, z_range):
     x_start, y_start, z_start = (x_range[0] + mx*nx*dx,
             y_range[0] + my*ny*dy,
             z_range[0] + mz*nz*dz)
-    z, y, x = np.meshgrid(
+    z, y, x = np.ix_(
             np.linspace(z_start, z_start+(nz-1)*dz, nz),
             np.linspace(y_start, y_start+(ny-1)*dy, ny),
-            np.linspace(x_start, x_start+(nx-1)*dx, nx),
-            indexing='ij')
-    return x, y, z
+            np.linspace(x_start, x_start+(nx-1)*dx, nx))
+    return (x, y, z), (dx, dy, dz)
 
 def DA_scatter_blocks(da, x_global, x_local):
 
@@ -441,10 +718,11 @@ def DA_scatter_blocks(da, x_global, x_local):
     size = da.size
     rank = da.rank
 
+    datatype = mpi_type(x_local.dtype)
     start_z, start_y, start_x = mz*nz, my*ny, mx*nx
-    subarray_aux = MPI.DOUBLE.Create_subarray([NZ, NY, NX],
+    subarray_aux = datatype.Create_subarray([NZ, NY, NX],
                         [nz, ny, nx], [start_z, start_y, start_x])
-    subarray = subarray_aux.Create_resized(0, 8)
+    subarray = subarray_aux.Create_resized(0, x_local.dtype.itemsize)
     subarray.Commit()
 
     start_index = np.array(start_z*(NX*NY) + start_y*(NX) + start_x, dtype=np.int)
@@ -455,7 +733,7 @@ def DA_scatter_blocks(da, x_global, x_local):
     da.comm.Barrier()
 
     da.comm.Scatterv([x_global, np.ones(size, dtype=np.int), displs, subarray],
-        [x_local, MPI.DOUBLE], root=0)
+        [x_local, datatype], root=0)
 
     subarray.Free()
 
@@ -469,10 +747,11 @@ def DA_gather_blocks(da, x_local, x_global):
     size = da.size
     rank = da.rank 
 
+    datatype = mpi_type(x_local.dtype)
     start_z, start_y, start_x = mz*nz, my*ny, mx*nx
-    subarray_aux = MPI.DOUBLE.Create_subarray([NZ, NY, NX],
+    subarray_aux = datatype.Create_subarray([NZ, NY, NX],
                         [nz, ny, nx], [start_z, start_y, start_x])
-    subarray = subarray_aux.Create_resized(0, 8)
+    subarray = subarray_aux.Create_resized(0, x_local.dtype.itemsize)
     subarray.Commit()
 
     start_index = np.array(start_z*(NX*NY) + start_y*(NX) + start_x, dtype=np.int)
@@ -482,7 +761,7 @@ def DA_gather_blocks(da, x_local, x_global):
     da.comm.Gather(sendbuf, recvbuf, root=0)
     da.comm.Barrier()
 
-    da.comm.Gatherv([x_local, MPI.DOUBLE],
+    da.comm.Gatherv([x_local, datatype],
         [x_global, np.ones(size, dtype=np.int), displs, subarray], root=0)
 
     subarray.Free()
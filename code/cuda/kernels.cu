@@ -1,9 +1,12 @@
 #include <cuda.h>
+/* `real` is float or double, and `index_t` (the type of flat indices
+   into 3-d arrays) int or long long, as defined when the kernels are built
+   (see kernels.py) */
 extern "C" {
 
-__global__ void computeRHS(const double *f_local_d,
-                        double *rhs_d,
-                        double dx,
+__global__ void computeRHS(const real *f_local_d,
+                        real *rhs_d,
+                        real dx,
                         int mx,
                         int npx)
 {
@@ -28,29 +31,29 @@ __global__ void computeRHS(const double *f_local_d,
     int ny = gridDim.y*blockDim.y;
     int nz = gridDim.z*blockDim.z;
 
-    int i = iz*(nx*ny) + iy*nx + ix;
-    int iloc = (iz+1)*((nx+2)*(ny+2)) + (iy+1)*(nx+2) + (ix+1);
+    index_t i = ((index_t)iz*ny + iy)*nx + ix;
+    index_t iloc = ((index_t)(iz+1)*(ny+2) + (iy+1))*(nx+2) + (ix+1);
 
-    rhs_d[i] = (3./(4*dx))*(f_local_d[iloc+1] - f_local_d[iloc-1]);
+    rhs_d[i] = (3.0f/(4*dx))*(f_local_d[iloc+1] - f_local_d[iloc-1]);
 
     if (mx == 0) {
         if (ix == 0) {
-            rhs_d[i] = (1./(2*dx))*(-5*f_local_d[iloc] + 4*f_local_d[iloc+1] + f_local_d[iloc+2]);
+            rhs_d[i] = (1.0f/(2*dx))*(-5*f_local_d[iloc] + 4*f_local_d[iloc+1] + f_local_d[iloc+2]);
         }
     }
 
     if (mx == npx-1) {
         if (ix == nx-1) {
-            rhs_d[i] = -(1./(2*dx))*(-5*f_local_d[iloc] + 4*f_local_d[iloc-1] + f_local_d[iloc-2]);
+            rhs_d[i] = -(1.0f/(2*dx))*(-5*f_local_d[iloc] + 4*f_local_d[iloc-1] + f_local_d[iloc-2]);
         }
     }
 }
 
-__global__ void sumSolutions(double* x_R_d,
-                             double* x_UH_d,
-                             double* x_LH_d,
-                             double* alpha,
-                             double* beta,
+__global__ void sumSolutions(real* x_R_d,
+                             real* x_UH_d,
+                             real* x_LH_d,
+                             real* alpha,
+                             real* beta,
                             int nx,
                             int ny,
                             int nz)
@@ -65,16 +68,17 @@ __global__ void sumSolutions(double* x_R_d,
     int ix = blockIdx.x*blockDim.x + threadIdx.x;
     int iy = blockIdx.y*blockDim.y + threadIdx.y;
     int iz = blockIdx.z*blockDim.z + threadIdx.z;
-    int i3d, i2d;
+    int i2d;
+    index_t i3d;
 
     i2d = iz*ny + iy;
-    i3d = iz*(ny*nx) + iy*nx + ix;
+    i3d = ((index_t)iz*ny + iy)*nx + ix;
 
     x_R_d[i3d] = x_R_d[i3d] + alpha[i2d]*x_UH_d[ix] + beta[i2d]*x_LH_d[ix];
 }
 
-__global__ void negateAndCopyFaces( double* x,
-             double* x_faces,
+__global__ void negateAndCopyFaces( real* x,
+             real* x_faces,
             int nx,
             int ny,
             int nz,
@@ -90,41 +94,41 @@ __global__ void negateAndCopyFaces( double* x,
     int iy = blockIdx.x*blockDim.x + threadIdx.x;
     int iz = blockIdx.y*blockDim.y + threadIdx.y;
 
-    int i_source;
+    index_t i_source;
     int i_dest;
     
-    i_source = iz*(nx*ny) + iy*nx + 0;
+    i_source = ((index_t)iz*ny + iy)*nx + 0;
     i_dest = 0 + iz*ny + iy;
     
     x_faces[i_dest] = -x[i_source];
 
     if (mx == 0) {
-        x_faces[i_dest] = 0.0;        
+        x_faces[i_dest] = 0;        
     }
 
-    i_source = iz*(nx*ny) + iy*nx + nx-1;
+    i_source = ((index_t)iz*ny + iy)*nx + nx-1;
     i_dest = nz*ny + iz*ny + iy;
     
     x_faces[i_dest] = -x[i_source];
     
     if (mx == npx-1) {
-        x_faces[i_dest] = 0.0;        
+        x_faces[i_dest] = 0;        
     }
 }
 
-__global__ void reducedSolverKernel(double *a_d,
-                                    double *b_d,
-                                    double *c_d,
-                                    double *c2_d,
-                                    double *d_d,
+__global__ void reducedSolverKernel(real *a_d,
+                                    real *b_d,
+                                    real *c_d,
+                                    real *c2_d,
+                                    real *d_d,
                                     int nx,
                                     int ny,
                                     int nz) {
     int gix = blockIdx.x*blockDim.x + threadIdx.x;
     int giy = blockIdx.y*blockDim.y + threadIdx.y;
     int start = giy*(nx) + gix;
-    int stride = nx*ny;
-    double bmac;
+    index_t stride = (index_t)nx*ny;
+    real bmac;
 
     /* do a serial TDMA on the local system */
 
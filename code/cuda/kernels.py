@@ -11,9 +11,57 @@ def render_kernel(template_filename, out_filename, **kwargs):
     with open(out_filename, 'w') as f:
         f.write(kernel)
 
-def get_funcs(filename, *args):
+def c_type(dtype):
+    '''
+    The C type ("float" or "double")
+    for the numpy dtype `dtype`
+    '''
+    dtype = np.dtype(dtype)
+    if dtype == np.float32:
+        return 'float'
+    elif dtype == np.float64:
+        return 'double'
+    raise ValueError('Unsupported dtype: {0}'.format(dtype))
+
+def index_type(index_dtype):
+    '''
+    The C type ("int" or "long long")
+    for the numpy integer dtype `index_dtype`
+    '''
+    index_dtype = np.dtype(index_dtype)
+    if index_dtype == np.int32:
+        return 'int'
+    elif index_dtype == np.int64:
+        return 'long long'
+    raise ValueError('Unsupported index dtype: {0}'.format(index_dtype))
+
+def index_dtype(size):
+    '''
+    The integer dtype for flat indices into arrays
+    of `size` elements: numpy.int32 if they fit
+    (which is faster), numpy.int64 otherwise.
+    '''
+    if size <= np.iinfo(np.int32).max:
+        return np.int32
+    return np.int64
+
+def get_funcs(filename, *args, **kwargs):
+    '''
+    Compile the code in `filename` and get the
+    kernels in args therein.
+    The floating-point type `real` in the kernels
+    is float or double according to the keyword
+    argument `dtype` (default: numpy.float64),
+    and the type `index_t` of flat indices into
+    3-d arrays is int or long long according to
+    `index_dtype` (default: numpy.int32).
+    '''
+    dtype = kwargs.get('dtype', np.float64)
+    index_dtype = kwargs.get('index_dtype', np.int32)
     with open(filename) as f:
         kernel_source = f.read()
+    kernel_source = '#define real {0}\n#define index_t {1}\n'.format(
+            c_type(dtype), index_type(index_dtype)) + kernel_source
     module = compiler.SourceModule(kernel_source, options=['-lineinfo', '-O2'], arch='sm_35')
     
     funcs = []
@@ -1,18 +1,47 @@
 import numpy as np
+import pycuda.driver as cuda
+import pycuda.gpuarray as gpuarray
 import kernels
 import os
+from autotune import grid_size
 
 class ReducedSolver:
-    def __init__(self, shape):
+    def __init__(self, shape, dtype=np.float64, index_dtype=None):
         '''
         Create context for pThomas (thread-parallel Thomas algorithm)
+        of floating-point type `dtype`, with flat indices
+        of type `index_dtype` (default: see kernels.index_dtype)
         '''
         self.nz, self.ny, self.nx = shape 
+        self.dtype = np.dtype(dtype)
+        if index_dtype is None:
+            index_dtype = kernels.index_dtype(self.nz*self.ny*self.nx)
+        self.index_dtype = np.dtype(index_dtype)
         thisdir = os.path.dirname(os.path.realpath(__file__))
-        self.solver, = kernels.get_funcs(thisdir + '/' + 'kernels.cu', 'reducedSolverKernel')
+        self.solver, = kernels.get_funcs(thisdir + '/' + 'kernels.cu', 'reducedSolverKernel',
+                dtype=self.dtype, index_dtype=self.index_dtype)
         self.solver.prepare([np.intp, np.intp, np.intp, np.intp, np.intp, np.intc, np.intc, np.intc])
+        # threads per block (see `tune`):
+        self.block = (16, 16, 1)
 
     def solve(self, a_d, b_d, c_d, c2_d, x_d):
-        self.solver.prepared_call((self.nx/16, self.ny/16, 1), (16, 16, 1),
+        self.solver.prepared_call(grid_size((self.nx, self.ny, 1), self.block), self.block,
              a_d.gpudata, b_d.gpudata, c_d.gpudata, c2_d.gpudata, x_d.gpudata,
                 np.int32(self.nx), np.int32(self.ny), np.int32(self.nz))
+
+    def tune(self, tuner):
+        '''
+        Set `self.block` to the fastest for this
+        system size, as benchmarked (or recorded) by the
+        autotune.Autotuner `tuner`, on a diagonal system.
+        '''
+        a_d = gpuarray.zeros(self.nx, self.dtype)
+        b_d = a_d + 1
+        x_d = gpuarray.zeros((self.nz, self.ny, self.nx), self.dtype)
+        default = self.block
+        def run(block):
+            self.block = block
+            self.solve(a_d, b_d, a_d, a_d.copy(), x_d)
+            cuda.Context.synchronize()
+        self.block = tuner.block_size('reducedSolverKernel', (self.nx, self.ny, 1),
+                self.dtype, self.index_dtype, run, default)
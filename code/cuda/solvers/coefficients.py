@@ -0,0 +1,138 @@
+'''
+Coefficient tables of the near-Toeplitz solvers,
+shared by the solvers in `globalmem` and `templated`.
+'''
+import pycuda.gpuarray as gpuarray
+import pycuda.driver as cuda
+import numpy as np
+from collections import OrderedDict
+
+def _precompute_coefficients(system_size, coeffs):
+    '''
+    The a, b, c, k1, k2
+    used in the Cyclic Reduction Algorithm can be
+    *pre-computed*.
+    Further, for the special case
+    of constant coefficients,
+    they are the same at (almost) each step of reduction,
+    with the exception, of course of the boundary conditions.
+
+    Thus, the information can be stored in arrays
+    sized log2(system_size)-1,
+    as opposed to arrays sized system_size.
+
+    Values at the first and last point at each step
+    need to be stored seperately.
+
+    The last values for a and b are required only at
+    the final stage of forward reduction (the 2-by-2 solve),
+    so for convenience, these two scalar values are stored
+    at the end of arrays a and b.
+
+    -- See the paper
+    "Fast Tridiagonal Solvers on the GPU"
+    '''
+    # these arrays technically have length 1 more than required:
+    log2_system_size = int(np.log2(system_size))
+
+    a = np.zeros(log2_system_size, np.float64)
+    b = np.zeros(log2_system_size, np.float64)
+    c = np.zeros(log2_system_size, np.float64)
+    k1 = np.zeros(log2_system_size, np.float64)
+    k2 = np.zeros(log2_system_size, np.float64)
+
+    b_first = np.zeros(log2_system_size, np.float64)
+    k1_first = np.zeros(log2_system_size, np.float64)
+    k1_last = np.zeros(log2_system_size, np.float64)
+
+    [b1, c1,
+        ai, bi, ci,
+            an, bn] = coeffs
+
+    num_reductions = log2_system_size - 1
+    for i in range(num_reductions):
+        if i == 0:
+            k1[i] = ai/bi
+            k2[i] = ci/bi
+            a[i] = -ai*k1[i]
+            b[i] = bi - ci*k1[i] - ai*k2[i]
+            c[i] = -ci*k2[i]
+
+            k1_first[i] = ai/b1
+            b_first[i] = bi - c1*k1_first[i] - ai*k2[i]
+
+            k1_last[i] = an/bi
+            a_last = -(ai)*k1_last[i]
+            b_last = bn - (ci)*k1_last[i]
+        else:
+            k1[i] = a[i-1]/b[i-1]
+            k2[i] = c[i-1]/b[i-1]
+            a[i] = -a[i-1]*k1[i]
+            b[i] = b[i-1] - c[i-1]*k1[i] - a[i-1]*k2[i]
+            c[i] = -c[i-1]*k2[i]
+
+            k1_first[i] = a[i-1]/b_first[i-1]
+            b_first[i] = b[i-1] - c[i-1]*k1_first[i] - a[i-1]*k2[i]
+
+            k1_last[i] = a_last/b[i-1]
+            a_last = -a[i-1]*k1_last[i]
+            b_last = b_last - c[i-1]*k1_last[i]
+
+    # put the last values for a and b at the end of the arrays:
+    a[-1] = a_last
+    b[-1] = b_last
+
+    return a, b, c, k1, k2, b_first, k1_first, k1_last
+
+# The coefficient tables depend only on (nx, coeffs, dtype),
+# so they are shared by all solvers: the host tables in `_host_tables`,
+# and their copies on the device in `_device_tables`, one per
+# CUDA context.
+# Each cache keeps at most MAX_CACHED_TABLES entries,
+# dropping the least recently used first.
+MAX_CACHED_TABLES = 16
+_host_tables = OrderedDict()
+_device_tables = OrderedDict()
+
+def get_coefficients(system_size, coeffs, dtype=np.float64):
+    '''
+    The (read-only) tables returned by `_precompute_coefficients`,
+    converted to `dtype`. They are computed once for every
+    (system_size, coeffs, dtype).
+    '''
+    def create():
+        tables = [table.astype(dtype)
+                for table in _precompute_coefficients(system_size, coeffs)]
+        for table in tables:
+            table.setflags(write=False)
+        return tables
+    return _lookup(_host_tables, _table_key(system_size, coeffs, dtype), create)
+
+def get_device_coefficients(system_size, coeffs, dtype=np.float64):
+    '''
+    The tables of `get_coefficients` as GPUArrays,
+    copied once to the current context.
+    '''
+    def create():
+        return [gpuarray.to_gpu(table)
+                for table in get_coefficients(system_size, coeffs, dtype)]
+    key = (cuda.Context.get_current().handle,) + _table_key(system_size, coeffs, dtype)
+    return _lookup(_device_tables, key, create)
+
+def clear_coefficient_cache():
+    _host_tables.clear()
+    _device_tables.clear()
+
+def _table_key(system_size, coeffs, dtype):
+    return (int(system_size), tuple(float(coeff) for coeff in coeffs),
+            np.dtype(dtype).str)
+
+def _lookup(cache, key, create):
+    if key in cache:
+        value = cache.pop(key)
+    else:
+        value = create()
+    cache[key] = value
+    while len(cache) > MAX_CACHED_TABLES:
+        cache.popitem(last=False)
+    return value
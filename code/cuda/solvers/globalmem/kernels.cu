@@ -1,13 +1,16 @@
+/* `real` is float or double, and `index_t` (the type of flat indices
+   into 3-d arrays) int or long long, as defined when the kernels are built
+   (see kernels.py) */
 extern "C"{
-__global__ void globalForwardReduction(const double *a_d,
-                                const double *b_d,
-                                const double *c_d,
-                                double *d_d,
-                                const double *k1_d,
-                                const double *k2_d,
-                                const double *b_first_d,
-                                const double *k1_first_d,
-                                const double *k1_last_d,
+__global__ void globalForwardReduction(const real *a_d,
+                                const real *b_d,
+                                const real *c_d,
+                                real *d_d,
+                                const real *k1_d,
+                                const real *k2_d,
+                                const real *b_first_d,
+                                const real *k1_first_d,
+                                const real *k1_last_d,
                                 const int nx,
                                 const int ny,
                                 const int nz,
@@ -19,11 +22,11 @@ __global__ void globalForwardReduction(const double *a_d,
     int i;
     int m, n;
     int idx;
-    int gi3d, gi3d0;
-    double x_m, x_n;
+    index_t gi3d, gi3d0;
+    real x_m, x_n;
 
-    gi3d = giz*(nx*ny) + giy*nx + gix;
-    gi3d0 = giz*(nx*ny) + giy*nx + 0;
+    gi3d = ((index_t)giz*ny + giy)*nx + gix;
+    gi3d0 = ((index_t)giz*ny + giy)*nx + 0;
 
     // forward reduction
     if (stride == nx)
@@ -63,16 +66,16 @@ __global__ void globalForwardReduction(const double *a_d,
     }
 }
 
-__global__ void globalBackSubstitution(const double *a_d,
-                                    const double *b_d,
-                                    const double *c_d,
-                                    double *d_d,
-                                    const double *b_first_d,
-                                    const double b1,
-                                    const double c1,
-                                    const double ai,
-                                    const double bi,
-                                    const double ci,
+__global__ void globalBackSubstitution(const real *a_d,
+                                    const real *b_d,
+                                    const real *c_d,
+                                    real *d_d,
+                                    const real *b_first_d,
+                                    const real b1,
+                                    const real c1,
+                                    const real ai,
+                                    const real bi,
+                                    const real ci,
                                     const int nx,
                                     const int ny,
                                     const int nz,
@@ -83,9 +86,9 @@ __global__ void globalBackSubstitution(const double *a_d,
     int giz = blockIdx.z*blockDim.z + threadIdx.z;
     int i;
     int idx;
-    int gi3d, gi3d0;
+    index_t gi3d, gi3d0;
 
-    gi3d0 = giz*(nx*ny) + giy*nx + 0;
+    gi3d0 = ((index_t)giz*ny + giy)*nx + 0;
     i = (stride/2-1) + gix*stride;
     gi3d = gi3d0 + i;
 
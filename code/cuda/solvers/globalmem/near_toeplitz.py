@@ -2,6 +2,7 @@ import pycuda.gpuarray as gpuarray
 import pycuda.driver as cuda
 import numpy as np
 import kernels
+from solvers.coefficients import get_device_coefficients
 import os
 
 '''
@@ -32,7 +33,7 @@ The tridiagonal system is then of the form:
 
 class NearToeplitzSolver:
 
-    def __init__(self, shape, coeffs):
+    def __init__(self, shape, coeffs, dtype=np.float64, index_dtype=None):
         '''
         Create context for the Cyclic Reduction Solver
         that solves a "near-toeplitz"
@@ -47,29 +48,33 @@ class NearToeplitzSolver:
         shape: The size of the tridiagonal system.
         coeffs: A list of coefficients that make up the tridiagonal matrix:
             [b1, c1, ai, bi, ci, an, bn]
+        dtype: (optional) floating-point type of the system
+            (numpy.float64 or numpy.float32). The coefficients are
+            always precomputed in double precision.
+        index_dtype: (optional) integer type of the flat indices
+            in the kernels (numpy.int32 or numpy.int64). By default,
+            numpy.int64 only if the system has 2**31 elements or more.
         '''
         self.nz, self.ny, self.nx = shape
         self.coeffs = coeffs
+        self.dtype = np.dtype(dtype)
+        if index_dtype is None:
+            index_dtype = kernels.index_dtype(self.nz*self.ny*self.nx)
+        self.index_dtype = np.dtype(index_dtype)
 
         # check that system_size is a power of 2:
         assert np.int(np.log2(self.nx)) == np.log2(self.nx)
 
-        # compute coefficients a, b, etc.,
-        a, b, c, k1, k2, b_first, k1_first, k1_last = _precompute_coefficients(self.nx, self.coeffs)
-
-        # copy coefficients to buffers:
-        self.a_d = gpuarray.to_gpu(a)
-        self.b_d = gpuarray.to_gpu(b)
-        self.c_d = gpuarray.to_gpu(c)
-        self.k1_d = gpuarray.to_gpu(k1)
-        self.k2_d = gpuarray.to_gpu(k2)
-        self.b_first_d = gpuarray.to_gpu(b_first)
-        self.k1_first_d = gpuarray.to_gpu(k1_first)
-        self.k1_last_d = gpuarray.to_gpu(k1_last)
+        # coefficients a, b, etc., on the device
+        # (shared by all solvers of this size, coefficients and dtype):
+        (self.a_d, self.b_d, self.c_d, self.k1_d, self.k2_d,
+            self.b_first_d, self.k1_first_d, self.k1_last_d) = get_device_coefficients(
+                    self.nx, self.coeffs, self.dtype)
         
         self.forward_reduction, self.back_substitution = kernels.get_funcs(
                 os.path.dirname(os.path.realpath(__file__)) + '/' + 'kernels.cu',
-                'globalForwardReduction', 'globalBackSubstitution')
+                'globalForwardReduction', 'globalBackSubstitution', dtype=self.dtype,
+                    index_dtype=self.index_dtype)
         
         self.forward_reduction.prepare([
                 np.intp, np.intp, np.intp, np.intp,
@@ -77,8 +82,8 @@ class NearToeplitzSolver:
                         np.intc, np.intc, np.intc, np.intc])
         self.back_substitution.prepare([
                 np.intp, np.intp, np.intp, np.intp, np.intp,
-                    np.float64, np.float64, np.float64, np.float64,
-                        np.float64,
+                    self.dtype, self.dtype, self.dtype, self.dtype,
+                        self.dtype,
                             np.intc, np.intc, np.intc, np.intc])
 
     def solve(self, x_d, block_sizes=(1, 1)):
@@ -93,6 +98,7 @@ class NearToeplitzSolver:
                 an, bn] = self.coeffs
 
         (bz, by) = block_sizes
+        real = self.dtype.type
 
         # CR algorithm
         # ============================================
@@ -110,86 +116,8 @@ class NearToeplitzSolver:
             stride /= 2
             self.back_substitution.prepared_call((1, self.ny/by, self.nz/bz), (self.nx/stride, by, bz),
                 self.a_d.gpudata, self.b_d.gpudata, self.c_d.gpudata, x_d.gpudata, self.b_first_d.gpudata,
-                    np.float64(b1), np.float64(c1),
-                        np.float64(ai), np.float64(bi), np.float64(ci),
+                    real(b1), real(c1),
+                        real(ai), real(bi), real(ci),
                             np.int32(self.nx), np.int32(self.ny), np.int32(self.nz),
                                 np.int32(stride))
        # ============================================
-
-def _precompute_coefficients(system_size, coeffs):
-    '''
-    The a, b, c, k1, k2
-    used in the Cyclic Reduction Algorithm can be
-    *pre-computed*.
-    Further, for the special case
-    of constant coefficients,
-    they are the same at (almost) each step of reduction,
-    with the exception, of course of the boundary conditions.
-
-    Thus, the information can be stored in arrays
-    sized log2(system_size)-1,
-    as opposed to arrays sized system_size.
-
-    Values at the first and last point at each step
-    need to be stored seperately.
-
-    The last values for a and b are required only at
-    the final stage of forward reduction (the 2-by-2 solve),
-    so for convenience, these two scalar values are stored
-    at the end of arrays a and b.
-
-    -- See the paper
-    "Fast Tridiagonal Solvers on the GPU"
-    '''
-    # these arrays technically have length 1 more than required:
-    log2_system_size = int(np.log2(system_size))
-
-    a = np.zeros(log2_system_size, np.float64)
-    b = np.zeros(log2_system_size, np.float64)
-    c = np.zeros(log2_system_size, np.float64)
-    k1 = np.zeros(log2_system_size, np.float64)
-    k2 = np.zeros(log2_system_size, np.float64)
-
-    b_first = np.zeros(log2_system_size, np.float64)
-    k1_first = np.zeros(log2_system_size, np.float64)
-    k1_last = np.zeros(log2_system_size, np.float64)
-
-    [b1, c1,
-        ai, bi, ci,
-            an, bn] = coeffs
-
-    num_reductions = log2_system_size - 1
-    for i in range(num_reductions):
-        if i == 0:
-            k1[i] = ai/bi
-            k2[i] = ci/bi
-            a[i] = -ai*k1[i]
-            b[i] = bi - ci*k1[i] - ai*k2[i]
-            c[i] = -ci*k2[i]
-
-            k1_first[i] = ai/b1
-            b_first[i] = bi - c1*k1_first[i] - ai*k2[i]
-
-            k1_last[i] = an/bi
-            a_last = -(ai)*k1_last[i]
-            b_last = bn - (ci)*k1_last[i]
-        else:
-            k1[i] = a[i-1]/b[i-1]
-            k2[i] = c[i-1]/b[i-1]
-            a[i] = -a[i-1]*k1[i]
-            b[i] = b[i-1] - c[i-1]*k1[i] - a[i-1]*k2[i]
-            c[i] = -c[i-1]*k2[i]
-
-            k1_first[i] = a[i-1]/b_first[i-1]
-            b_first[i] = b[i-1] - c[i-1]*k1_first[i] - a[i-1]*k2[i]
-
-            k1_last[i] = a_last/b[i-1]
-            a_last = -a[i-1]*k1_last[i]
-            b_last = b_last - c[i-1]*k1_last[i]
-
-    # put the last values for a and b at the end of the arrays:
-    a[-1] = a_last
-    b[-1] = b_last
-
-    return a, b, c, k1, k2, b_first, k1_first, k1_last
-
@@ -21,6 +21,17 @@ def test_DA_arange():
                 assert_equal(x[i, j, :], np.arange(6, 11))
     print 'pass'
 
+def test_DA_arange_sparse():
+    da = DA(comm, [5, 5, 5], [2, 2, 2], 1)
+    x, y, z = DA_arange(da, (1., 10.), (1., 10.), (1., 10.))
+    (x_s, y_s, z_s), (dx, dy, dz) = DA_arange_sparse(da, (1., 10.), (1., 10.), (1., 10.))
+    assert_equal(x_s.shape, (1, 1, 5))
+    assert_equal(y_s.shape, (1, 5, 1))
+    assert_equal(z_s.shape, (5, 1, 1))
+    assert_equal(x_s*y_s*z_s, x*y*z)
+    assert_equal((dx, dy, dz), (1., 1., 1.))
+    print 'pass'
+
 def test_DA_get_line_DA():
     da = DA(comm, [5, 5, 5], [2, 2, 2], 1)
     line_da = da.get_line_DA(0)
@@ -44,6 +55,7 @@ def test_DA_gather():
 
 if __name__ == "__main__":
     test_DA_arange()
+    test_DA_arange_sparse()
     test_DA_get_line_DA()
     test_DA_gather()
     MPI.Finalize()
@@ -0,0 +1,42 @@
+import numpy as np
+import pycuda.gpuarray as gpuarray
+
+class Workspace:
+
+    def __init__(self):
+        '''
+        Device arrays that are allocated once,
+        on first use, and reused by every later call
+        of a solver, instead of allocating (and freeing)
+        temporaries in every call.
+
+        Arrays are named by the caller and are valid
+        until they are next requested under the same name.
+        '''
+        self.arrays = {}
+
+    def get(self, name, shape, dtype):
+        '''
+        The array `name`, allocated on first use
+        (or if its shape or dtype have changed).
+        Its contents are undefined.
+        '''
+        shape = tuple(shape)
+        dtype = np.dtype(dtype)
+        array = self.arrays.get(name)
+        if array is None or array.shape != shape or array.dtype != dtype:
+            array = gpuarray.empty(shape, dtype)
+            self.arrays[name] = array
+        return array
+
+    def to_gpu(self, name, ary):
+        '''
+        Copy the host array `ary` to the array `name`.
+        '''
+        array = self.get(name, ary.shape, ary.dtype)
+        array.set(np.ascontiguousarray(ary))
+        return array
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in self.arrays.values())
@@ -0,0 +1,175 @@
+'''
+Choosing the local (work-group) sizes of kernels by benchmarking.
+
+For every kernel and global size, `Autotuner.local_size` times
+the kernel with each candidate local size on the device,
+and the fastest one is recorded in a tuning file (JSON),
+keyed by the device name, the kernel name, the global size,
+and the types of the values and of the flat indices
+the kernel is built for:
+
+    {"<device name>": {"computeRHS 64x64x64 float64 int32": [64, 2, 1], ...}, ...}
+
+Later runs on the same device read the recorded
+local sizes from the file instead of benchmarking again.
+A recorded null means that the OpenCL implementation
+chooses the local size (a local size of None).
+
+The tuning file is TUNING_FILE, which can be set
+with the environment variable COMPACT_TUNING_FILE.
+'''
+import os
+import json
+import time
+import fcntl
+import socket
+from contextlib import contextmanager
+import numpy as np
+import pyopencl as cl
+
+TUNING_FILE = os.environ.get('COMPACT_TUNING_FILE',
+        os.path.expanduser('~/.compact_tuning.json'))
+
+# every candidate is timed REPEATS times (after a first,
+# untimed launch), and the best time is kept:
+REPEATS = 3
+
+class Autotuner:
+
+    def __init__(self, device, filename=TUNING_FILE):
+        '''
+        :param device: the device that the kernels run on
+        :type device: pyopencl.Device
+        :param filename: the tuning file
+        :type filename: str
+        '''
+        self.device = device
+        self.device_name = device.name.strip()
+        self.filename = filename
+        self.records = _load(filename).get(self.device_name, {})
+
+    def local_size(self, kernel, global_size, dtype, index_dtype, run, candidates=None):
+        '''
+        The local size to launch `kernel` with,
+        for a launch of size `global_size`.
+
+        If no local size is recorded for this device, kernel,
+        global size and types, every candidate is passed to `run`,
+        which must launch the kernel with it and wait for it
+        to complete; the fastest is recorded and returned.
+        Candidates that the kernel cannot be launched with
+        (raising pyopencl.Error) are skipped.
+
+        :param kernel: the name the local size is recorded under
+        :type kernel: str
+        :param global_size: the global size of the launch
+        :type global_size: tuple
+        :param dtype: the type of the values the kernel is built for
+        :type dtype: numpy.dtype
+        :param index_dtype: the type of its flat indices
+        :type index_dtype: numpy.dtype
+        :param run: callable taking a local size
+        :param candidates: the local sizes to try
+            (default: `self.candidates(global_size)`)
+        :type candidates: list
+
+        Returns:
+            out (tuple): the local size, or None
+        '''
+        key = _key(kernel, global_size, dtype, index_dtype)
+        if key not in self.records:
+            if candidates is None:
+                candidates = self.candidates(global_size)
+            best, best_time = None, np.inf
+            for candidate in candidates:
+                try:
+                    t = _time(run, candidate)
+                except cl.Error:
+                    continue
+                if t < best_time:
+                    best, best_time = candidate, t
+            self.records[key] = None if best is None else list(best)
+            self.save()
+        local_size = self.records[key]
+        if local_size is None:
+            return None
+        return tuple(local_size)
+
+    def candidates(self, global_size):
+        '''
+        The candidate local sizes for a launch of size `global_size`:
+        None, and all local sizes of powers of 2 that divide
+        the global size, within the limits of the device,
+        of at least 1/16 of the maximum work-group size
+        (so that work-groups are not too small to be efficient).
+        '''
+        max_size = self.device.max_work_group_size
+        max_item_sizes = self.device.max_work_item_sizes
+        min_size = min(max_size//16, int(np.prod(global_size)))
+        sizes = [()]
+        for n, max_item_size in zip(global_size, max_item_sizes):
+            sizes = [size + (m,) for size in sizes
+                    for m in powers_of_2(n) if m <= max_item_size]
+        return [None] + [size for size in sizes
+                if min_size <= np.prod(size) <= max_size]
+
+    def save(self):
+        '''
+        Write the records for this device to the tuning file,
+        keeping those of other devices in it, and those that other
+        processes have saved since it was read. As several processes
+        (possibly on several nodes) may be writing it, they take turns
+        under a lock (see `_locked`), and the file is replaced atomically.
+        '''
+        with _locked(self.filename):
+            all_records = _load(self.filename)
+            records = all_records.setdefault(self.device_name, {})
+            records.update(self.records)
+            self.records = dict(records)
+            tmp_filename = '{0}.{1}.{2}'.format(self.filename, socket.gethostname(),
+                    os.getpid())
+            with open(tmp_filename, 'w') as f:
+                json.dump(all_records, f, indent=1, sort_keys=True)
+            os.rename(tmp_filename, self.filename)
+
+def powers_of_2(n):
+    '''
+    The powers of 2 that divide n
+    '''
+    powers = [1]
+    while n % (2*powers[-1]) == 0:
+        powers.append(2*powers[-1])
+    return powers
+
+def _key(kernel, global_size, dtype, index_dtype):
+    return '{0} {1} {2} {3}'.format(kernel, 'x'.join(str(n) for n in global_size),
+            np.dtype(dtype).name, np.dtype(index_dtype).name)
+
+def _time(run, local_size):
+    run(local_size)
+    times = []
+    for i in range(REPEATS):
+        t1 = time.time()
+        run(local_size)
+        times.append(time.time() - t1)
+    return min(times)
+
+@contextmanager
+def _locked(filename):
+    '''
+    Hold an exclusive lock of the file `filename` + '.lock'
+    (a POSIX record lock, which also holds across nodes
+    on file systems supporting them, such as NFS)
+    '''
+    with open(filename + '.lock', 'a') as lock_file:
+        fcntl.lockf(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.lockf(lock_file, fcntl.LOCK_UN)
+
+def _load(filename):
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as f:
+        return json.load(f)
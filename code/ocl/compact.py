@@ -8,20 +8,100 @@ import kernels
 from near_toeplitz import *
 from pthomas import *
 from mpi_util import *
+from profiler import Profiler, create_queue
+from costs import *
+from workspace import Workspace
+from autotune import Autotuner
 
 class CompactFiniteDifferenceSolver:
 
-    def __init__(self, da, use_gpu=False):
+    def __init__(self, da, use_gpu=False, profile=False, reduced_dtype=None,
+            slab_size=None, directions=(0, 1, 2), zero_copy=None, autotune=False,
+            index_dtype=None, hierarchical=False, overlap_halos=False, fused=False):
         '''
-        :param da: DA object carrying the grid information
+        :param da: DA object carrying the grid information.
+            Function values, derivatives and all messages
+            have the floating-point type of the DA (`da.dtype`).
         :type da: mpi_util.DA
         :param use_gpu: set True if using GPU
         :type use_gpu: bool
+        :param profile: set True to record kernel and phase
+            timings in `self.profiler`
+        :type profile: bool
+        :param reduced_dtype: floating-point type in which the
+            reduced system is built and solved (default: `da.dtype`).
+            With a numpy.float32 DA and numpy.float64 here,
+            the solver runs in "mixed" precision.
+        :type reduced_dtype: numpy.dtype
+        :param slab_size: if given, every derivative is computed
+            in slabs of at most `slab_size` planes (along the first
+            axis of the block, as ordered for that derivative),
+            so that only two slabs are on the device at a time
+            (see `_solve_line_streamed`)
+        :type slab_size: int
+        :param directions: the derivatives (0, 1, 2 for x, y, z)
+            the solver is set up for
+        :type directions: tuple
+        :param zero_copy: if True, the kernels read the function
+            values and write the derivatives in host memory
+            (USE_HOST_PTR buffers, mapped instead of copied).
+            By default, this is done if the device shares memory
+            with the host (see `host_unified`).
+            Slab streaming always copies.
+        :type zero_copy: bool
+        :param autotune: set True to launch the kernels with the
+            local sizes found fastest for this device and problem
+            size (see `tune`), instead of the defaults
+        :type autotune: bool
+        :param index_dtype: integer type of the flat indices in the
+            kernels: numpy.int32, or numpy.int64 for blocks that
+            (with ghost points) have 2**31 elements or more.
+            By default, chosen by the size of the block.
+        :type index_dtype: numpy.dtype
+        :param hierarchical: set True to gather the reduced system
+            (and scatter its solution) through one process per node
+            (see mpi_util.NodeAggregator), rather than exchanging
+            messages between the first process of every line
+            and all the others
+        :type hierarchical: bool
+        :param overlap_halos: set True to compute the RHS at the
+            points of every line that need no ghost points while the
+            ghost points are exchanged, and at the first and last
+            points once they have arrived (see `_begin_RHS`)
+        :type overlap_halos: bool
+        :param fused: set True to compute the RHS in the first level
+            of the reduction of the primary system, and copy the faces
+            in the last level of its back substitution, rather than
+            in kernels of their own (see `solve_primary_system`)
+        :type fused: bool
         '''
         self.da = da
         self.use_gpu = use_gpu
+        self.dtype = da.dtype
+        if reduced_dtype is None:
+            reduced_dtype = da.dtype
+        self.reduced_dtype = np.dtype(reduced_dtype)
+        if index_dtype is None:
+            sw = da.stencil_width
+            index_dtype = kernels.index_dtype((da.nz+2*sw)*(da.ny+2*sw)*(da.nx+2*sw))
+        self.index_dtype = np.dtype(index_dtype)
+        self.slab_size = slab_size
+        self.directions = tuple(directions)
+        self.profiler = Profiler(enabled=profile)
+        self.hierarchical = hierarchical
+        self.overlap_halos = overlap_halos
+        self.fused = fused
+        self.workspaces = {}
+        self.aggregators = {}
+        self.pending = set()
+        self.local_sizes = {}
         self.init_cl()
+        if zero_copy is None:
+            zero_copy = host_unified(self.device)
+        self.zero_copy = zero_copy
         self.init_solvers()
+        if autotune:
+            self.tune()
 
     def dfdx(self, f, dx):
         '''
@@ -30,124 +110,640 @@ class CompactFiniteDifferenceSolver:
         :param dx: Spacing in x-direction
         :type dx: float
         '''
-        r_d = self.compute_RHS(self.x_line_da, f, dx)
-        x_UH, x_LH = self.solve_secondary_systems(self.x_line_da)
-        self.x_primary_solver.solve(r_d, [1, 1])
-        alpha, beta = self.solve_reduced_system(self.x_line_da, x_UH, x_LH, r_d, self.x_reduced_solver)
-        self.sum_solutions(self.x_line_da, r_d, x_UH, x_LH, alpha, beta)
-        dfdx = r_d.get()
+        dfdx = self._line_derivative(0, f, dx)
         return dfdx 
     
     def dfdy(self, f, dy):
         f_T = f.transpose(0, 2, 1).copy()
-        r_d = self.compute_RHS(self.y_line_da, f_T, dy)
-        x_UH, x_LH = self.solve_secondary_systems(self.y_line_da)
-        self.y_primary_solver.solve(r_d, [1, 1])
-        alpha, beta = self.solve_reduced_system(self.y_line_da, x_UH, x_LH, r_d, self.y_reduced_solver)
-        self.sum_solutions(self.y_line_da, r_d, x_UH, x_LH, alpha, beta)
-        dfdy = r_d.get()
+        dfdy = self._line_derivative(1, f_T, dy)
         dfdy = dfdy.transpose(0, 2, 1).copy()
         return dfdy 
 
     def dfdz(self, f, dz):
         f_T = f.transpose(1, 2, 0).copy()
-        r_d = self.compute_RHS(self.z_line_da, f_T, dz)
-        x_UH, x_LH = self.solve_secondary_systems(self.z_line_da)
-        self.z_primary_solver.solve(r_d, [1, 1])
-        alpha, beta = self.solve_reduced_system(self.z_line_da, x_UH, x_LH, r_d, self.z_reduced_solver)
-        self.sum_solutions(self.z_line_da, r_d, x_UH, x_LH, alpha, beta)
-        dfdz = r_d.get()
+        dfdz = self._line_derivative(2, f_T, dz)
         dfdz = dfdz.transpose(2, 0, 1).copy()
         return dfdz
 
-    def compute_RHS(self, line_da, f, dx):
-        f_local = line_da.create_local_vector()
-        line_da.global_to_local(f, f_local)
-        f_d = cl_array.to_device(self.queue, f_local)
-        x_d = cl_array.Array(self.queue, (line_da.nz, line_da.ny, line_da.nx),
-                dtype=np.float64)
-        self.compute_RHS_kernel(self.queue, (line_da.nx, line_da.ny, line_da.nz),
-                None, f_d.data, x_d.data, np.float64(dx),
-                    np.int32(line_da.rank), np.int32(line_da.size))
+    def dfdx_async(self, f, dx):
+        '''
+        Start computing the x-derivative of f, and return a
+        DerivativeFuture for it instead of waiting for the result.
+        Derivatives in different directions can be in flight
+        at the same time (see `wait_all`), one per direction.
+        With `slab_size`, the derivative is computed before returning.
+        '''
+        return self._line_derivative_async(0, f, dx)
+
+    def dfdy_async(self, f, dy):
+        f_T = f.transpose(0, 2, 1).copy()
+        return self._line_derivative_async(1, f_T, dy,
+                lambda dfdy: dfdy.transpose(0, 2, 1).copy())
+
+    def dfdz_async(self, f, dz):
+        f_T = f.transpose(1, 2, 0).copy()
+        return self._line_derivative_async(2, f_T, dz,
+                lambda dfdz: dfdz.transpose(2, 0, 1).copy())
+
+    def pipeline(self, direction, fields, spacing):
+        '''
+        The derivatives in `direction` (0, 1 or 2 for x, y or z)
+        of the fields in `fields` (an iterable of 3-d arrays),
+        yielded in order. The halos of field k+1 are exchanged while
+        field k is solved and its reduced system is exchanged,
+        and field k+1 and its halos are then copied to the device
+        on a queue of their own (`transfer_queue`), without waiting
+        for the kernels of field k (see `_enqueue_inputs`).
+        With `slab_size`, the fields are solved in turn.
+
+        :param spacing: the spacing in `direction`
+        :type spacing: float
+        '''
+        axes, axes_back = _ORIENTATIONS[direction]
+        def orient(f):
+            return f if axes is None else f.transpose(axes).copy()
+        def finish(dfdx):
+            return dfdx if axes_back is None else dfdx.transpose(axes_back).copy()
+
+        if self.slab_size is not None:
+            for f in fields:
+                yield finish(self._line_derivative(direction, orient(f), spacing))
+            return
+
+        line_da = (self.x_line_da, self.y_line_da, self.z_line_da)[direction]
+        queue = self.direction_queues[direction]
+        future = None
+        for k, f in enumerate(fields):
+            f = np.ascontiguousarray(orient(f), dtype=self.dtype)
+            requests = line_da.global_to_local_begin(f, None)
+            # field k-1 progresses while the halos of field k travel:
+            while not MPI.Request.Testall(requests):
+                if future is not None:
+                    future.done()
+            line_da.global_to_local_end(None, requests)
+            # alternate between two sets of device arrays,
+            # as those of field k-1 may still be in use:
+            inputs, uploads = self._enqueue_inputs(line_da, f, queue, str(k%2))
+            if future is not None:
+                yield future.result()
+            future = self._line_derivative_async(direction, f, spacing, finish,
+                    inputs, uploads)
+        if future is not None:
+            yield future.result()
+
+    def _line_derivative_async(self, direction, f, dx, finish=None, inputs=None,
+            uploads=None):
+        if self.slab_size is not None:
+            return DerivativeFuture(iter([]), self._line_derivative(direction, f, dx), finish)
+        if direction in self.pending:
+            raise ValueError('A derivative in direction {0} is already in flight'.format(
+                direction))
+        result = np.empty(f.shape, dtype=self.dtype)
+        self.pending.add(direction)
+        return DerivativeFuture(self._line_steps(direction, f, dx, result, inputs,
+                uploads), result, finish)
+
+    def _line_steps(self, direction, f, dx, result, inputs=None, uploads=None):
+        '''
+        Compute the derivative of f along the lines of the line
+        DA in `direction` into the host array `result`, as `_solve_line`
+        does, but with non-blocking copies and communication:
+        a generator yielding what every next step waits for,
+        OpenCL events or lists of MPI requests
+        (see DerivativeFuture).
+        If given, `inputs` are the device arrays of f and of its
+        halos (see `_compute_RHS`), and f is not exchanged
+        nor uploaded again; `uploads` are then the events of their
+        copies, which the RHS waits for, and the host arrays
+        they are copied from, kept until the steps are done
+        (see `_enqueue_inputs`).
+        '''
+        line_da = (self.x_line_da, self.y_line_da, self.z_line_da)[direction]
+        primary_solver = (self.x_primary_solver, self.y_primary_solver,
+                self.z_primary_solver)[direction]
+        reduced_solver = (self.x_reduced_solver, self.y_reduced_solver,
+                self.z_reduced_solver)[direction]
+        queue = self.direction_queues[direction]
+        nz, ny, nx = line_da.nz, line_da.ny, line_da.nx
+        line_size = line_da.size
+        wait_for = None
+        if uploads is not None:
+            # `hosts` are only kept for the copies:
+            wait_for, hosts = uploads
+
+        try:
+            x_UH, x_LH = self.solve_secondary_systems(line_da)
+            if inputs is None and not self.overlap_halos:
+                f = np.ascontiguousarray(f, dtype=self.dtype)
+                requests = line_da.global_to_local_begin(f, None)
+                if not self.hierarchical:
+                    yield requests
+                line_da.global_to_local_end(None, requests)
+                inputs = (self._field_to_device(line_da, f, queue),
+                        self._halos_to_device(line_da, queue))
+            if inputs is not None:
+                r_d, x_R_faces_d = self.solve_primary_system(line_da, primary_solver,
+                        None, queue, inputs, dx, wait_for)
+            else:
+                rhs = self._begin_RHS(line_da, f, dx, queue)
+                if not self.hierarchical:
+                    yield rhs[-1]
+                r_d, x_R_faces_d = self.solve_primary_system(line_da, primary_solver,
+                        self._end_RHS(line_da, dx, queue, *rhs), queue)
+            if self.hierarchical:
+                # the node aggregator has no non-blocking form, and its
+                # blocking collectives must be reached in the same order
+                # on every process: nothing is yielded before them, so
+                # that they run when the future is created
+                # (not when it is driven, see `wait_all`):
+                alpha, beta = self.solve_reduced_system(line_da, x_UH, x_LH, r_d,
+                        reduced_solver, queue, x_R_faces_d)
+            else:
+                if x_R_faces_d is None:
+                    x_R_faces_d = self._copy_faces(line_da, r_d, queue)
+                x_R_faces = np.empty([nz, ny, 2], dtype=self.dtype)
+                yield cl.enqueue_copy(queue, x_R_faces, x_R_faces_d.data, is_blocking=False)
+
+                lengths, displacements, subarray = self._faces_layout(line_da)
+                x_H = np.array([x_UH[0], x_UH[-1], x_LH[0], x_LH[-1]])
+                x_H_line = np.zeros([line_size, 4], dtype=np.float64)
+                x_R_faces_line = np.zeros([nz, ny, 2*line_size], dtype=self.dtype)
+                yield [line_da.comm.Igather([x_H, 4, MPI.DOUBLE], [x_H_line, 4, MPI.DOUBLE]),
+                        line_da.comm.Igatherv([x_R_faces, line_da.mpi_type],
+                            [x_R_faces_line, lengths, displacements, subarray])]
+
+                if line_da.rank == 0:
+                    params = self._solve_reduced(line_da, x_H_line[:, :2].ravel(),
+                            x_H_line[:, 2:].ravel(), x_R_faces_line, reduced_solver, queue)
+                else:
+                    params = None
+                params_local = np.zeros([nz, ny, 2], dtype=self.dtype)
+                yield [line_da.comm.Iscatterv([params, lengths, displacements, subarray],
+                        [params_local, line_da.mpi_type])]
+                alpha = params_local[:, :, 0].copy()
+                beta = params_local[:, :, 1].copy()
+
+            self.sum_solutions(line_da, r_d, x_UH, x_LH, alpha, beta, queue)
+            yield cl.enqueue_copy(queue, result, r_d.data, is_blocking=False)
+        finally:
+            # also if the steps fail, or are abandoned:
+            self.pending.discard(direction)
+
+    def _line_derivative(self, direction, f, dx):
+        '''
+        Compute the derivative of f along the lines
+        of the line DA in `direction` (0, 1 or 2 for x, y or z),
+        and return it on the host.
+        '''
+        if self.slab_size is not None:
+            return self._solve_line_streamed(direction, f, dx)
+        line_da = (self.x_line_da, self.y_line_da, self.z_line_da)[direction]
+        primary_solver = (self.x_primary_solver, self.y_primary_solver,
+                self.z_primary_solver)[direction]
+        reduced_solver = (self.x_reduced_solver, self.y_reduced_solver,
+                self.z_reduced_solver)[direction]
+        r_d = self._solve_line(line_da, f, dx, primary_solver, reduced_solver,
+                self.direction_queues[direction])
+        if self.zero_copy:
+            return self._map_to_host(r_d)
+        return r_d.get()
+
+    def _solve_line(self, line_da, f, dx, primary_solver, reduced_solver, queue):
+        '''
+        Compute the derivative of f along the lines of `line_da`
+        (the last axis of f), enqueued on `queue` (that of the solvers).
+        Returns the device array with the result.
+        '''
+        prof = self.profiler
+        inputs = None
+        with prof.phase('compute_RHS'):
+            if self.fused and not self.overlap_halos:
+                # the RHS is computed by the primary solver:
+                inputs = self.prepare_RHS(line_da, f, queue)
+                r_d = self._rhs_array(line_da, queue)
+            else:
+                r_d = self.compute_RHS(line_da, f, dx, queue)
+        with prof.phase('solve_secondary_systems'):
+            x_UH, x_LH = self.solve_secondary_systems(line_da)
+        with prof.phase('solve_primary_system'):
+            r_d, x_R_faces_d = self.solve_primary_system(line_da, primary_solver,
+                    r_d, queue, inputs, dx)
+        with prof.phase('solve_reduced_system'):
+            alpha, beta = self.solve_reduced_system(line_da, x_UH, x_LH, r_d,
+                    reduced_solver, queue, x_R_faces_d)
+        with prof.phase('sum_solutions'):
+            self.sum_solutions(line_da, r_d, x_UH, x_LH, alpha, beta, queue)
+        return r_d
+
+    def _solve_line_streamed(self, direction, f, dx):
+        '''
+        Compute the derivative of f along the lines of the
+        line DA in `direction`, one slab (of `self.slab_das[direction]`)
+        at a time, and return it on the host.
+
+        Slabs alternate between two command queues:
+        the upload of slab k+1 is enqueued before slab k is solved,
+        so that it overlaps with the solution of slab k.
+        The results are copied back into their place
+        in the output array as each slab is done.
+        '''
+        prof = self.profiler
+        slab_da = self.slab_das[direction]
+        primary_solvers = self.slab_primary_solvers[direction]
+        reduced_solvers = self.slab_reduced_solvers[direction]
+        slab_nz = slab_da.nz
+        nslabs = f.shape[0]/slab_nz
+        result = np.empty(f.shape, dtype=self.dtype)
+
+        def upload(k):
+            queue = self.queues[k%2]
+            slab = np.ascontiguousarray(f[k*slab_nz:(k+1)*slab_nz], dtype=self.dtype)
+            slab_da.update_halos(slab)
+            f_d = self._workspace(slab_da, queue).get('f', slab.shape, self.dtype)
+            cl.enqueue_copy(queue, f_d.data, slab, is_blocking=False)
+            # slab must outlive the copy:
+            return slab, f_d, self._halos_to_device(slab_da, queue)
+
+        with prof.phase('solve_secondary_systems'):
+            x_UH, x_LH = self.solve_secondary_systems(slab_da)
+        uploads = {0: upload(0)}
+        for k in range(nslabs):
+            queue = self.queues[k%2]
+            if k+1 < nslabs:
+                uploads[k+1] = upload(k+1)
+            slab, f_d, halos_d = uploads.pop(k)
+            r_d, inputs = None, None
+            if self.fused:
+                inputs = (f_d, halos_d)
+            else:
+                with prof.phase('compute_RHS'):
+                    r_d = self._compute_RHS(slab_da, f_d, halos_d, dx, queue)
+            with prof.phase('solve_primary_system'):
+                r_d, x_R_faces_d = self.solve_primary_system(slab_da, primary_solvers[k%2],
+                        r_d, queue, inputs, dx)
+            with prof.phase('solve_reduced_system'):
+                alpha, beta = self.solve_reduced_system(slab_da, x_UH, x_LH, r_d,
+                        reduced_solvers[k%2], queue, x_R_faces_d)
+            with prof.phase('sum_solutions'):
+                self.sum_solutions(slab_da, r_d, x_UH, x_LH, alpha, beta, queue)
+            cl.enqueue_copy(queue, result[k*slab_nz:(k+1)*slab_nz], r_d.data,
+                    is_blocking=False)
+        for queue in self.queues:
+            queue.finish()
+        return result
+
+    def compute_RHS(self, line_da, f, dx, queue=None):
+        if queue is None:
+            queue = self.queue
+        if self.overlap_halos:
+            return self._end_RHS(line_da, dx, queue, *self._begin_RHS(line_da, f, dx, queue))
+        f_d, halos_d = self.prepare_RHS(line_da, f, queue)
+        return self._compute_RHS(line_da, f_d, halos_d, dx, queue,
+                self._rhs_array(line_da, queue))
+
+    def prepare_RHS(self, line_da, f, queue=None):
+        '''
+        Exchange the halos of f, and return the device arrays
+        of f and of its halos, from which the RHS is computed
+        (by `compute_RHS`, or by `solve_primary_system`).
+        '''
+        if queue is None:
+            queue = self.queue
+        f = np.ascontiguousarray(f, dtype=self.dtype)
+        line_da.update_halos(f)
+        return self._field_to_device(line_da, f, queue), self._halos_to_device(line_da, queue)
+
+    def solve_primary_system(self, line_da, primary_solver, r_d=None, queue=None,
+            inputs=None, dx=None, wait_for=None):
+        '''
+        Solve the primary system of `line_da` with `primary_solver`
+        (a NearToeplitzSolver enqueuing on `queue`), in place in `r_d`
+        (by default, a workspace array).
+        If `inputs`, the device arrays of a field and of its halos
+        (see `prepare_RHS`), are given, the RHS is computed from them
+        with spacing `dx` first, else `r_d` holds the RHS.
+        The first kernel waits for the events `wait_for`, if given
+        (e.g. those of the copies of `inputs`).
+
+        With `fused` (and lines of at least 4 points), the RHS is
+        computed in the first level of the reduction, and the faces
+        (see `_copy_faces`) are copied in the last level of the
+        back substitution, which saves a pass over `r_d` each.
+
+        Returns:
+            out (tuple): `r_d`, and the device array of the faces,
+                or None if they are not copied yet
+        '''
+        if queue is None:
+            queue = self.queue
+        if r_d is None:
+            r_d = self._workspace(line_da, queue).get('x',
+                    (line_da.nz, line_da.ny, line_da.nx), self.dtype)
+        fused = self.fused and line_da.nx >= 4
+        if inputs is not None and not fused:
+            r_d = self._compute_RHS(line_da, inputs[0], inputs[1], dx, queue, r_d,
+                    wait_for)
+            wait_for = None
+        if not fused:
+            primary_solver.solve(r_d, wait_for=wait_for)
+            return r_d, None
+        rhs = None
+        if inputs is not None:
+            f_d, (left_halo_d, right_halo_d) = inputs
+            rhs = (f_d, left_halo_d, right_halo_d, dx, line_da.stencil_width,
+                    line_da.rank, line_da.size)
+        x_R_faces_d = self._faces_array(line_da, queue)
+        primary_solver.solve(r_d, rhs=rhs, faces=(x_R_faces_d, line_da.mx, line_da.npx),
+                wait_for=wait_for)
+        return r_d, x_R_faces_d
+
+    def _begin_RHS(self, line_da, f, dx, queue):
+        '''
+        Start the exchange of the halos of f, upload it,
+        and enqueue computeRHSInterior, which needs no ghost points.
+        Returns the state to pass to `_end_RHS`, the last item of which
+        are the requests of the exchange.
+        '''
+        nz, ny, nx = line_da.nz, line_da.ny, line_da.nx
+        f = np.ascontiguousarray(f, dtype=self.dtype)
+        requests = line_da.global_to_local_begin(f, None)
+        f_d = self._field_to_device(line_da, f, queue)
+        x_d = self._rhs_array(line_da, queue)
+        if nx > 2:
+            global_size = (nx-2, ny, nz)
+            evt = self.compute_RHS_interior_kernel(queue, global_size,
+                    self.local_sizes.get(('computeRHSInterior', global_size)),
+                        f_d.data, x_d.data, self.dtype.type(dx), np.int32(nx))
+            self.profiler.add_event('computeRHSInterior', evt,
+                    compute_RHS_cost(nz, ny, nx-2, self.dtype.itemsize))
+            # submit it to the device now, while the halos travel:
+            queue.flush()
+        return f_d, x_d, requests
+
+    def _end_RHS(self, line_da, dx, queue, f_d, x_d, requests):
+        '''
+        Complete the exchange started by `_begin_RHS`,
+        upload the halos, and enqueue computeRHSBoundary.
+        Returns the device array of the RHS.
+        '''
+        nz, ny, nx = line_da.nz, line_da.ny, line_da.nx
+        line_da.global_to_local_end(None, requests)
+        left_halo_d, right_halo_d = self._halos_to_device(line_da, queue)
+        global_size = (2, ny, nz)
+        evt = self.compute_RHS_boundary_kernel(queue, global_size,
+                self.local_sizes.get(('computeRHSBoundary', global_size)),
+                    f_d.data, left_halo_d.data, right_halo_d.data, x_d.data,
+                        self.dtype.type(dx), np.int32(nx), np.int32(line_da.stencil_width),
+                            np.int32(line_da.rank), np.int32(line_da.size))
+        self.profiler.add_event('computeRHSBoundary', evt,
+                compute_RHS_cost(nz, ny, 2, self.dtype.itemsize))
+        return x_d
+
+    def _field_to_device(self, line_da, f, queue, suffix=''):
+        '''
+        The device array of the function values `f` (C-contiguous,
+        without ghost points): with `zero_copy`, in host memory
+        (and held by the workspace, as f may be a temporary),
+        otherwise copied to the workspace array 'f' + `suffix`.
+        '''
+        workspace = self._workspace(line_da, queue)
+        if self.zero_copy:
+            return workspace.hold('f' + suffix, self._wrap_host(f, queue))
+        return workspace.to_device('f' + suffix, f)
+
+    def _halos_to_device(self, line_da, queue, suffix=''):
+        '''
+        The device arrays of the receive halos of `line_da`
+        before and after the lines ('left' and 'right'),
+        copied, as the next exchange overwrites them.
+        With `zero_copy`, the copies are held by the workspace
+        under the same names, for the kernels reading them.
+        '''
+        halos = (line_da.left_recv_halo, line_da.right_recv_halo)
+        workspace = self._workspace(line_da, queue)
+        if self.zero_copy:
+            return tuple(workspace.hold(name + suffix, self._wrap_host(halo.copy(), queue))
+                    for name, halo in zip(('left_halo', 'right_halo'), halos))
+        return tuple(workspace.to_device(name + suffix, halo)
+                for name, halo in zip(('left_halo', 'right_halo'), halos))
+
+    def _enqueue_inputs(self, line_da, f, queue, suffix=''):
+        '''
+        Enqueue the copies of the function values `f` (C-contiguous)
+        and of the receive halos of `line_da` to the workspace arrays
+        of solves on `queue` ('f', 'left_halo' and 'right_halo',
+        + `suffix`), on `transfer_queue`: unlike the copies of
+        `_field_to_device` and `_halos_to_device`, they do not wait
+        for the kernels already enqueued on `queue`,
+        nor for themselves to complete.
+        With `zero_copy`, nothing is copied.
+
+        Returns:
+            out (tuple): the device arrays of f and of its halos
+                (as `inputs` of `solve_primary_system`), and the events
+                of the copies with the host arrays they copy,
+                which must be kept until the copies are complete
+        '''
+        if self.zero_copy:
+            return (self._field_to_device(line_da, f, queue, suffix),
+                    self._halos_to_device(line_da, queue, suffix)), None
+        workspace = self._workspace(line_da, queue)
+        # the next exchange overwrites the receive halos:
+        hosts = (f, line_da.left_recv_halo.copy(), line_da.right_recv_halo.copy())
+        arrays, events = [], []
+        for name, ary in zip(('f', 'left_halo', 'right_halo'), hosts):
+            ary_d, evt = workspace.enqueue_to_device(name + suffix, ary,
+                    self.transfer_queue)
+            self.profiler.add_transfer('upload', evt, ary.nbytes)
+            arrays.append(ary_d)
+            events.append(evt)
+        # start the copies now, not when they are first waited for:
+        self.transfer_queue.flush()
+        return (arrays[0], tuple(arrays[1:])), (events, hosts)
+
+    def _rhs_array(self, line_da, queue):
+        '''
+        The device array for the RHS, and the derivative computed
+        in its place: with `zero_copy`, in host memory
+        (see `_map_to_host`), otherwise from the workspace.
+        '''
+        if self.zero_copy:
+            return self._wrap_host(line_da.create_global_vector(), queue)
+        return self._workspace(line_da, queue).get('x',
+                (line_da.nz, line_da.ny, line_da.nx), self.dtype)
+
+    def _compute_RHS(self, line_da, f_d, halos_d, dx, queue, x_d=None, wait_for=None):
+        if x_d is None:
+            x_d = self._workspace(line_da, queue).get('x',
+                    (line_da.nz, line_da.ny, line_da.nx), self.dtype)
+        left_halo_d, right_halo_d = halos_d
+        global_size = (line_da.nx, line_da.ny, line_da.nz)
+        evt = self.compute_RHS_kernel(queue, global_size,
+                self.local_sizes.get(('computeRHS', global_size)),
+                    f_d.data, left_halo_d.data, right_halo_d.data, x_d.data,
+                        self.dtype.type(dx), np.int32(line_da.stencil_width),
+                            np.int32(line_da.rank), np.int32(line_da.size),
+                                wait_for=wait_for)
+        self.profiler.add_event('computeRHS', evt,
+                compute_RHS_cost(line_da.nz, line_da.ny, line_da.nx, self.dtype.itemsize))
         return x_d
     
-    def sum_solutions(self, line_da, x_R_d, x_UH, x_LH, alpha, beta):
-        x_UH_d = cl_array.to_device(self.queue, x_UH)
-        x_LH_d = cl_array.to_device(self.queue, x_LH)
-        alpha_d = cl_array.to_device(self.queue, alpha)
-        beta_d = cl_array.to_device(self.queue, beta)
-        evt = self.sum_solutions_kernel(self.queue, (line_da.nx, line_da.ny, line_da.nz), None,
+    def sum_solutions(self, line_da, x_R_d, x_UH, x_LH, alpha, beta, queue=None):
+        if queue is None:
+            queue = self.queue
+        workspace = self._workspace(line_da, queue)
+        x_UH_d = workspace.to_device('x_UH', x_UH.astype(self.dtype))
+        x_LH_d = workspace.to_device('x_LH', x_LH.astype(self.dtype))
+        alpha_d = workspace.to_device('alpha', alpha.astype(self.dtype, copy=False))
+        beta_d = workspace.to_device('beta', beta.astype(self.dtype, copy=False))
+        global_size = (line_da.nx, line_da.ny, line_da.nz)
+        evt = self.sum_solutions_kernel(queue, global_size,
+                self.local_sizes.get(('sumSolutions', global_size)),
                 x_R_d.data, x_UH_d.data,
                     x_LH_d.data, alpha_d.data, beta_d.data,
                         np.int32(line_da.nx), np.int32(line_da.ny),
                             np.int32(line_da.nz))
+        self.profiler.add_event('sumSolutions', evt,
+                sum_solutions_cost(line_da.nz, line_da.ny, line_da.nx, self.dtype.itemsize))
 
-    def solve_reduced_system(self, line_da, x_UH, x_LH, x_R_d, reduced_solver):
+    def solve_reduced_system(self, line_da, x_UH, x_LH, x_R_d, reduced_solver, queue=None,
+            x_R_faces_d=None):
+        '''
+        Solve the reduced system of `line_da`, whose right-hand side
+        is made of the faces of `x_R_d`, the solution of the primary
+        system: by default, copied from it (see `_copy_faces`),
+        or already in `x_R_faces_d` (see `solve_primary_system`).
+        Returns alpha and beta, the [nz, ny] coefficients of
+        the secondary solutions x_UH and x_LH in the solution.
+        '''
+        if queue is None:
+            queue = self.queue
         nz, ny, nx = line_da.nz, line_da.ny, line_da.nx
         line_rank = line_da.rank
         line_size = line_da.size
         
-        x_UH_line = np.zeros(2*line_size, dtype=np.float64)
-        x_LH_line = np.zeros(2*line_size, dtype=np.float64)
-        line_da.gather(
-                [np.array([x_UH[0], x_UH[-1]]), 2, MPI.DOUBLE],
-                [x_UH_line, 2, MPI.DOUBLE])
-        line_da.gather(
-                [np.array([x_LH[0], x_LH[-1]]), 2, MPI.DOUBLE],
-                [x_LH_line, 2, MPI.DOUBLE])
+        if self.hierarchical:
+            aggregator = self._aggregator(line_da)
+            x_H_line = aggregator.gather(np.array([x_UH[0], x_UH[-1], x_LH[0], x_LH[-1]]))
+            if line_rank == 0:
+                x_UH_line = x_H_line[:, :2].ravel()
+                x_LH_line = x_H_line[:, 2:].ravel()
+        else:
+            x_UH_line = np.zeros(2*line_size, dtype=np.float64)
+            x_LH_line = np.zeros(2*line_size, dtype=np.float64)
+            line_da.gather(
+                    [np.array([x_UH[0], x_UH[-1]]), 2, MPI.DOUBLE],
+                    [x_UH_line, 2, MPI.DOUBLE])
+            line_da.gather(
+                    [np.array([x_LH[0], x_LH[-1]]), 2, MPI.DOUBLE],
+                    [x_LH_line, 2, MPI.DOUBLE])
 
-        lengths = np.ones(line_size)
-        displacements = np.arange(0, 2*line_size, 2)
-        start_z, start_y, start_x = 0, 0, displacements[line_rank]
-        subarray_aux = MPI.DOUBLE.Create_subarray([nz, ny, 2*line_size],
-                            [nz, ny, 2], [start_z, start_y, start_x])
-        subarray = subarray_aux.Create_resized(0, 8)
-        subarray.Commit()
-        
-        x_R_faces_d = cl_array.Array(self.queue,
-                (nz, ny, 2), np.float64)
-        self.copy_faces_kernel(self.queue, [1, ny, nz], None,
-                x_R_d.data, x_R_faces_d.data,
-                    np.int32(nx), np.int32(ny), np.int32(nz),
-                        np.int32(line_da.mx), np.int32(line_da.npx))
+        lengths, displacements, subarray = self._faces_layout(line_da)
+        if x_R_faces_d is None:
+            x_R_faces_d = self._copy_faces(line_da, x_R_d, queue)
         x_R_faces = x_R_faces_d.get()
-        x_R_faces_line = np.zeros([nz, ny, 2*line_size], dtype=np.float64)
-        line_da.gatherv([x_R_faces, MPI.DOUBLE],
-                [x_R_faces_line, lengths, displacements, subarray])
+        if self.hierarchical:
+            x_R_faces_blocks = aggregator.gather(x_R_faces)
+            if line_rank == 0:
+                x_R_faces_line = x_R_faces_blocks.transpose(1, 2, 0, 3).reshape(
+                        [nz, ny, 2*line_size])
+        else:
+            x_R_faces_line = np.zeros([nz, ny, 2*line_size], dtype=self.dtype)
+            line_da.gatherv([x_R_faces, line_da.mpi_type],
+                    [x_R_faces_line, lengths, displacements, subarray])
         
         if line_rank == 0:
-            a_reduced = np.zeros(2*line_size, dtype=np.float64)
-            b_reduced = np.zeros(2*line_size, dtype=np.float64)
-            c_reduced = np.zeros(2*line_size, dtype=np.float64)
-            a_reduced[0::2] = -1.
-            a_reduced[1::2] = x_UH_line[1::2]
-            b_reduced[0::2] = x_UH_line[0::2]
-            b_reduced[1::2] = x_LH_line[1::2]
-            c_reduced[0::2] = x_LH_line[0::2]
-            c_reduced[1::2] = -1.
-            a_reduced[0], c_reduced[0] = 0.0, 0.0
-            b_reduced[0] = 1.0
-            a_reduced[-1], c_reduced[-1] = 0.0, 0.0
-            b_reduced[-1] = 1.0
-            a_reduced[1] = 0.
-            c_reduced[-2] = 0.
-            a_reduced_d = cl_array.to_device(self.queue, a_reduced)
-            b_reduced_d = cl_array.to_device(self.queue, b_reduced)
-            c_reduced_d = cl_array.to_device(self.queue, c_reduced)
-            c2_reduced_d = cl_array.to_device(self.queue, c_reduced)
-            d_reduced_d = cl_array.to_device(self.queue, x_R_faces_line)
-            reduced_solver.solve(a_reduced_d, b_reduced_d,
-                    c_reduced_d, c2_reduced_d, d_reduced_d)
-            params = d_reduced_d.get()
+            params = self._solve_reduced(line_da, x_UH_line, x_LH_line, x_R_faces_line,
+                    reduced_solver, queue)
         else:
             params = None
         
-        params_local = np.zeros([nz, ny, 2], dtype=np.float64)
-        line_da.scatterv([params, lengths, displacements, subarray],
-                [params_local, MPI.DOUBLE])
+        if self.hierarchical:
+            if params is not None:
+                params = params.reshape([nz, ny, line_size, 2]).transpose(2, 0, 1, 3)
+            params_local = aggregator.scatter(params, (nz, ny, 2), self.dtype)
+        else:
+            params_local = np.zeros([nz, ny, 2], dtype=self.dtype)
+            line_da.scatterv([params, lengths, displacements, subarray],
+                    [params_local, line_da.mpi_type])
         alpha = params_local[:, :, 0].copy()
         beta = params_local[:, :, 1].copy()
         return alpha, beta
+
+    def _faces_layout(self, line_da):
+        '''
+        The counts, displacements and MPI datatype with which the
+        [nz, ny, 2] faces of every process of `line_da` are gathered
+        into (and scattered from) the [nz, ny, 2*npx] faces of the line
+        '''
+        nz, ny = line_da.nz, line_da.ny
+        line_size = line_da.size
+        lengths = np.ones(line_size)
+        displacements = np.arange(0, 2*line_size, 2)
+        start_z, start_y, start_x = 0, 0, displacements[line_da.rank]
+        subarray_aux = line_da.mpi_type.Create_subarray([nz, ny, 2*line_size],
+                            [nz, ny, 2], [start_z, start_y, start_x])
+        subarray = subarray_aux.Create_resized(0, self.dtype.itemsize)
+        subarray.Commit()
+        return lengths, displacements, subarray
+
+    def _copy_faces(self, line_da, x_R_d, queue):
+        '''
+        Enqueue the copy of the (negated) first and last
+        points of every line of `x_R_d` to a [nz, ny, 2] device array
+        '''
+        nz, ny, nx = line_da.nz, line_da.ny, line_da.nx
+        x_R_faces_d = self._faces_array(line_da, queue)
+        global_size = (1, ny, nz)
+        evt = self.copy_faces_kernel(queue, global_size,
+                self.local_sizes.get(('negateAndCopyFaces', global_size)),
+                x_R_d.data, x_R_faces_d.data,
+                    np.int32(nx), np.int32(ny), np.int32(nz),
+                        np.int32(line_da.mx), np.int32(line_da.npx))
+        self.profiler.add_event('negateAndCopyFaces', evt,
+                copy_faces_cost(nz, ny, self.dtype.itemsize))
+        return x_R_faces_d
+
+    def _faces_array(self, line_da, queue):
+        return self._workspace(line_da, queue).get('x_R_faces',
+                (line_da.nz, line_da.ny, 2), self.dtype)
+
+    def _solve_reduced(self, line_da, x_UH_line, x_LH_line, x_R_faces_line,
+            reduced_solver, queue):
+        '''
+        Build and solve the reduced system of `line_da`
+        (on its first process), returning alpha and beta
+        of every process, as a [nz, ny, 2*npx] array
+        '''
+        line_size = line_da.size
+        workspace = self._workspace(line_da, queue)
+        # the reduced system is built and solved in `reduced_dtype`,
+        # which may be wider than the type it is communicated in:
+        reduced_dtype = self.reduced_dtype
+        a_reduced = np.zeros(2*line_size, dtype=reduced_dtype)
+        b_reduced = np.zeros(2*line_size, dtype=reduced_dtype)
+        c_reduced = np.zeros(2*line_size, dtype=reduced_dtype)
+        a_reduced[0::2] = -1.
+        a_reduced[1::2] = x_UH_line[1::2]
+        b_reduced[0::2] = x_UH_line[0::2]
+        b_reduced[1::2] = x_LH_line[1::2]
+        c_reduced[0::2] = x_LH_line[0::2]
+        c_reduced[1::2] = -1.
+        a_reduced[0], c_reduced[0] = 0.0, 0.0
+        b_reduced[0] = 1.0
+        a_reduced[-1], c_reduced[-1] = 0.0, 0.0
+        b_reduced[-1] = 1.0
+        a_reduced[1] = 0.
+        c_reduced[-2] = 0.
+        a_reduced_d = workspace.to_device('a_reduced', a_reduced)
+        b_reduced_d = workspace.to_device('b_reduced', b_reduced)
+        c_reduced_d = workspace.to_device('c_reduced', c_reduced)
+        c2_reduced_d = workspace.to_device('c2_reduced', c_reduced)
+        d_reduced_d = workspace.to_device('d_reduced',
+                x_R_faces_line.astype(reduced_dtype, copy=False))
+        reduced_solver.solve(a_reduced_d, b_reduced_d,
+                c_reduced_d, c2_reduced_d, d_reduced_d)
+        return d_reduced_d.get().astype(self.dtype, copy=False)
         
     def solve_secondary_systems(self, line_da):
         nz, ny, nx = line_da.nz, line_da.ny, line_da.nx
@@ -175,11 +771,142 @@ class CompactFiniteDifferenceSolver:
         x_LH = scipy_solve_banded(a, b, c, r_LH)
         return x_UH, x_LH
 
-    def setup_reduced_solver(self, line_da):
-       return PThomas(self.ctx, self.queue,
-               (line_da.nz, line_da.ny, 2*line_da.npx))
+    def _wrap_host(self, ary, queue):
+        '''
+        A device array using the memory of the host array `ary`
+        (which must be C-contiguous and outlive the device array).
+        '''
+        mf = cl.mem_flags
+        buf = cl.Buffer(self.ctx, mf.READ_WRITE | mf.USE_HOST_PTR, hostbuf=ary)
+        return cl_array.Array(queue, ary.shape, ary.dtype, data=buf)
+
+    def _map_to_host(self, ary_d):
+        '''
+        Wait for the kernels writing to `ary_d`, a device array
+        from `_wrap_host`, and make its host array up to date
+        by mapping and unmapping it.
+        Returns the host array.
+        '''
+        mapped, evt = cl.enqueue_map_buffer(ary_d.queue, ary_d.data,
+                cl.map_flags.READ, 0, ary_d.shape, ary_d.dtype, is_blocking=True)
+        mapped.base.release(ary_d.queue)
+        return ary_d.data.hostbuf
+
+    def tune(self, tuner=None):
+        '''
+        Benchmark the local sizes of every kernel for the
+        line DAs in use (or look them up in the tuning file),
+        and launch the kernels with the fastest from now on.
+        The solvers are tuned likewise (see
+        NearToeplitzSolver.tune and PThomas.tune).
+        The benchmark runs on scratch arrays,
+        and is not included in the profile.
+
+        :param tuner: the tuner (default: an autotune.Autotuner
+            for this device, with the default tuning file)
+        :type tuner: autotune.Autotuner
+        '''
+        if tuner is None:
+            tuner = Autotuner(self.device)
+        queue = self.queue
+        line_das = [self.x_line_da, self.y_line_da, self.z_line_da]
+        solvers = [self.x_primary_solver, self.y_primary_solver, self.z_primary_solver,
+                self.x_reduced_solver, self.y_reduced_solver, self.z_reduced_solver]
+        if self.slab_size is not None:
+            line_das += self.slab_das
+            for direction in self.directions:
+                solvers += self.slab_primary_solvers[direction]
+                solvers += self.slab_reduced_solvers[direction]
+        for line_da in line_das:
+            if line_da is None:
+                continue
+            nz, ny, nx = line_da.nz, line_da.ny, line_da.nx
+            sw = line_da.stencil_width
+            f_d = cl_array.zeros(queue, (nz, ny, nx), self.dtype)
+            halo_d = cl_array.zeros(queue, (nz, ny, sw), self.dtype)
+            x_d = cl_array.zeros(queue, (nz, ny, nx), self.dtype)
+            x_UH_d = cl_array.zeros(queue, nx, self.dtype)
+            alpha_d = cl_array.zeros(queue, (nz, ny), self.dtype)
+            x_faces_d = cl_array.zeros(queue, (nz, ny, 2), self.dtype)
+            launches = [
+                (self.compute_RHS_kernel, 'computeRHS', (nx, ny, nz),
+                    (f_d.data, halo_d.data, halo_d.data, x_d.data, self.dtype.type(1.0),
+                        np.int32(sw), np.int32(line_da.rank), np.int32(line_da.size))),
+                (self.sum_solutions_kernel, 'sumSolutions', (nx, ny, nz),
+                    (x_d.data, x_UH_d.data, x_UH_d.data, alpha_d.data, alpha_d.data,
+                        np.int32(nx), np.int32(ny), np.int32(nz))),
+                (self.copy_faces_kernel, 'negateAndCopyFaces', (1, ny, nz),
+                    (x_d.data, x_faces_d.data, np.int32(nx), np.int32(ny), np.int32(nz),
+                        np.int32(line_da.mx), np.int32(line_da.npx)))]
+            if self.overlap_halos:
+                launches.append((self.compute_RHS_boundary_kernel, 'computeRHSBoundary',
+                    (2, ny, nz), (f_d.data, halo_d.data, halo_d.data, x_d.data,
+                        self.dtype.type(1.0), np.int32(nx), np.int32(sw),
+                            np.int32(line_da.rank), np.int32(line_da.size))))
+                if nx > 2:
+                    launches.append((self.compute_RHS_interior_kernel, 'computeRHSInterior',
+                        (nx-2, ny, nz), (f_d.data, x_d.data, self.dtype.type(1.0),
+                            np.int32(nx))))
+            for kernel, name, global_size, args in launches:
+                def run(local_size):
+                    kernel(queue, global_size, local_size, *args).wait()
+                self.local_sizes[name, global_size] = tuner.local_size(name, global_size,
+                        self.dtype, self.index_dtype, run)
+        for solver in solvers:
+            if solver is not None:
+                solver.tune(tuner)
+        self.profiler.reset()
+
+    def destroy(self):
+        '''
+        Free the line and slab DAs of the solver (see mpi_util.DA.destroy),
+        which hold shared windows if `da` has `shared_memory`,
+        and the node aggregators of `hierarchical`, which always do.
+        This is collective, and the solver cannot be used afterwards.
+        '''
+        line_das = [self.x_line_da, self.y_line_da, self.z_line_da]
+        if self.slab_size is not None:
+            line_das += self.slab_das
+        for line_da in line_das:
+            # in the same order on every process:
+            if line_da in self.aggregators:
+                self.aggregators.pop(line_da).destroy()
+            if line_da is not None:
+                line_da.destroy()
+
+    def workspace_nbytes(self):
+        '''
+        The number of bytes of device memory held for temporaries
+        (see workspace.Workspace): as workspaces only grow,
+        this is also their peak size so far.
+        '''
+        return sum(workspace.nbytes for workspace in self.workspaces.values())
+
+    def _workspace(self, line_da, queue):
+        '''
+        The workspace for solves on `line_da`, enqueued on `queue`
+        '''
+        key = (line_da, queue)
+        if key not in self.workspaces:
+            self.workspaces[key] = Workspace(queue)
+        return self.workspaces[key]
+
+    def _aggregator(self, line_da):
+        '''
+        The NodeAggregator for the reduced systems of `line_da`
+        '''
+        if line_da not in self.aggregators:
+            self.aggregators[line_da] = NodeAggregator(line_da.comm)
+        return self.aggregators[line_da]
+
+    def setup_reduced_solver(self, line_da, queue=None):
+       if queue is None:
+           queue = self.queue
+       return PThomas(self.ctx, queue,
+               (line_da.nz, line_da.ny, 2*line_da.npx), self.profiler,
+                   dtype=self.reduced_dtype, index_dtype=self.index_dtype)
 
-    def setup_primary_solver(self, line_da):
+    def setup_primary_solver(self, line_da, queue=None):
         line_rank = line_da.rank
         line_size = line_da.size
         coeffs = [1., 1./4, 1./4, 1., 1./4, 1./4, 1.]
@@ -187,8 +914,11 @@ class CompactFiniteDifferenceSolver:
             coeffs[1] = 2.
         if line_rank == line_size-1:
             coeffs[-2] = 2.
-        return NearToeplitzSolver(self.ctx, self.queue,
-                (line_da.nz, line_da.ny, line_da.nx), coeffs)
+        if queue is None:
+            queue = self.queue
+        return NearToeplitzSolver(self.ctx, queue,
+                (line_da.nz, line_da.ny, line_da.nx), coeffs, self.profiler,
+                    dtype=self.dtype, index_dtype=self.index_dtype)
 
     def init_cl(self):
         self.platform = cl.get_platforms()[0]
@@ -198,21 +928,151 @@ class CompactFiniteDifferenceSolver:
         else:
             self.device = self.platform.get_devices()[0]
         self.ctx = cl.Context([self.device])
-        self.queue = cl.CommandQueue(self.ctx)
+        self.queue = create_queue(self.ctx, profile=self.profiler.enabled)
+        self.queues = [self.queue]
+        if self.slab_size is not None:
+            # a second queue, for double-buffering slabs:
+            self.queues.append(create_queue(self.ctx, profile=self.profiler.enabled))
+        # the solves in different directions are independent, and are
+        # enqueued on a queue of their own, so that the device can run
+        # them concurrently (e.g. those of DerivativeFutures):
+        self.direction_queues = [None, None, None]
+        for direction in self.directions:
+            self.direction_queues[direction] = create_queue(self.ctx,
+                    profile=self.profiler.enabled)
+        # the copies of the next inputs of a pipeline (see `pipeline`),
+        # enqueued while the kernels of the last are running:
+        self.transfer_queue = create_queue(self.ctx, profile=self.profiler.enabled)
         
-        self.compute_RHS_kernel, self.sum_solutions_kernel, self.copy_faces_kernel, = kernels.get_funcs(
-                self.ctx, 'kernels.cl', 'computeRHS', 'sumSolutions', 'negateAndCopyFaces')
+        (self.compute_RHS_kernel, self.sum_solutions_kernel, self.copy_faces_kernel,
+                self.compute_RHS_interior_kernel, self.compute_RHS_boundary_kernel) = kernels.get_funcs(
+                self.ctx, 'kernels.cl', 'computeRHS', 'sumSolutions', 'negateAndCopyFaces',
+                    'computeRHSInterior', 'computeRHSBoundary',
+                    dtype=self.dtype, index_dtype=self.index_dtype)
                  
     def init_solvers(self):
-        self.x_line_da = self.da.get_line_DA(0)
-        self.y_line_da = self.da.get_line_DA(1)
-        self.z_line_da = self.da.get_line_DA(2)
-        self.x_primary_solver = self.setup_primary_solver(self.x_line_da)
-        self.y_primary_solver = self.setup_primary_solver(self.y_line_da)
-        self.z_primary_solver = self.setup_primary_solver(self.z_line_da)
-        self.x_reduced_solver = self.setup_reduced_solver(self.x_line_da)
-        self.y_reduced_solver = self.setup_reduced_solver(self.y_line_da)
-        self.z_reduced_solver = self.setup_reduced_solver(self.z_line_da)
+        line_das = [None, None, None]
+        primary_solvers = [None, None, None]
+        reduced_solvers = [None, None, None]
+        for direction in self.directions:
+            line_das[direction] = self.da.get_line_DA(direction)
+            queue = self.direction_queues[direction]
+            primary_solvers[direction] = self.setup_primary_solver(line_das[direction], queue)
+            reduced_solvers[direction] = self.setup_reduced_solver(line_das[direction], queue)
+        self.x_line_da, self.y_line_da, self.z_line_da = line_das
+        self.x_primary_solver, self.y_primary_solver, self.z_primary_solver = primary_solvers
+        self.x_reduced_solver, self.y_reduced_solver, self.z_reduced_solver = reduced_solvers
+        if self.slab_size is not None:
+            self.slab_das = [None, None, None]
+            self.slab_primary_solvers = [None, None, None]
+            self.slab_reduced_solvers = [None, None, None]
+            for direction in self.directions:
+                line_da = line_das[direction]
+                slab_da = line_da.get_slab_DA(_slab_depth(line_da.nz, self.slab_size))
+                self.slab_das[direction] = slab_da
+                self.slab_primary_solvers[direction] = [self.setup_primary_solver(slab_da, queue)
+                    for queue in self.queues]
+                self.slab_reduced_solvers[direction] = [self.setup_reduced_solver(slab_da, queue)
+                    for queue in self.queues]
+
+class DerivativeFuture:
+
+    def __init__(self, steps, result, finish=None):
+        '''
+        A derivative being computed
+        (see CompactFiniteDifferenceSolver.dfdx_async).
+
+        :param steps: iterator running the computation step by step,
+            and yielding what the next step waits for:
+            an OpenCL event, or a list of MPI requests
+        :param result: the host array the derivative is computed into
+        :type result: numpy.ndarray
+        :param finish: if given, applied to `result` when complete
+        '''
+        self.steps = steps
+        self._result = result
+        self.finish = finish
+        self.waiting = None
+        self.finished = False
+        # start, up to the first wait:
+        self._next()
+
+    def done(self):
+        '''
+        Advance the computation as far as it goes
+        without waiting, and return True if it is complete.
+        '''
+        while not self.finished and _is_complete(self.waiting):
+            self._next()
+        return self.finished
+
+    def result(self):
+        '''
+        Wait for the computation to complete, and return the derivative.
+        '''
+        while not self.finished:
+            _wait(self.waiting)
+            self._next()
+        return self._result
+
+    def _next(self):
+        try:
+            self.waiting = next(self.steps)
+        except StopIteration:
+            self.waiting = None
+            self.finished = True
+            if self.finish is not None:
+                self._result = self.finish(self._result)
+
+def wait_all(futures):
+    '''
+    Drive the DerivativeFutures `futures` to completion together,
+    so that each progresses while the others wait,
+    and return their results.
+    '''
+    pending = list(futures)
+    while pending:
+        pending = [future for future in pending if not future.done()]
+    return [future.result() for future in futures]
+
+def _is_complete(waiting):
+    if waiting is None:
+        return True
+    if isinstance(waiting, cl.Event):
+        return waiting.command_execution_status == cl.command_execution_status.COMPLETE
+    return MPI.Request.Testall(waiting)
+
+def _wait(waiting):
+    if waiting is None:
+        return
+    if isinstance(waiting, cl.Event):
+        waiting.wait()
+    else:
+        MPI.Request.Waitall(waiting)
+
+# the axes that f is transposed to, for the derivative in every
+# direction to be along the last axis, and those transposing it back:
+_ORIENTATIONS = [(None, None), ((0, 2, 1), (0, 2, 1)), ((1, 2, 0), (2, 0, 1))]
+
+def host_unified(device):
+    '''
+    True if `device` works on host memory: a CPU device,
+    or one that reports a memory system unified with the host.
+    '''
+    if device.type & cl.device_type.CPU:
+        return True
+    try:
+        return bool(device.host_unified_memory)
+    except cl.Error:
+        return False
+
+def _slab_depth(nz, slab_size):
+    '''
+    The largest divisor of nz that is at most slab_size
+    '''
+    for depth in range(min(nz, slab_size), 0, -1):
+        if nz % depth == 0:
+            return depth
 
 def scipy_solve_banded(a, b, c, rhs):
     '''
@@ -0,0 +1,82 @@
+'''
+Bytes moved and floating-point operations
+of a single launch of each kernel in kernels.cl,
+computed from the launch geometry.
+
+Bytes count every array element a kernel
+reads or writes once per launch (`itemsize` bytes each:
+8 for double, the default, and 4 for float), so that
+bytes/time is the "effective" bandwidth of the kernel:
+extra traffic from cache lines that are only partly used
+(for instance, by the strided accesses of cyclic reduction)
+is not counted. Coefficient arrays of length log2(nx),
+shared by all threads, are ignored.
+
+Each function returns a tuple (bytes, flops).
+'''
+
+DOUBLE = 8
+
+def compute_RHS_cost(nz, ny, nx, itemsize=DOUBLE):
+    # reads f and, for the first and last point of every line,
+    # one ghost point from each of the two halo buffers
+    # (left_halo and right_halo), so nx+2 elements per line;
+    # writes rhs; (f[i+1] - f[i-1])*c in the interior:
+    nbytes = itemsize*(nz*ny*(nx+2) + nz*ny*nx)
+    flops = 2*nz*ny*nx
+    return nbytes, flops
+
+def compute_RHS_forward_reduction_cost(nz, ny, nx, itemsize=DOUBLE):
+    # computeRHS and the first level of the forward reduction
+    # in one pass: reads f and the ghost points (from the halo
+    # buffers, as computeRHS), writes every
+    # point of d once (the RHS, or its reduced value);
+    # 4 more flops for each of the nx/2 reduced points:
+    nbytes = itemsize*(nz*ny*(nx+2) + nz*ny*nx)
+    flops = 2*nz*ny*nx + 4*nz*ny*(nx/2)
+    return nbytes, flops
+
+def forward_reduction_cost(nz, ny, nx, stride, itemsize=DOUBLE):
+    nlines = nz*ny
+    if stride == nx:
+        # the 2-by-2 solve: read 2, write 2 elements of each line
+        return itemsize*4*nlines, 14*nlines
+    # every thread updates d[i] from d[i-stride/2] and d[i+stride/2]
+    # (shared with its neighbours):
+    nthreads = nx/stride
+    nbytes = itemsize*nlines*(2*nthreads + nthreads)
+    flops = 4*nlines*nthreads
+    return nbytes, flops
+
+def back_substitution_cost(nz, ny, nx, stride, itemsize=DOUBLE):
+    nlines = nz*ny
+    nthreads = nx/stride
+    nbytes = itemsize*nlines*(2*nthreads + nthreads)
+    flops = 5*nlines*nthreads
+    return nbytes, flops
+
+def back_substitution_faces_cost(nz, ny, nx, itemsize=DOUBLE):
+    # the last level (stride 2) of the back substitution,
+    # and the two faces of every line written (negated)
+    # without being read again:
+    nbytes, flops = back_substitution_cost(nz, ny, nx, 2, itemsize)
+    return nbytes + itemsize*2*nz*ny, flops + 2*nz*ny
+
+def pthomas_cost(nsystems, system_size, itemsize=DOUBLE):
+    # forward and backward sweep each read and write
+    # every element of d; a, b, c and c2 are shared:
+    nbytes = itemsize*(4*nsystems*system_size + 4*system_size)
+    flops = 8*nsystems*system_size
+    return nbytes, flops
+
+def sum_solutions_cost(nz, ny, nx, itemsize=DOUBLE):
+    # read and write x_R; read alpha, beta and x_UH, x_LH:
+    nbytes = itemsize*(2*nz*ny*nx + 2*nz*ny + 2*nx)
+    flops = 4*nz*ny*nx
+    return nbytes, flops
+
+def copy_faces_cost(nz, ny, itemsize=DOUBLE):
+    # read two faces and write them (negated):
+    nbytes = itemsize*4*nz*ny
+    flops = 2*nz*ny
+    return nbytes, flops
@@ -6,15 +6,13 @@ import matplotlib.pyplot as plt
 
 comm = MPI.COMM_WORLD 
 da = DA(comm, (8, 32, 16), (2, 2, 2), 1)
-x, y, z = DA_arange(da, (0, 2*np.pi), (0, 2*np.pi), (0, 2*np.pi))
+(x, y, z), (dx, dy, dz) = DA_arange_sparse(da, (0, 2*np.pi), (0, 2*np.pi), (0, 2*np.pi))
 f = y*np.cos(x*y) + np.sin(z)*y
-dfdx_true = (-y**2)*np.sin(x*y)
+dfdx_true = da.create_global_vector()
+dfdx_true[...] = (-y**2)*np.sin(x*y)
 dfdy_true = -(x*y)*np.sin(x*y) + np.cos(x*y) + np.sin(z)
-dfdz_true = y*np.cos(z)
-
-dz = z[1, 0, 0] - z[0, 0, 0]
-dy = y[0, 1, 0] - y[0, 0, 0]
-dx = x[0, 0, 1] - x[0, 0, 0]
+dfdz_true = da.create_global_vector()
+dfdz_true[...] = y*np.cos(z)
 
 cfd = CompactFiniteDifferenceSolver(da)
 
@@ -1,18 +1,26 @@
-__kernel void computeRHS(__global double *f_local_d,
-                        __global double *rhs_d,
-                        double dx,
+/* `real` is float or double, and `index_t` (the type of flat indices
+   into 3-d arrays) int or long, as defined when the kernels are built
+   (see kernels.py) */
+__kernel void computeRHS(__global real *f_d,
+                        __global real *left_halo_d,
+                        __global real *right_halo_d,
+                        __global real *rhs_d,
+                        real dx,
+                        int sw,
                         int mx,
                         int npx)
 {
     /*
     Computes the RHS for solving for the x-derivative
-    of a function f. f_local is the "local" part of
-    the function which includes ghost points.
+    of a function f.
 
     dx is the spacing.
 
-    nx, ny, nz define the size of d. f_local is shaped
-    [nz+2, ny+2, nx+2]
+    nx, ny, nz define the size of f (without ghost points).
+    The ghost points before the first and after the last
+    point of every line are read from left_halo and right_halo,
+    shaped [nz, ny, sw] (the receive halos of the DA,
+    sw being the stencil width).
 
     mx and npx together decide if we are evaluating
     at a boundary.
@@ -24,31 +32,231 @@ __kernel void computeRHS(__global double *f_local_d,
     int nx = get_global_size(0);
     int ny = get_global_size(1);
     int nz = get_global_size(2);
+    real f_left, f_right;
 
+    index_t i = ((index_t)iz*ny + iy)*nx + ix;
+    index_t ih = ((index_t)iz*ny + iy)*sw;
 
-    int i = iz*(nx*ny) + iy*nx + ix;
-    int iloc = (iz+1)*((nx+2)*(ny+2)) + (iy+1)*(nx+2) + (ix+1);
+    f_left = (ix == 0) ? left_halo_d[ih + sw-1] : f_d[i-1];
+    f_right = (ix == nx-1) ? right_halo_d[ih] : f_d[i+1];
+    rhs_d[i] = (3.0f/(4*dx))*(f_right - f_left);
 
-    rhs_d[i] = (3./(4*dx))*(f_local_d[iloc+1] - f_local_d[iloc-1]);
+    if (mx == 0) {
+        if (ix == 0) {
+            rhs_d[i] = (1.0f/(2*dx))*(-5*f_d[i] + 4*f_d[i+1] + f_d[i+2]);
+        }
+    }
+
+    if (mx == npx-1) {
+        if (ix == nx-1) {
+            rhs_d[i] = -(1.0f/(2*dx))*(-5*f_d[i] + 4*f_d[i-1] + f_d[i-2]);
+        }
+    }
+}
+
+__kernel void computeRHSInterior(__global real *f_d,
+                        __global real *rhs_d,
+                        real dx,
+                        int nx)
+{
+    /*
+    computeRHS at the points that need no ghost points:
+    all but the first and the last of every line,
+    so that it can run while the ghost points are exchanged.
+    Launched on [nz, ny, nx-2] points.
+    */
+
+    int ix = get_global_id(0) + 1;
+    int iy = get_global_id(1);
+    int iz = get_global_id(2);
+    int ny = get_global_size(1);
+
+    index_t i = ((index_t)iz*ny + iy)*nx + ix;
+
+    rhs_d[i] = (3.0f/(4*dx))*(f_d[i+1] - f_d[i-1]);
+}
+
+__kernel void computeRHSBoundary(__global real *f_d,
+                        __global real *left_halo_d,
+                        __global real *right_halo_d,
+                        __global real *rhs_d,
+                        real dx,
+                        int nx,
+                        int sw,
+                        int mx,
+                        int npx)
+{
+    /*
+    computeRHS at the first and the last point of
+    every line, once the ghost points have arrived
+    (see computeRHSInterior).
+    Launched on [nz, ny, 2] points.
+    */
+
+    int ix = get_global_id(0)*(nx-1);
+    int iy = get_global_id(1);
+    int iz = get_global_id(2);
+    int ny = get_global_size(1);
+    real f_left, f_right;
+
+    index_t i = ((index_t)iz*ny + iy)*nx + ix;
+    index_t ih = ((index_t)iz*ny + iy)*sw;
+
+    f_left = (ix == 0) ? left_halo_d[ih + sw-1] : f_d[i-1];
+    f_right = (ix == nx-1) ? right_halo_d[ih] : f_d[i+1];
+    rhs_d[i] = (3.0f/(4*dx))*(f_right - f_left);
 
     if (mx == 0) {
         if (ix == 0) {
-            rhs_d[i] = (1./(2*dx))*(-5*f_local_d[iloc] + 4*f_local_d[iloc+1] + f_local_d[iloc+2]);
+            rhs_d[i] = (1.0f/(2*dx))*(-5*f_d[i] + 4*f_d[i+1] + f_d[i+2]);
         }
     }
 
     if (mx == npx-1) {
         if (ix == nx-1) {
-            rhs_d[i] = -(1./(2*dx))*(-5*f_local_d[iloc] + 4*f_local_d[iloc-1] + f_local_d[iloc-2]);
+            rhs_d[i] = -(1.0f/(2*dx))*(-5*f_d[i] + 4*f_d[i-1] + f_d[i-2]);
         }
     }
 }
 
-__kernel void sumSolutions(__global double* x_R_d,
-                            __global double* x_UH_d,
-                            __global double* x_LH_d,
-                            __global double* alpha,
-                            __global double* beta,
+real rhsAt(__global real *f_d,
+            __global real *left_halo_d,
+            __global real *right_halo_d,
+            index_t i0,
+            index_t ih,
+            int ix,
+            int nx,
+            int sw,
+            int mx,
+            int npx,
+            real dx)
+{
+    /*
+    The RHS (as computed by computeRHS) at point ix
+    of the line starting at f_d[i0], whose ghost points
+    start at left_halo_d[ih] and right_halo_d[ih]
+    */
+    index_t i = i0 + ix;
+    real f_left, f_right;
+
+    if (mx == 0 && ix == 0) {
+        return (1.0f/(2*dx))*(-5*f_d[i] + 4*f_d[i+1] + f_d[i+2]);
+    }
+    if (mx == npx-1 && ix == nx-1) {
+        return -(1.0f/(2*dx))*(-5*f_d[i] + 4*f_d[i-1] + f_d[i-2]);
+    }
+    f_left = (ix == 0) ? left_halo_d[ih + sw-1] : f_d[i-1];
+    f_right = (ix == nx-1) ? right_halo_d[ih] : f_d[i+1];
+    return (3.0f/(4*dx))*(f_right - f_left);
+}
+
+__kernel void computeRHSForwardReduction(__global real *f_d,
+                               __global real *left_halo_d,
+                               __global real *right_halo_d,
+                               __global real *d_d,
+                               __global real *k1_d,
+                               __global real *k2_d,
+                               __global real *k1_first_d,
+                               __global real *k1_last_d,
+                               real dx,
+                               int nx,
+                               int ny,
+                               int nz,
+                               int sw,
+                               int mx,
+                               int npx)
+{
+    /*
+    computeRHS fused with the first level (stride 2)
+    of globalForwardReduction: the RHS is computed from f
+    (see computeRHS) and reduced without being read back.
+    Every thread writes the RHS at the even point 2*gix,
+    and the reduced value at the odd point 2*gix+1.
+    Requires nx >= 4, and is launched on [nz, ny, nx/2] points.
+    */
+    int gix = get_global_id(0);
+    int giy = get_global_id(1);
+    int giz = get_global_id(2);
+    int i = 2*gix + 1;
+    index_t gi3d0, ih;
+    real r_prev, r, r_next;
+
+    gi3d0 = ((index_t)giz*ny + giy)*nx + 0;
+    ih = ((index_t)giz*ny + giy)*sw;
+
+    r_prev = rhsAt(f_d, left_halo_d, right_halo_d, gi3d0, ih, i-1, nx, sw, mx, npx, dx);
+    r = rhsAt(f_d, left_halo_d, right_halo_d, gi3d0, ih, i, nx, sw, mx, npx, dx);
+    d_d[gi3d0 + i-1] = r_prev;
+
+    if (gix == 0)
+    {
+        r_next = rhsAt(f_d, left_halo_d, right_halo_d, gi3d0, ih, i+1, nx, sw, mx, npx, dx);
+        d_d[gi3d0 + i] = r - r_prev*k1_first_d[0] - r_next*k2_d[0];
+    }
+    else if (i == (nx-1))
+    {
+        d_d[gi3d0 + i] = r - r_prev*k1_last_d[0];
+    }
+    else
+    {
+        r_next = rhsAt(f_d, left_halo_d, right_halo_d, gi3d0, ih, i+1, nx, sw, mx, npx, dx);
+        d_d[gi3d0 + i] = r - r_prev*k1_d[0] - r_next*k2_d[0];
+    }
+}
+
+__kernel void globalBackSubstitutionFaces(__global real *d_d,
+                                   __global real *x_faces_d,
+                                   real b1,
+                                   real c1,
+                                   real ai,
+                                   real bi,
+                                   real ci,
+                                   int nx,
+                                   int ny,
+                                   int nz,
+                                   int mx,
+                                   int npx)
+{
+    /*
+    The last level (stride 2) of globalBackSubstitution,
+    fused with negateAndCopyFaces: the thread solving for
+    the first point of a line also writes the first face,
+    and the thread of the last pair the last face
+    (the last point being solved by then).
+    Launched on [nz, ny, nx/2] points.
+    */
+    int gix = get_global_id(0);
+    int giy = get_global_id(1);
+    int giz = get_global_id(2);
+    int i = 2*gix;
+    int i_faces;
+    index_t gi3d, gi3d0;
+
+    gi3d0 = ((index_t)giz*ny + giy)*nx + 0;
+    gi3d = gi3d0 + i;
+    i_faces = giz*(2*ny) + giy*2;
+
+    if (i == 0)
+    {
+        d_d[gi3d] = (d_d[gi3d] - c1*d_d[gi3d+1])/b1;
+        x_faces_d[i_faces] = (mx == 0) ? 0 : -d_d[gi3d];
+    }
+    else
+    {
+        d_d[gi3d] = (d_d[gi3d] - (ai)*d_d[gi3d-1] - (ci)*d_d[gi3d+1])/bi;
+    }
+
+    if (i == nx-2)
+    {
+        x_faces_d[i_faces + 1] = (mx == npx-1) ? 0 : -d_d[gi3d0 + nx-1];
+    }
+}
+
+__kernel void sumSolutions(__global real* x_R_d,
+                            __global real* x_UH_d,
+                            __global real* x_LH_d,
+                            __global real* alpha,
+                            __global real* beta,
                             int nx,
                             int ny,
                             int nz)
@@ -63,16 +271,17 @@ __kernel void sumSolutions(__global double* x_R_d,
     int ix = get_global_id(0);
     int iy = get_global_id(1);
     int iz = get_global_id(2);
-    int i3d, i2d;
+    int i2d;
+    index_t i3d;
 
     i2d = iz*ny + iy;
-    i3d = iz*(ny*nx) + iy*nx + ix;
+    i3d = ((index_t)iz*ny + iy)*nx + ix;
 
     x_R_d[i3d] = x_R_d[i3d] + alpha[i2d]*x_UH_d[ix] + beta[i2d]*x_LH_d[ix];
 }
 
-__kernel void negateAndCopyFaces(__global double* x,
-            __global double* x_faces,
+__kernel void negateAndCopyFaces(__global real* x,
+            __global real* x_faces,
             int nx,
             int ny,
             int nz,
@@ -87,32 +296,32 @@ __kernel void negateAndCopyFaces(__global double* x,
     int iy = get_global_id(1);
     int iz = get_global_id(2);
 
-    int i_source;
+    index_t i_source;
     int i_dest;
     
-    i_source = iz*(nx*ny) + iy*nx + 0;
+    i_source = ((index_t)iz*ny + iy)*nx + 0;
     i_dest = iz*(2*ny) + iy*2 + 0;
     
     x_faces[i_dest] = -x[i_source];
 
     if (mx == 0) {
-        x_faces[i_dest] = 0.0;        
+        x_faces[i_dest] = 0;        
     }
 
-    i_source = iz*(nx*ny) + iy*nx + nx-1;
+    i_source = ((index_t)iz*ny + iy)*nx + nx-1;
     i_dest = iz*(2*ny) + iy*2 + 1;
     
     x_faces[i_dest] = -x[i_source];
 
     if (mx == npx-1) {
-        x_faces[i_dest] = 0.0;        
+        x_faces[i_dest] = 0;        
     }
 }
-__kernel void pThomasKernel(__global double *a_d,
-                                __global double *b_d,
-                                __global double *c_d,
-                                __global double *c2_d,
-                                __global double *d_d,
+__kernel void pThomasKernel(__global real *a_d,
+                                __global real *b_d,
+                                __global real *c_d,
+                                __global real *c2_d,
+                                __global real *d_d,
                                 int block_size)
 {
     /*
@@ -121,8 +330,8 @@ __kernel void pThomasKernel(__global double *a_d,
     */
 
     int gid = get_global_id(0);
-    int block_start = gid*block_size;
-    double bmac;
+    index_t block_start = (index_t)gid*block_size;
+    real bmac;
 
     /* do a serial TDMA on the local system */
 
@@ -143,15 +352,15 @@ __kernel void pThomasKernel(__global double *a_d,
 }
 
 
-__kernel void globalForwardReduction(__global double *a_d,
-                               __global double *b_d,
-                               __global double *c_d,
-                               __global double *d_d,
-                               __global double *k1_d,
-                               __global double *k2_d,
-                               __global double *b_first_d,
-                               __global double *k1_first_d,
-                               __global double *k1_last_d,
+__kernel void globalForwardReduction(__global real *a_d,
+                               __global real *b_d,
+                               __global real *c_d,
+                               __global real *d_d,
+                               __global real *k1_d,
+                               __global real *k2_d,
+                               __global real *b_first_d,
+                               __global real *k1_first_d,
+                               __global real *k1_last_d,
                                int nx,
                                int ny,
                                int nz,
@@ -163,11 +372,11 @@ __kernel void globalForwardReduction(__global double *a_d,
     int i;
     int m, n;
     int idx;
-    int gi3d, gi3d0;
-    double x_m, x_n;
+    index_t gi3d, gi3d0;
+    real x_m, x_n;
 
-    gi3d = giz*(nx*ny) + giy*nx + gix;
-    gi3d0 = giz*(nx*ny) + giy*nx + 0;
+    gi3d = ((index_t)giz*ny + giy)*nx + gix;
+    gi3d0 = ((index_t)giz*ny + giy)*nx + 0;
 
     // forward reduction
     if (stride == nx)
@@ -208,16 +417,16 @@ __kernel void globalForwardReduction(__global double *a_d,
     }
 }
 
-__kernel void globalBackSubstitution(__global double *a_d,
-                                   __global double *b_d,
-                                   __global double *c_d,
-                                   __global double *d_d,
-                                   __global double *b_first_d,
-                                   double b1,
-                                   double c1,
-                                   double ai,
-                                   double bi,
-                                   double ci,
+__kernel void globalBackSubstitution(__global real *a_d,
+                                   __global real *b_d,
+                                   __global real *c_d,
+                                   __global real *d_d,
+                                   __global real *b_first_d,
+                                   real b1,
+                                   real c1,
+                                   real ai,
+                                   real bi,
+                                   real ci,
                                    int nx,
                                    int ny,
                                    int nz,
@@ -228,9 +437,9 @@ __kernel void globalBackSubstitution(__global double *a_d,
     int giz = get_global_id(2);
     int i;
     int idx;
-    int gi3d, gi3d0;
+    index_t gi3d, gi3d0;
 
-    gi3d0 = giz*(nx*ny) + giy*nx + 0;
+    gi3d0 = ((index_t)giz*ny + giy)*nx + 0;
 
     i = (stride/2-1) + gix*stride;
     gi3d = gi3d0 + i;
@@ -2,14 +2,58 @@ import numpy as np
 import pyopencl as cl
 import os
 
-def get_funcs(ctx, filename, *args):
+def c_type(dtype):
+    '''
+    The C type ("float" or "double")
+    for the numpy dtype `dtype`
+    '''
+    dtype = np.dtype(dtype)
+    if dtype == np.float32:
+        return 'float'
+    elif dtype == np.float64:
+        return 'double'
+    raise ValueError('Unsupported dtype: {0}'.format(dtype))
+
+def index_type(index_dtype):
+    '''
+    The C type ("int" or "long")
+    for the numpy integer dtype `index_dtype`
+    '''
+    index_dtype = np.dtype(index_dtype)
+    if index_dtype == np.int32:
+        return 'int'
+    elif index_dtype == np.int64:
+        return 'long'
+    raise ValueError('Unsupported index dtype: {0}'.format(index_dtype))
+
+def index_dtype(size):
+    '''
+    The integer dtype for flat indices into arrays
+    of `size` elements: numpy.int32 if they fit
+    (which is faster), numpy.int64 otherwise.
+    '''
+    if size <= np.iinfo(np.int32).max:
+        return np.int32
+    return np.int64
+
+def get_funcs(ctx, filename, *args, **kwargs):
     '''
     Build the code in 'src' and get the
-    kernels in args therein
+    kernels in args therein.
+    The floating-point type `real` in the kernels
+    is float or double according to the keyword
+    argument `dtype` (default: numpy.float64),
+    and the type `index_t` of flat indices into
+    3-d arrays is int or long according to
+    `index_dtype` (default: numpy.int32).
     '''
+    dtype = kwargs.get('dtype', np.float64)
+    index_dtype = kwargs.get('index_dtype', np.int32)
     src_dir = os.path.dirname(__file__)
     with open(src_dir + '/' + filename) as f:
         src = f.read()
+    src = '#define real {0}\n#define index_t {1}\n'.format(
+            c_type(dtype), index_type(index_dtype)) + src
     platform = ctx.devices[0].platform
     if 'NVIDIA' in platform.name:
         src = '#pragma OPENCL EXTENSION cl_khr_fp64: enable\n' + src
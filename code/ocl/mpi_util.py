@@ -1,9 +1,16 @@
 import numpy as np
 from mpi4py import MPI
 
+# Files written by DA.write start with this header,
+# followed by the global array in C order:
+FILE_MAGIC = 'DAFIELD1'
+FILE_HEADER = np.dtype([('magic', 'S8'), ('dtype', 'S8'),
+    ('shape', '<i8', (3,)), ('proc_sizes', '<i8', (3,))])
+
 class DA:
 
-    def __init__(self, comm, local_dims, proc_sizes, stencil_width):
+    def __init__(self, comm, local_dims, proc_sizes, stencil_width, dtype=np.float64,
+            reorder=False, shared_memory=False):
         """
         DA: a class for handling structured grid information
 
@@ -19,28 +26,55 @@ class DA:
         :param stencil_width: The width of boundary information
                 that may be exchanged between processes
         :type stencil_width: int
+        :param dtype: The floating-point type (numpy.float64 or
+                numpy.float32) of the vectors and halos
+        :type dtype: numpy.dtype
+        :param reorder: Allow MPI to reorder the ranks of the
+                processes in the grid (for example, to place
+                neighbours on the same node). See also `create_DA`.
+        :type reorder: bool
+        :param shared_memory: Exchange halos with neighbours on the
+                same node through shared memory, instead of MPI
+                messages (see `_create_shared_halos`)
+        :type shared_memory: bool
         """
-        comm = comm.Create_cart(proc_sizes)
+        comm = comm.Create_cart(proc_sizes, reorder=reorder)
         self.comm = comm
         self.local_dims = local_dims
         self.proc_sizes = proc_sizes
         self.stencil_width = stencil_width
+        self.dtype = np.dtype(dtype)
+        self.mpi_type = mpi_type(self.dtype)
         self.rank = comm.Get_rank()
         self.size = comm.Get_size()
 
         self.nz, self.ny, self.nx = local_dims
         self.npz, self.npy, self.npx = proc_sizes
         self.mz, self.my, self.mx = self.comm.Get_topo()[2]
+        self.shared_memory = shared_memory
 
         assert(self.size == reduce(lambda a,b: a*b, proc_sizes))
         self._create_halo_arrays()
+        if shared_memory:
+            self._create_shared_halos()
     
+    def destroy(self):
+        """
+        Free the shared window of the halos and its communicator
+        (with `shared_memory`). This is collective over the
+        processes of the node, and the DA cannot exchange
+        halos afterwards.
+        """
+        if self.shared_memory:
+            self.halo_win.Free()
+            self.node_comm.Free()
+
     def create_global_vector(self):
         """
         Returns:
             out (numpy.ndarray): an array sized (nz, ny, nx)
         """
-        return np.zeros([self.nz, self.ny, self.nx], dtype=np.float64)
+        return np.zeros([self.nz, self.ny, self.nx], dtype=self.dtype)
 
     def create_local_vector(self):
         """
@@ -49,7 +83,7 @@ class DA:
         """
         return np.zeros([self.nz+2*self.stencil_width,
             self.ny+2*self.stencil_width,
-            self.nx+2*self.stencil_width], dtype=np.float64)
+            self.nx+2*self.stencil_width], dtype=self.dtype)
 
     def global_to_local(self, global_array, local_array):
         """
@@ -59,13 +93,42 @@ class DA:
         # Update the local array (which includes ghost points)
         # from the global array (which does not)
 
+        requests = self.global_to_local_begin(global_array, local_array)
+        self.global_to_local_end(local_array, requests)
+
+    def update_halos(self, global_array):
+        """
+        Exchange the halos of the global portion of an array
+        only: on return, the receive halos (e.g. `left_recv_halo`)
+        hold the neighbours' faces, and no local array is filled.
+        """
+        requests = self.global_to_local_begin(global_array, None)
+        self.global_to_local_end(None, requests)
+
+    def global_to_local_begin(self, global_array, local_array):
+        """
+        Start `global_to_local`: copy the inner elements
+        and post the swaps of the halos, without waiting for them.
+        Returns the requests to pass to `global_to_local_end`,
+        which completes the transfer. Only one transfer
+        may be in progress at a time on a DA.
+        With `shared_memory`, the faces of neighbours on the
+        same node are copied here, and only the swaps with
+        the others are left to `global_to_local_end`.
+        If `local_array` is None, only the halos are exchanged
+        (see `update_halos`).
+        """
+        if self.shared_memory:
+            return self._shared_global_to_local_begin(global_array, local_array)
+
         npz, npy, npx = self.npz, self.npy, self.npx
         nz, ny, nx = self.nz, self.ny, self.nx
         mz, my, mx = self.mz, self.my, self.mx
         sw = self.stencil_width
 
         # copy inner elements:
-        self._copy_global_to_local(global_array, local_array)
+        if local_array is not None:
+            self._copy_global_to_local(global_array, local_array)
 
         # copy from arrays to send halos:
         self._copy_array_to_halo(global_array, self.left_send_halo, [nz, ny, sw], [0, 0, 0])
@@ -78,34 +141,53 @@ class DA:
         self._copy_array_to_halo(global_array, self.back_send_halo, [sw, ny, nx], [nz-1, 0, 0])
 
         # perform swaps in x-direction
-        sendbuf = [self.right_send_halo, MPI.DOUBLE]
-        recvbuf = [self.left_recv_halo, MPI.DOUBLE]
+        sendbuf = [self.right_send_halo, self.mpi_type]
+        recvbuf = [self.left_recv_halo, self.mpi_type]
         req1 = self._forward_swap(sendbuf, recvbuf, self.rank-1, self.rank+1, mx, npx, 10)
 
-        sendbuf = [self.left_send_halo, MPI.DOUBLE]
-        recvbuf = [self.right_recv_halo, MPI.DOUBLE]
+        sendbuf = [self.left_send_halo, self.mpi_type]
+        recvbuf = [self.right_recv_halo, self.mpi_type]
         req2 = self._backward_swap(sendbuf, recvbuf, self.rank+1, self.rank-1, mx, npx, 20)
 
         # perform swaps in y-direction:
-        sendbuf = [self.top_send_halo, MPI.DOUBLE]
-        recvbuf = [self.bottom_recv_halo, MPI.DOUBLE]
+        sendbuf = [self.top_send_halo, self.mpi_type]
+        recvbuf = [self.bottom_recv_halo, self.mpi_type]
         req3 = self._forward_swap(sendbuf, recvbuf, self.rank-npx, self.rank+npx, my, npy, 30)
 
-        sendbuf = [self.bottom_send_halo, MPI.DOUBLE]
-        recvbuf = [self.top_recv_halo, MPI.DOUBLE]
+        sendbuf = [self.bottom_send_halo, self.mpi_type]
+        recvbuf = [self.top_recv_halo, self.mpi_type]
         req4 = self._backward_swap(sendbuf, recvbuf, self.rank+npx, self.rank-npx, my, npy, 40)
 
         # perform swaps in z-direction:
-        sendbuf = [self.back_send_halo, MPI.DOUBLE]
-        recvbuf = [self.front_recv_halo, MPI.DOUBLE]
+        sendbuf = [self.back_send_halo, self.mpi_type]
+        recvbuf = [self.front_recv_halo, self.mpi_type]
         req5 = self._forward_swap(sendbuf, recvbuf, self.rank-npx*npy, self.rank+npx*npy, mz, npz, 50)
 
-        sendbuf = [self.front_send_halo, MPI.DOUBLE]
-        recvbuf = [self.back_recv_halo, MPI.DOUBLE]
+        sendbuf = [self.front_send_halo, self.mpi_type]
+        recvbuf = [self.back_recv_halo, self.mpi_type]
         req6 = self._backward_swap(sendbuf, recvbuf, self.rank+npx*npy, self.rank-npx*npy, mz, npz, 60)
 
-        requests = [req for req in  [req1, req2, req3, req4, req5, req6] if req != None]
+        return req1 + req2 + req3 + req4 + req5 + req6
+
+    def global_to_local_end(self, local_array, requests):
+        """
+        Wait for the swaps started by `global_to_local_begin`,
+        and copy the received halos to the local array.
+        """
+        nz, ny, nx = self.nz, self.ny, self.nx
+        sw = self.stencil_width
+
         MPI.Request.Waitall(requests, [MPI.Status()]*len(requests))
+        if local_array is None:
+            return
+
+        if self.shared_memory:
+            # the faces of neighbours on other nodes:
+            for side, dims, _, recv_offsets, _, shared_halo in self.faces:
+                if shared_halo is None:
+                    self._copy_halo_to_array(getattr(self, side + '_recv_halo'), local_array,
+                            dims, recv_offsets)
+            return
 
         # copy from recv halos to local_array:
         if self.has_neighbour('left'):
@@ -164,18 +246,136 @@ class DA:
         global_group = self.comm.Get_group()
         if direction == 0:
             line_group = global_group.Incl(ranks_matrix[self.mz, self.my, :])
-            line_proc_sizes = [1, 1, self.npx]
-            line_local_dims = [self.nz, self.ny, self.nx]
         elif direction == 1:
             line_group = global_group.Incl(ranks_matrix[self.mz, :, self.mx])
-            line_proc_sizes = [1, 1, self.npy]
-            line_local_dims = [self.nz, self.nx, self.ny]
         else:
             line_group = global_group.Incl(ranks_matrix[:, self.my, self.mx])
-            line_proc_sizes = [1, 1, self.npz]
-            line_local_dims = [self.ny, self.nx, self.nz]
+        line_local_dims, line_proc_sizes = self.get_line_dims(direction)
         line_comm = self.comm.Create(line_group)
-        return self.__class__(line_comm, line_local_dims, line_proc_sizes, self.stencil_width)
+        return self.__class__(line_comm, line_local_dims, line_proc_sizes, self.stencil_width,
+                self.dtype, shared_memory=self.shared_memory)
+
+    def get_line_dims(self, direction):
+        """
+        The local_dims and proc_sizes of the DA returned by
+        `get_line_DA`, without creating it (which is collective,
+        and with `shared_memory`, allocates a window).
+        """
+        if direction == 0:
+            return [self.nz, self.ny, self.nx], [1, 1, self.npx]
+        elif direction == 1:
+            return [self.nz, self.nx, self.ny], [1, 1, self.npy]
+        return [self.ny, self.nx, self.nz], [1, 1, self.npz]
+
+    def get_slab_DA(self, slab_nz):
+        """
+        Return a DA over the same processes, for a slab
+        of `slab_nz` consecutive z-planes of the local portion.
+        Slabs at the same z-offset on every process
+        can be exchanged and solved independently of the others.
+
+        :parameter slab_nz: Number of z-planes in the slab,
+                which must divide nz.
+        :type slab_nz: int
+        """
+        assert(self.nz % slab_nz == 0)
+        return self.__class__(self.comm, [slab_nz, self.ny, self.nx], self.proc_sizes,
+                self.stencil_width, self.dtype, shared_memory=self.shared_memory)
+
+    def write(self, filename, x):
+        """
+        Write the global vector `x` of every process
+        to its block of the shared file `filename`, using
+        collective MPI-IO (every process must call this).
+
+        The file holds a header (see FILE_HEADER) with the
+        global shape, dtype and process grid, followed by the
+        global array in C order, so that it can be read back
+        by `read` under any process grid of the same global shape.
+
+        :param x: An array sized (nz, ny, nx)
+        :type x: numpy.ndarray
+        """
+        x = np.ascontiguousarray(x, dtype=self.dtype)
+        assert(x.shape == (self.nz, self.ny, self.nx))
+        fh = MPI.File.Open(self.comm, filename, MPI.MODE_WRONLY | MPI.MODE_CREATE)
+        try:
+            fh.Set_size(0)
+            if self.rank == 0:
+                header = np.zeros(1, dtype=FILE_HEADER)
+                header['magic'] = FILE_MAGIC
+                header['dtype'] = self.dtype.str
+                header['shape'] = self.get_global_dims()
+                header['proc_sizes'] = self.proc_sizes
+                fh.Write_at(0, [header.view(np.uint8), MPI.BYTE])
+            filetype = self._create_block_subarray(self.mpi_type)
+            fh.Set_view(FILE_HEADER.itemsize, self.mpi_type, filetype)
+            fh.Write_all([x, self.mpi_type])
+            filetype.Free()
+        finally:
+            fh.Close()
+
+    def read(self, filename, x=None):
+        """
+        Read the block of every process from the file `filename`
+        written by `write`, using collective MPI-IO (every process
+        must call this). The file may have been written
+        under a different process grid.
+
+        :param x: (optional) An array sized (nz, ny, nx) to read into
+        :type x: numpy.ndarray
+
+        Returns:
+            out: `x`, or a new global vector if `x` is None
+        """
+        fh = MPI.File.Open(self.comm, filename, MPI.MODE_RDONLY)
+        try:
+            header = np.zeros(1, dtype=FILE_HEADER)
+            if self.rank == 0:
+                fh.Read_at(0, [header.view(np.uint8), MPI.BYTE])
+            self.comm.Bcast([header.view(np.uint8), MPI.BYTE], root=0)
+            if header['magic'][0] != FILE_MAGIC:
+                raise ValueError('{0} was not written by DA.write'.format(filename))
+            shape = tuple(header['shape'][0])
+            if shape != self.get_global_dims():
+                raise ValueError('{0} holds an array of shape {1}, expected {2}'.format(
+                    filename, shape, self.get_global_dims()))
+            file_dtype = np.dtype(header['dtype'][0])
+            file_mpi_type = mpi_type(file_dtype)
+            if x is not None and x.dtype == file_dtype and x.flags['C_CONTIGUOUS']:
+                buf = x
+            else:
+                buf = np.empty([self.nz, self.ny, self.nx], dtype=file_dtype)
+            filetype = self._create_block_subarray(file_mpi_type)
+            fh.Set_view(FILE_HEADER.itemsize, file_mpi_type, filetype)
+            fh.Read_all([buf, file_mpi_type])
+            filetype.Free()
+        finally:
+            fh.Close()
+        if x is None:
+            x = buf.astype(self.dtype, copy=False)
+        elif x is not buf:
+            x[...] = buf
+        return x
+
+    def get_global_dims(self):
+        """
+        Returns:
+            out (tuple): dimensions (NZ, NY, NX) of the global problem
+        """
+        return (self.npz*self.nz, self.npy*self.ny, self.npx*self.nx)
+
+    def _create_block_subarray(self, datatype):
+        """
+        Create (and commit) the subarray type selecting
+        the block of this process in the global array.
+        """
+        NZ, NY, NX = self.get_global_dims()
+        subarray = datatype.Create_subarray([NZ, NY, NX],
+                [self.nz, self.ny, self.nx],
+                    [self.mz*self.nz, self.my*self.ny, self.mx*self.nx])
+        subarray.Commit()
+        return subarray
 
     def _forward_swap(self, sendbuf, recvbuf, src, dest, loc, dimprocs, tag):
         """
@@ -189,36 +389,40 @@ class DA:
             loc (int): Sending position in direction (0 to npx/npy/npz-1)
             dimprocs (int): Number of processes in direction (npx/npy/npz)
             tag (int): 
+
+        Returns:
+            list: the requests of the send and the receive posted,
+                both to be waited for (the next swap overwrites sendbuf)
         """
         # Perform swap in the +x, +y or +z direction
-        req = None
+        requests = []
         if loc > 0 and loc < dimprocs-1:
-            self.comm.Isend(sendbuf, dest=dest, tag=tag)
-            req = self.comm.Irecv(recvbuf, source=src, tag=tag)
+            requests.append(self.comm.Isend(sendbuf, dest=dest, tag=tag))
+            requests.append(self.comm.Irecv(recvbuf, source=src, tag=tag))
 
         elif loc == 0 and dimprocs > 1:
-            self.comm.Isend(sendbuf, dest=dest, tag=tag)
+            requests.append(self.comm.Isend(sendbuf, dest=dest, tag=tag))
 
         elif loc == dimprocs-1 and dimprocs > 1:
-            req = self.comm.Irecv(recvbuf, source=src, tag=tag)
+            requests.append(self.comm.Irecv(recvbuf, source=src, tag=tag))
 
-        return req
+        return requests
 
     def _backward_swap(self, sendbuf, recvbuf, src, dest, loc, dimprocs, tag):
 
         # Perform swap in the -x, -y or -z direction
-        req = None
+        requests = []
         if loc > 0 and loc < dimprocs-1:
-            self.comm.Isend(sendbuf, dest=dest, tag=tag)
-            req = self.comm.Irecv(recvbuf, source=src, tag=tag)
+            requests.append(self.comm.Isend(sendbuf, dest=dest, tag=tag))
+            requests.append(self.comm.Irecv(recvbuf, source=src, tag=tag))
 
         elif loc == 0 and dimprocs > 1:
-            req = self.comm.Irecv(recvbuf, source=src, tag=tag)
+            requests.append(self.comm.Irecv(recvbuf, source=src, tag=tag))
 
         elif loc == dimprocs-1 and dimprocs > 1:
-            self.comm.Isend(sendbuf, dest=dest, tag=tag)
+            requests.append(self.comm.Isend(sendbuf, dest=dest, tag=tag))
 
-        return req
+        return requests
 
     def _create_halo_arrays(self):
 
@@ -231,21 +435,119 @@ class DA:
         # the halo values to send, and the other holding
         # the halo values to receive.
 
-        self.left_recv_halo = np.empty([nz,ny,sw], dtype=np.float64)
+        self.left_recv_halo = np.empty([nz,ny,sw], dtype=self.dtype)
         self.left_send_halo = self.left_recv_halo.copy()
         self.right_recv_halo = self.left_recv_halo.copy()
         self.right_send_halo = self.left_recv_halo.copy()
 
-        self.bottom_recv_halo = np.empty([nz,sw,nx], dtype=np.float64)
+        self.bottom_recv_halo = np.empty([nz,sw,nx], dtype=self.dtype)
         self.bottom_send_halo = self.bottom_recv_halo.copy()
         self.top_recv_halo = self.bottom_recv_halo.copy()
         self.top_send_halo = self.bottom_recv_halo.copy()
 
-        self.back_recv_halo = np.empty([sw,ny,nx], dtype=np.float64)
+        self.back_recv_halo = np.empty([sw,ny,nx], dtype=self.dtype)
         self.back_send_halo = self.back_recv_halo.copy()
         self.front_recv_halo = self.back_recv_halo.copy()
         self.front_send_halo = self.back_recv_halo.copy()
 
+    def _create_shared_halos(self):
+        """
+        Put the send halos of the processes on every node
+        (sharing memory) in a shared window, so that neighbours
+        on the same node read them directly.
+
+        Sets `self.faces`, with, for every side that has a neighbour:
+        (side, halo dims, offsets of the send halo in the
+        global array, offsets of the ghost points in the local
+        array, neighbour's rank, neighbour's send halo for this side
+        (in the window) or None if the neighbour is on another node).
+        """
+        nz, ny, nx = self.nz, self.ny, self.nx
+        npz, npy, npx = self.npz, self.npy, self.npx
+        sw = self.stencil_width
+        faces = [
+            ('left', [nz, ny, sw], [0, 0, 0], [sw, sw, 0], self.rank-1, 'right'),
+            ('right', [nz, ny, sw], [0, 0, nx-sw], [sw, sw, sw+nx], self.rank+1, 'left'),
+            ('bottom', [nz, sw, nx], [0, 0, 0], [sw, 0, sw], self.rank-npx, 'top'),
+            ('top', [nz, sw, nx], [0, ny-sw, 0], [sw, sw+ny, sw], self.rank+npx, 'bottom'),
+            ('front', [sw, ny, nx], [0, 0, 0], [0, sw, sw], self.rank-npx*npy, 'back'),
+            ('back', [sw, ny, nx], [nz-sw, 0, 0], [sw+nz, sw, sw], self.rank+npx*npy, 'front')]
+
+        # the send halos of every process, one after the other:
+        self.node_comm = self._split_node_comm()
+        offsets = {}
+        size = 0
+        for side, dims, _, _, _, _ in faces:
+            offsets[side] = size
+            size += int(np.prod(dims))
+        itemsize = self.dtype.itemsize
+        self.halo_win = MPI.Win.Allocate_shared(size*itemsize, itemsize, comm=self.node_comm)
+
+        def halo(node_rank, side, dims):
+            buf, _ = self.halo_win.Shared_query(node_rank)
+            window = np.frombuffer(buf, dtype=self.dtype, count=size)
+            return window[offsets[side]:offsets[side]+int(np.prod(dims))].reshape(dims)
+
+        node_ranks = MPI.Group.Translate_ranks(self.comm.Get_group(),
+                [face[4] % self.size for face in faces], self.node_comm.Get_group())
+        self.faces = []
+        for (side, dims, send_offsets, recv_offsets, neighbour, opposite), node_rank in zip(
+                faces, node_ranks):
+            setattr(self, side + '_send_halo', halo(self.node_comm.Get_rank(), side, dims))
+            if not self.has_neighbour(side):
+                continue
+            if node_rank == MPI.UNDEFINED:
+                shared_halo = None
+            else:
+                shared_halo = halo(node_rank, opposite, dims)
+            self.faces.append((side, dims, send_offsets, recv_offsets, neighbour, shared_halo))
+
+    def _split_node_comm(self):
+        """
+        The communicator of the processes of `comm`
+        on this node (sharing memory)
+        """
+        return self.comm.Split_type(MPI.COMM_TYPE_SHARED)
+
+    def _shared_global_to_local_begin(self, global_array, local_array):
+        """
+        `global_to_local_begin`, reading the faces of neighbours
+        on the same node from the shared window, and posting
+        the swaps only with the others, whose requests are returned.
+        If `local_array` is None, the faces are copied
+        to the receive halos instead.
+        """
+        # tags by the direction in which a face travels:
+        tags = {'left': 10, 'right': 20, 'bottom': 30, 'top': 40, 'front': 50, 'back': 60}
+        opposite = {'left': 'right', 'right': 'left', 'bottom': 'top',
+                'top': 'bottom', 'front': 'back', 'back': 'front'}
+
+        if local_array is not None:
+            self._copy_global_to_local(global_array, local_array)
+
+        # neighbours have read the faces of the last exchange:
+        self.halo_win.Fence()
+        for side, dims, send_offsets, _, _, _ in self.faces:
+            self._copy_array_to_halo(global_array, getattr(self, side + '_send_halo'),
+                    dims, send_offsets)
+        # ... and can read the new ones:
+        self.halo_win.Fence()
+
+        requests = []
+        for side, dims, _, recv_offsets, neighbour, shared_halo in self.faces:
+            if shared_halo is not None and local_array is None:
+                getattr(self, side + '_recv_halo')[...] = shared_halo
+            elif shared_halo is not None:
+                self._copy_halo_to_array(shared_halo, local_array, dims, recv_offsets)
+            else:
+                requests.append(self.comm.Isend(
+                    [getattr(self, side + '_send_halo'), self.mpi_type],
+                        dest=neighbour, tag=tags[side]))
+                requests.append(self.comm.Irecv(
+                    [getattr(self, side + '_recv_halo'), self.mpi_type],
+                        source=neighbour, tag=tags[opposite[side]]))
+        return requests
+
     def _copy_array_to_halo(self, array, halo, copy_dims, copy_offsets, dtype=np.float64):
         """
         Copy from 3-d array to 2-d halo
@@ -319,6 +621,270 @@ class DA:
             return False
     
 
+def mpi_type(dtype):
+    '''
+    The MPI datatype for the numpy dtype `dtype`
+    '''
+    dtype = np.dtype(dtype)
+    if dtype == np.float32:
+        return MPI.FLOAT
+    elif dtype == np.float64:
+        return MPI.DOUBLE
+    raise ValueError('Unsupported dtype: {0}'.format(dtype))
+
+# the shortest local line length planned for a derivative direction
+# (the near-Toeplitz solvers also need a power of 2):
+MIN_LINE_LENGTH = 4
+
+def plan_proc_sizes(global_dims, nprocs, directions=(0, 1, 2), stencil_width=1):
+    '''
+    Choose the process grid (npz, npy, npx) for
+    a problem of size `global_dims` (NZ, NY, NX) on `nprocs` processes.
+
+    Of all grids that divide the problem evenly, and leave
+    local lines in the derivative `directions` (0, 1, 2 for x, y, z)
+    a power of 2 long (and at least MIN_LINE_LENGTH),
+    the one with the smallest `decomposition_cost` is chosen.
+
+    Raises ValueError if there is no such grid.
+    '''
+    candidates = []
+    for npz in _divisors(nprocs):
+        for npy in _divisors(nprocs//npz):
+            npx = nprocs//(npz*npy)
+            proc_sizes = (npz, npy, npx)
+            if _is_valid_decomposition(global_dims, proc_sizes, directions):
+                candidates.append(proc_sizes)
+    if not candidates:
+        raise ValueError('Cannot decompose {0} on {1} processes'.format(
+            tuple(global_dims), nprocs))
+    return min(candidates, key=lambda proc_sizes:
+            decomposition_cost(global_dims, proc_sizes, directions, stencil_width))
+
+def decomposition_cost(global_dims, proc_sizes, directions=(0, 1, 2), stencil_width=1):
+    '''
+    The number of elements every process communicates for
+    a derivative in each of `directions` with the grid `proc_sizes`:
+    for lines split among processes, the halos exchanged with
+    its two neighbours along the lines (the derivative in one
+    direction exchanges no others), and its share of the
+    reduced systems, of 2*np unknowns per line, gathered
+    on one process per line.
+    '''
+    local_dims = [n//p for n, p in zip(global_dims, proc_sizes)]
+    cost = 0
+    for direction in directions:
+        # in (z, y, x) order:
+        axis = 2 - direction
+        if proc_sizes[axis] > 1:
+            nlines = np.prod([local_dims[a] for a in range(3) if a != axis])
+            cost += 2*stencil_width*nlines
+            cost += 2*proc_sizes[axis]*nlines
+    return cost
+
+def create_DA(comm, global_dims, stencil_width=1, dtype=np.float64,
+        directions=(0, 1, 2), node_aware=True):
+    '''
+    Create a DA for a problem of size `global_dims`
+    on all processes of `comm`, with the process grid
+    chosen by `plan_proc_sizes`.
+
+    With `node_aware`, processes sharing memory (a node)
+    are given a compact sub-grid of the process grid
+    (see `node_ordered_comm`), and halos are exchanged
+    through shared memory on a node. MPI is not allowed
+    to reorder the ranks again (in Create_cart), which
+    could undo that placement.
+    '''
+    proc_sizes = plan_proc_sizes(global_dims, comm.Get_size(), directions, stencil_width)
+    local_dims = [n//p for n, p in zip(global_dims, proc_sizes)]
+    if node_aware:
+        comm = node_ordered_comm(comm, proc_sizes, local_dims)
+    return DA(comm, local_dims, proc_sizes, stencil_width, dtype,
+            shared_memory=node_aware)
+
+def node_ordered_comm(comm, proc_sizes, local_dims):
+    '''
+    A copy of `comm`, with processes ranked so that the
+    processes of every node (sharing memory) form a block of
+    the process grid `proc_sizes` (ranked in row-major order,
+    as by Create_cart), of the smallest surface.
+    If nodes have different numbers of processes,
+    or no block shape fits, the ranks are unchanged.
+    '''
+    node_comm = comm.Split_type(MPI.COMM_TYPE_SHARED)
+    ppn = node_comm.Get_size()
+    node_rank = node_comm.Get_rank()
+    if len(set(comm.allgather(ppn))) != 1 or ppn == 1 or ppn == comm.Get_size():
+        return comm.Dup()
+    blocks = [block for block in _factorizations(ppn, 3)
+            if all(p % b == 0 for p, b in zip(proc_sizes, block))]
+    if not blocks:
+        return comm.Dup()
+    block = min(blocks, key=lambda block: _surface(
+        [b*n for b, n in zip(block, local_dims)]))
+    # number the nodes in the order of their first process:
+    is_leader = node_rank == 0
+    leaders = comm.allgather(comm.Get_rank() if is_leader else None)
+    leaders = [rank for rank in leaders if rank is not None]
+    node = node_comm.bcast(leaders.index(comm.Get_rank()) if is_leader else None)
+    node_grid = [p//b for p, b in zip(proc_sizes, block)]
+    node_coords = np.unravel_index(node, node_grid)
+    local_coords = np.unravel_index(node_rank, block)
+    coords = [n*b + l for n, b, l in zip(node_coords, block, local_coords)]
+    key = int(np.ravel_multi_index(coords, proc_sizes))
+    return comm.Split(0, key)
+
+class NodeAggregator:
+
+    def __init__(self, comm):
+        '''
+        Gather to (and scatter from) the first process of `comm`
+        in two levels: the processes of every node (sharing memory)
+        write their arrays to (and read them from) a window of the
+        first of them (the node's leader), and only the leaders
+        exchange messages with the root.
+        The root then receives one message per node,
+        instead of one per process.
+
+        :param comm: the communicator (e.g. that of a line DA)
+        :type comm: mpi4py.MPI.Comm
+        '''
+        self.comm = comm
+        self.rank = comm.Get_rank()
+        self.size = comm.Get_size()
+        self.node_comm = self._split_node_comm()
+        self.node_rank = self.node_comm.Get_rank()
+        self.is_leader = self.node_rank == 0
+        # the first process of comm leads its node,
+        # and is the first of the leaders:
+        self.leader_comm = comm.Split(0 if self.is_leader else MPI.UNDEFINED, self.rank)
+        self.node_ranks = self.node_comm.allgather(self.rank)
+        if self.is_leader:
+            self.leader_node_ranks = self.leader_comm.gather(self.node_ranks)
+        if self.rank == 0:
+            # the ranks in comm of the blocks, in the order received:
+            self.order = sum(self.leader_node_ranks, [])
+        self.win = None
+        self.win_nbytes = 0
+
+    def destroy(self):
+        '''
+        Free the window and the communicators of the aggregator.
+        This is collective over the processes of `comm`,
+        and the aggregator cannot be used afterwards.
+        '''
+        if self.win is not None:
+            self.win.Free()
+            self.win = None
+        if self.is_leader:
+            self.leader_comm.Free()
+        self.node_comm.Free()
+
+    def _split_node_comm(self):
+        '''
+        The communicator of the processes of `comm`
+        on this node (sharing memory)
+        '''
+        return self.comm.Split_type(MPI.COMM_TYPE_SHARED, key=self.rank)
+
+    def _node_blocks(self, shape, dtype):
+        '''
+        The arrays of `shape` and `dtype` of the processes of the node,
+        one after the other in the leader's window
+        (of shape (node size,) + shape), reallocated
+        (collectively over the node) if it is too small.
+        '''
+        dtype = np.dtype(dtype)
+        count = len(self.node_ranks)*int(np.prod(shape))
+        nbytes = count*dtype.itemsize
+        if nbytes > self.win_nbytes:
+            if self.win is not None:
+                self.win.Free()
+            self.win = MPI.Win.Allocate_shared(nbytes if self.is_leader else 0,
+                    1, comm=self.node_comm)
+            self.win_nbytes = nbytes
+        buf, _ = self.win.Shared_query(0)
+        return np.frombuffer(buf, dtype=dtype, count=count).reshape(
+                (len(self.node_ranks),) + tuple(shape))
+
+    def gather(self, array):
+        '''
+        Gather `array` (of the same shape and type
+        on every process) to the first process.
+
+        Returns:
+            out (numpy.ndarray): on the first process, the arrays of all
+                processes, ordered by rank (of shape (size,) + array.shape);
+                None on the others
+        '''
+        array = np.asarray(array)
+        node_arrays = self._node_blocks(array.shape, array.dtype)
+        # the leader has sent the blocks of the last exchange:
+        self.win.Fence()
+        node_arrays[self.node_rank] = array
+        # ... and can send the new ones:
+        self.win.Fence()
+        if not self.is_leader:
+            return None
+        if self.rank != 0:
+            self.leader_comm.Gatherv(node_arrays, None)
+            return None
+        received = np.empty((self.size,) + array.shape, dtype=array.dtype)
+        counts = [len(ranks)*array.size for ranks in self.leader_node_ranks]
+        self.leader_comm.Gatherv(node_arrays, [received, counts])
+        arrays = np.empty_like(received)
+        arrays[self.order] = received
+        return arrays
+
+    def scatter(self, arrays, shape, dtype):
+        '''
+        The inverse of `gather`: scatter `arrays` (on the first process,
+        of shape (size,) + shape; ignored on the others) by rank.
+
+        Returns:
+            out (numpy.ndarray): this process' array, of shape `shape`
+        '''
+        node_arrays = self._node_blocks(shape, dtype)
+        # the processes of the node have read the blocks of the last exchange:
+        self.win.Fence()
+        if self.is_leader:
+            if self.rank == 0:
+                sent = np.ascontiguousarray(arrays[self.order], dtype=dtype)
+                counts = [len(ranks)*int(np.prod(shape)) for ranks in self.leader_node_ranks]
+                self.leader_comm.Scatterv([sent, counts], node_arrays)
+            else:
+                self.leader_comm.Scatterv(None, node_arrays)
+        # ... and can read the new ones:
+        self.win.Fence()
+        return node_arrays[self.node_rank].copy()
+
+def _is_valid_decomposition(global_dims, proc_sizes, directions):
+    for n, p in zip(global_dims, proc_sizes):
+        if n % p != 0:
+            return False
+    for direction in directions:
+        axis = 2 - direction
+        line_length = global_dims[axis]//proc_sizes[axis]
+        if line_length < MIN_LINE_LENGTH or line_length & (line_length-1):
+            return False
+    return True
+
+def _divisors(n):
+    return [d for d in range(1, n+1) if n % d == 0]
+
+def _factorizations(n, k):
+    '''
+    All ordered k-tuples of positive integers with product n
+    '''
+    if k == 1:
+        return [(n,)]
+    return [(d,) + rest for d in _divisors(n) for rest in _factorizations(n//d, k-1)]
+
+def _surface(dims):
+    nz, ny, nx = dims
+    return 2*(nz*ny + nz*nx + ny*nx)
+
 def DA_arange(da, x_range, y_range, z_range):
     '''
     Return x, y and z arrays
@@ -334,6 +900,29 @@ def DA_arange(da, x_range, y_range, z_range):
         x, y, z (np.ndarrays): coordinate arrays,
             all sized (nz, ny, nx)
     '''
+    (x, y, z), spacing = DA_arange_sparse(da, x_range, y_range, z_range)
+    z, y, x = np.meshgrid(z.ravel(), y.ravel(), x.ravel(), indexing='ij')
+    return x, y, z
+
+def DA_arange_sparse(da, x_range, y_range, z_range):
+    '''
+    Like `DA_arange`, but return the coordinates
+    as "sparse" arrays (as from np.ix_), which
+    broadcast against each other to the local block:
+    functions of the coordinates, such as np.sin(x)*y,
+    then cost no more memory than the result.
+    The grid spacings are returned too.
+
+    Args:
+        x_range (tuple): (xmin, xmax)
+        y_range (tuple): (ymin, ymax)
+        z_range (tuple): (zmin, zmax)
+
+    Returns:
+        (x, y, z), (dx, dy, dz): coordinate arrays
+            sized (1, 1, nx), (1, ny, 1) and (nz, 1, 1),
+            and the spacings
+    '''
     nz, ny, nx = da.nz, da.ny, da.nx
     npz, npy, npx = da.npz, da.npy, da.npx
     mz, my, mx = da.mz, da.my, da.mx
@@ -344,12 +933,11 @@ def DA_arange(da, x_range, y_range, z_range):
     x_start, y_start, z_start = (x_range[0] + mx*nx*dx,
             y_range[0] + my*ny*dy,
             z_range[0] + mz*nz*dz)
-    z, y, x = np.meshgrid(
+    z, y, x = np.ix_(
             np.linspace(z_start, z_start+(nz-1)*dz, nz),
             np.linspace(y_start, y_start+(ny-1)*dy, ny),
-            np.linspace(x_start, x_start+(nx-1)*dx, nx),
-            indexing='ij')
-    return x, y, z
+            np.linspace(x_start, x_start+(nx-1)*dx, nx))
+    return (x, y, z), (dx, dy, dz)
 
 def DA_scatter_blocks(da, x_global, x_local):
 
@@ -361,10 +949,11 @@ def DA_scatter_blocks(da, x_global, x_local):
     size = da.size
     rank = da.rank
 
+    datatype = mpi_type(x_local.dtype)
     start_z, start_y, start_x = mz*nz, my*ny, mx*nx
-    subarray_aux = MPI.DOUBLE.Create_subarray([NZ, NY, NX],
+    subarray_aux = datatype.Create_subarray([NZ, NY, NX],
                         [nz, ny, nx], [start_z, start_y, start_x])
-    subarray = subarray_aux.Create_resized(0, 8)
+    subarray = subarray_aux.Create_resized(0, x_local.dtype.itemsize)
     subarray.Commit()
 
     start_index = np.array(start_z*(NX*NY) + start_y*(NX) + start_x, dtype=np.int)
@@ -375,7 +964,7 @@ def DA_scatter_blocks(da, x_global, x_local):
     da.comm.Barrier()
 
     da.comm.Scatterv([x_global, np.ones(size, dtype=np.int), displs, subarray],
-        [x_local, MPI.DOUBLE], root=0)
+        [x_local, datatype], root=0)
 
     subarray.Free()
 
@@ -389,10 +978,11 @@ def DA_gather_blocks(da, x_local, x_global):
     size = da.size
     rank = da.rank 
 
+    datatype = mpi_type(x_local.dtype)
     start_z, start_y, start_x = mz*nz, my*ny, mx*nx
-    subarray_aux = MPI.DOUBLE.Create_subarray([NZ, NY, NX],
+    subarray_aux = datatype.Create_subarray([NZ, NY, NX],
                         [nz, ny, nx], [start_z, start_y, start_x])
-    subarray = subarray_aux.Create_resized(0, 8)
+    subarray = subarray_aux.Create_resized(0, x_local.dtype.itemsize)
     subarray.Commit()
 
     start_index = np.array(start_z*(NX*NY) + start_y*(NX) + start_x, dtype=np.int)
@@ -402,7 +992,7 @@ def DA_gather_blocks(da, x_local, x_global):
     da.comm.Gather(sendbuf, recvbuf, root=0)
     da.comm.Barrier()
 
-    da.comm.Gatherv([x_local, MPI.DOUBLE],
+    da.comm.Gatherv([x_local, datatype],
         [x_global, np.ones(size, dtype=np.int), displs, subarray], root=0)
 
     subarray.Free()
@@ -1,7 +1,11 @@
 import pyopencl as cl
 import pyopencl.array as cl_array
 import numpy as np
+from collections import OrderedDict
 import kernels
+from costs import (forward_reduction_cost, back_substitution_cost,
+        compute_RHS_forward_reduction_cost, back_substitution_faces_cost)
+from autotune import powers_of_2
 
 '''
 A tridiagonal solver for solving
@@ -32,7 +36,8 @@ The tridiagonal system is then of the form:
 
 class NearToeplitzSolver:
 
-    def __init__(self, ctx, queue, shape, coeffs):
+    def __init__(self, ctx, queue, shape, coeffs, profiler=None, dtype=np.float64,
+            index_dtype=None):
         '''
         Create context for the Cyclic Reduction Solver
         that solves a "near-toeplitz"
@@ -49,149 +54,287 @@ class NearToeplitzSolver:
         shape: The size of the tridiagonal system.
         coeffs: A list of coefficients that make up the tridiagonal matrix:
             [b1, c1, ai, bi, ci, an, bn]
+        profiler: (optional) profiler.Profiler recording the kernel events
+        dtype: (optional) floating-point type of the system
+            (numpy.float64 or numpy.float32). The coefficients are
+            always precomputed in double precision.
+        index_dtype: (optional) integer type of the flat indices
+            in the kernels (numpy.int32 or numpy.int64). By default,
+            numpy.int64 only if the system has 2**31 elements or more.
+
+        The coefficient tables are shared with every other solver
+        of the same size, coefficients and dtype in this context
+        (see `get_device_coefficients`).
         '''
         self.ctx = ctx
         self.queue = queue
+        self.profiler = profiler
         self.device = self.ctx.devices[0]
         self.platform = self.device.platform
         self.nz, self.ny, self.nx = shape
         self.coeffs = coeffs
+        self.dtype = np.dtype(dtype)
+        if index_dtype is None:
+            index_dtype = kernels.index_dtype(self.nz*self.ny*self.nx)
+        self.index_dtype = np.dtype(index_dtype)
 
         mf = cl.mem_flags
 
         # check that system_size is a power of 2:
         assert np.int(np.log2(self.nx)) == np.log2(self.nx)
 
-        # compute coefficients a, b, etc.,
-        a, b, c, k1, k2, b_first, k1_first, k1_last = self._precompute_coefficients()
-        
+        # coefficients a, b, etc., on the device:
+        (self.a_d, self.b_d, self.c_d, self.k1_d, self.k2_d,
+            self.b_first_d, self.k1_first_d, self.k1_last_d) = get_device_coefficients(
+                    queue, self.nx, self.coeffs, self.dtype)
 
-        self.a_d = cl_array.to_device(queue, a)
-        self.b_d = cl_array.to_device(queue, b)
-        self.c_d = cl_array.to_device(queue, c)
-        self.k1_d = cl_array.to_device(queue, k1)
-        self.k2_d = cl_array.to_device(queue, k2)
-        self.b_first_d = cl_array.to_device(queue, b_first)
-        self.k1_first_d = cl_array.to_device(queue, k1_first)
-        self.k1_last_d = cl_array.to_device(queue, k1_last)
+        (self.forward_reduction, self.back_substitution,
+            self.rhs_forward_reduction, self.back_substitution_faces) = kernels.get_funcs(
+                self.ctx, 'kernels.cl',
+                'globalForwardReduction', 'globalBackSubstitution',
+                'computeRHSForwardReduction', 'globalBackSubstitutionFaces',
+                    dtype=self.dtype, index_dtype=self.index_dtype)
 
-        self.forward_reduction, self.back_substitution = kernels.get_funcs(self.ctx, 'kernels.cl',
-                'globalForwardReduction', 'globalBackSubstitution')
+        # work-group size in z and y (see `tune`):
+        self.blocks = [1, 1]
 
-    def solve(self, x_d, blocks, print_profile=False):
+    def solve(self, x_d, blocks=None, print_profile=False, rhs=None, faces=None,
+            wait_for=None):
         '''
             Solve the tridiagonal system
             for rhs d, given storage for the solution
             vector in x.
             Additionally, OpenCL corresponding
             OpenCL buffers d_g and x_g must be provided.
+            The work-groups are `blocks` (lines in z and y),
+            by default `self.blocks`.
+
+            If `rhs` is given, the right-hand side is not read
+            from `x_d` but computed from a field in the first
+            level of the reduction (computeRHSForwardReduction);
+            `rhs` is (f_d, left_halo_d, right_halo_d, dx, sw, mx, npx),
+            the arguments of computeRHS.
+            If `faces` is given, the first and last point of every
+            line are copied (negated) to the faces in the last
+            level of the back substitution
+            (globalBackSubstitutionFaces); `faces` is
+            (x_faces_d, mx, npx), the arguments of negateAndCopyFaces.
+            Both require nx >= 4.
+            The first kernel waits for the events `wait_for`, if given.
         '''
         [b1, c1,
             ai, bi, ci,
                 an, bn] = self.coeffs
 
+        if blocks is None:
+            blocks = self.blocks
         bz, by = blocks
+        real = self.dtype.type
 
         # CR algorithm
         # ============================================
         stride = 1
         for i in np.arange(int(np.log2(self.nx))):
             stride *= 2
+            if stride == 2 and rhs is not None:
+                f_d, left_halo_d, right_halo_d, dx, sw, mx, npx = rhs
+                evt = self.rhs_forward_reduction(self.queue, [self.nx/2, self.ny, self.nz], [self.nx/2, by, bz],
+                    f_d.data, left_halo_d.data, right_halo_d.data, x_d.data,
+                        self.k1_d.data, self.k2_d.data, self.k1_first_d.data, self.k1_last_d.data,
+                            real(dx), np.int32(self.nx), np.int32(self.ny), np.int32(self.nz),
+                                np.int32(sw), np.int32(mx), np.int32(npx), wait_for=wait_for)
+                wait_for = None
+                self._record('computeRHSForwardReduction', evt,
+                        compute_RHS_forward_reduction_cost(self.nz, self.ny, self.nx, self.dtype.itemsize))
+                evt.wait()
+                continue
             evt = self.forward_reduction(self.queue, [self.nx/stride, self.ny, self.nz], [self.nx/stride, by, bz],
                 self.a_d.data, self.b_d.data, self.c_d.data, x_d.data, self.k1_d.data, self.k2_d.data,
                     self.b_first_d.data, self.k1_first_d.data, self.k1_last_d.data,
                         np.int32(self.nx), np.int32(self.ny), np.int32(self.nz),
-                            np.int32(stride))
+                            np.int32(stride), wait_for=wait_for)
+            wait_for = None
+            self._record('globalForwardReduction', evt,
+                    forward_reduction_cost(self.nz, self.ny, self.nx, stride, self.dtype.itemsize))
             evt.wait()
         
         # `stride` is now equal to `nx`
         for i in np.arange(int(np.log2(self.nx))-1):
             stride /= 2
+            if stride == 2 and faces is not None:
+                x_faces_d, mx, npx = faces
+                evt = self.back_substitution_faces(self.queue, [self.nx/2, self.ny, self.nz], [self.nx/2, by, bz],
+                    x_d.data, x_faces_d.data,
+                        real(b1), real(c1),
+                            real(ai), real(bi), real(ci),
+                                np.int32(self.nx), np.int32(self.ny), np.int32(self.nz),
+                                    np.int32(mx), np.int32(npx))
+                self._record('globalBackSubstitutionFaces', evt,
+                        back_substitution_faces_cost(self.nz, self.ny, self.nx, self.dtype.itemsize))
+                evt.wait()
+                continue
             evt = self.back_substitution(self.queue, [self.nx/stride, self.ny, self.nz], [self.nx/stride, by, bz],
                 self.a_d.data, self.b_d.data, self.c_d.data, x_d.data, self.b_first_d.data,
-                    np.float64(b1), np.float64(c1),
-                        np.float64(ai), np.float64(bi), np.float64(ci),
+                    real(b1), real(c1),
+                        real(ai), real(bi), real(ci),
                             np.int32(self.nx), np.int32(self.ny), np.int32(self.nz),
                                 np.int32(stride))
+            self._record('globalBackSubstitution', evt,
+                    back_substitution_cost(self.nz, self.ny, self.nx, stride, self.dtype.itemsize))
             evt.wait()
         # ============================================
     
 
-    def _precompute_coefficients(self):
+    def tune(self, tuner):
         '''
-        The a, b, c, k1, k2
-        used in the Cyclic Reduction Algorithm can be
-        *pre-computed*.
-        Further, for the special case
-        of constant coefficients,
-        they are the same at (almost) each step of reduction,
-        with the exception, of course of the boundary conditions.
-
-        Thus, the information can be stored in arrays
-        sized log2(system_size)-1,
-        as opposed to arrays sized system_size.
-
-        Values at the first and last point at each step
-        need to be stored seperately.
-
-        The last values for a and b are required only at
-        the final stage of forward reduction (the 2-by-2 solve),
-        so for convenience, these two scalar values are stored
-        at the end of arrays a and b.
-
-        -- See the paper
-        "Fast Tridiagonal Solvers on the GPU"
+        Set `self.blocks` to the fastest work-groups
+        for this system size, as benchmarked (or recorded)
+        by the autotune.Autotuner `tuner`.
+        Kernel events of the benchmark are recorded
+        in the profiler, if any.
         '''
-        system_size = self.nx
-
-        # these arrays technically have length 1 more than required:
-        log2_system_size = int(np.log2(system_size))
-
-        a = np.zeros(log2_system_size, np.float64)
-        b = np.zeros(log2_system_size, np.float64)
-        c = np.zeros(log2_system_size, np.float64)
-        k1 = np.zeros(log2_system_size, np.float64)
-        k2 = np.zeros(log2_system_size, np.float64)
-
-        b_first = np.zeros(log2_system_size, np.float64)
-        k1_first = np.zeros(log2_system_size, np.float64)
-        k1_last = np.zeros(log2_system_size, np.float64)
-
-        [b1, c1,
-            ai, bi, ci,
-                an, bn] = self.coeffs
-
-        num_reductions = log2_system_size - 1
-        for i in range(num_reductions):
-            if i == 0:
-                k1[i] = ai/bi
-                k2[i] = ci/bi
-                a[i] = -ai*k1[i]
-                b[i] = bi - ci*k1[i] - ai*k2[i]
-                c[i] = -ci*k2[i]
-
-                k1_first[i] = ai/b1
-                b_first[i] = bi - c1*k1_first[i] - ai*k2[i]
-
-                k1_last[i] = an/bi
-                a_last = -(ai)*k1_last[i]
-                b_last = bn - (ci)*k1_last[i]
-            else:
-                k1[i] = a[i-1]/b[i-1]
-                k2[i] = c[i-1]/b[i-1]
-                a[i] = -a[i-1]*k1[i]
-                b[i] = b[i-1] - c[i-1]*k1[i] - a[i-1]*k2[i]
-                c[i] = -c[i-1]*k2[i]
-
-                k1_first[i] = a[i-1]/b_first[i-1]
-                b_first[i] = b[i-1] - c[i-1]*k1_first[i] - a[i-1]*k2[i]
-
-                k1_last[i] = a_last/b[i-1]
-                a_last = -a[i-1]*k1_last[i]
-                b_last = b_last - c[i-1]*k1_last[i]
-
-        # put the last values for a and b at the end of the arrays:
-        a[-1] = a_last
-        b[-1] = b_last
-
-        return a, b, c, k1, k2, b_first, k1_first, k1_last
+        x_d = cl_array.zeros(self.queue, (self.nz, self.ny, self.nx), self.dtype)
+        max_size = self.device.max_work_group_size
+        candidates = [(bz, by) for bz in powers_of_2(self.nz) for by in powers_of_2(self.ny)
+                if (self.nx/2)*by*bz <= max_size]
+        def run(blocks):
+            self.solve(x_d, blocks)
+            self.queue.finish()
+        blocks = tuner.local_size('NearToeplitzSolver', (self.nz, self.ny, self.nx),
+                self.dtype, self.index_dtype, run, candidates)
+        if blocks is not None:
+            self.blocks = list(blocks)
+
+    def _record(self, name, evt, cost):
+        if self.profiler is not None:
+            self.profiler.add_event(name, evt, cost)
+
+def _precompute_coefficients(system_size, coeffs):
+    '''
+    The a, b, c, k1, k2
+    used in the Cyclic Reduction Algorithm can be
+    *pre-computed*.
+    Further, for the special case
+    of constant coefficients,
+    they are the same at (almost) each step of reduction,
+    with the exception, of course of the boundary conditions.
+
+    Thus, the information can be stored in arrays
+    sized log2(system_size)-1,
+    as opposed to arrays sized system_size.
+
+    Values at the first and last point at each step
+    need to be stored seperately.
+
+    The last values for a and b are required only at
+    the final stage of forward reduction (the 2-by-2 solve),
+    so for convenience, these two scalar values are stored
+    at the end of arrays a and b.
+
+    -- See the paper
+    "Fast Tridiagonal Solvers on the GPU"
+    '''
+    # these arrays technically have length 1 more than required:
+    log2_system_size = int(np.log2(system_size))
+
+    a = np.zeros(log2_system_size, np.float64)
+    b = np.zeros(log2_system_size, np.float64)
+    c = np.zeros(log2_system_size, np.float64)
+    k1 = np.zeros(log2_system_size, np.float64)
+    k2 = np.zeros(log2_system_size, np.float64)
+
+    b_first = np.zeros(log2_system_size, np.float64)
+    k1_first = np.zeros(log2_system_size, np.float64)
+    k1_last = np.zeros(log2_system_size, np.float64)
+
+    [b1, c1,
+        ai, bi, ci,
+            an, bn] = coeffs
+
+    num_reductions = log2_system_size - 1
+    for i in range(num_reductions):
+        if i == 0:
+            k1[i] = ai/bi
+            k2[i] = ci/bi
+            a[i] = -ai*k1[i]
+            b[i] = bi - ci*k1[i] - ai*k2[i]
+            c[i] = -ci*k2[i]
+
+            k1_first[i] = ai/b1
+            b_first[i] = bi - c1*k1_first[i] - ai*k2[i]
+
+            k1_last[i] = an/bi
+            a_last = -(ai)*k1_last[i]
+            b_last = bn - (ci)*k1_last[i]
+        else:
+            k1[i] = a[i-1]/b[i-1]
+            k2[i] = c[i-1]/b[i-1]
+            a[i] = -a[i-1]*k1[i]
+            b[i] = b[i-1] - c[i-1]*k1[i] - a[i-1]*k2[i]
+            c[i] = -c[i-1]*k2[i]
+
+            k1_first[i] = a[i-1]/b_first[i-1]
+            b_first[i] = b[i-1] - c[i-1]*k1_first[i] - a[i-1]*k2[i]
+
+            k1_last[i] = a_last/b[i-1]
+            a_last = -a[i-1]*k1_last[i]
+            b_last = b_last - c[i-1]*k1_last[i]
+
+    # put the last values for a and b at the end of the arrays:
+    a[-1] = a_last
+    b[-1] = b_last
+
+    return a, b, c, k1, k2, b_first, k1_first, k1_last
+
+# The coefficient tables depend only on (nx, coeffs, dtype),
+# so they are shared by all solvers: the host tables in `_host_tables`,
+# and their copies on the device in `_device_tables`, one per context.
+# Each cache keeps at most MAX_CACHED_TABLES entries,
+# dropping the least recently used first.
+MAX_CACHED_TABLES = 16
+_host_tables = OrderedDict()
+_device_tables = OrderedDict()
+
+def get_coefficients(system_size, coeffs, dtype=np.float64):
+    '''
+    The (read-only) tables returned by `_precompute_coefficients`,
+    converted to `dtype`. They are computed once for every
+    (system_size, coeffs, dtype).
+    '''
+    def create():
+        tables = [table.astype(dtype)
+                for table in _precompute_coefficients(system_size, coeffs)]
+        for table in tables:
+            table.setflags(write=False)
+        return tables
+    return _lookup(_host_tables, _table_key(system_size, coeffs, dtype), create)
+
+def get_device_coefficients(queue, system_size, coeffs, dtype=np.float64):
+    '''
+    The tables of `get_coefficients` as device arrays,
+    copied once to the context of `queue`
+    and shared by all queues of that context.
+    '''
+    def create():
+        return [cl_array.to_device(queue, table)
+                for table in get_coefficients(system_size, coeffs, dtype)]
+    key = (queue.context,) + _table_key(system_size, coeffs, dtype)
+    return _lookup(_device_tables, key, create)
+
+def clear_coefficient_cache():
+    _host_tables.clear()
+    _device_tables.clear()
+
+def _table_key(system_size, coeffs, dtype):
+    return (int(system_size), tuple(float(coeff) for coeff in coeffs),
+            np.dtype(dtype).str)
+
+def _lookup(cache, key, create):
+    if key in cache:
+        value = cache.pop(key)
+    else:
+        value = create()
+    cache[key] = value
+    while len(cache) > MAX_CACHED_TABLES:
+        cache.popitem(last=False)
+    return value
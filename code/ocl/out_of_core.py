@@ -0,0 +1,172 @@
+'''
+Derivatives of arrays that do not fit in memory,
+such as saved 3-d snapshots, computed on a single process.
+
+The array is read (from a numpy.memmap, a .npy file or a raw file)
+in tiles of whole lines along the direction of the derivative,
+and every tile is solved with the compact scheme of
+compact.CompactFiniteDifferenceSolver (computeRHS and the
+near-Toeplitz solve) before it is written to the output.
+Tiles are read into a buffer of the size of a tile, and
+(for the y- and z-derivatives) transposed from it into a buffer
+of contiguous lines; both are allocated once, as is the solver,
+which solves the last, smaller tiles padded to the full size.
+The size of the tiles is chosen so that the memory used
+stays within a given budget (see `bytes_per_line`).
+
+Example:
+
+    from out_of_core import derivative
+    derivative('u.npy', 'dudy.npy', dy, direction=1,
+            memory_budget=512*2**20)
+'''
+from mpi4py import MPI
+import numpy as np
+
+from mpi_util import DA
+from compact import CompactFiniteDifferenceSolver
+
+# host copies of every line held by `derivative` while solving a tile,
+# besides those of the solver: the tile as read, its lines,
+# and the solution
+HOST_COPIES_PER_LINE = 3
+
+def open_array(path, mode='r', shape=None, dtype=None):
+    '''
+    Open a .npy file, or a raw file of the given
+    shape and dtype, as a memory-mapped array.
+    With mode='w+', the file is created
+    (shape and dtype are then required for .npy files too).
+    '''
+    if path.endswith('.npy'):
+        if mode == 'w+':
+            return np.lib.format.open_memmap(path, mode=mode,
+                    dtype=dtype, shape=tuple(shape))
+        return np.load(path, mmap_mode=mode)
+    if shape is None or dtype is None:
+        raise ValueError('shape and dtype are required for raw file {0}'.format(path))
+    return np.memmap(path, mode=mode, dtype=dtype, shape=tuple(shape))
+
+def derivative(src, dst, spacing, direction=0, memory_budget=256*2**20,
+        shape=None, dtype=None, use_gpu=False):
+    '''
+    Compute the derivative of the 3-d array `src` in
+    `direction` (0, 1 or 2 for x, y or z), and write it to `dst`.
+    As for the distributed solver, the number of points
+    in `direction` must be a power of 2.
+
+    :param src: the function values: an array (usually a numpy.memmap),
+        or the path of a .npy or raw file
+    :param dst: array of the same shape for the derivative,
+        or the path of the file to create for it
+    :param spacing: grid spacing in `direction`
+    :type spacing: float
+    :param memory_budget: approximate bound (in bytes) on the
+        memory used for the tiles being solved
+    :type memory_budget: int
+    :param shape: shape of `src` (and `dst`), for raw files
+    :type shape: tuple
+    :param dtype: dtype of `src` (and `dst`), for raw files.
+        The derivative is computed in single precision
+        for numpy.float32 data and in double precision otherwise.
+    :param use_gpu: set True if using GPU
+    :type use_gpu: bool
+
+    Returns:
+        out (numpy.ndarray): the derivative (`dst`, opened if given as a path)
+    '''
+    if isinstance(src, basestring):
+        src = open_array(src, 'r', shape, dtype)
+    compute_dtype = np.float32 if src.dtype == np.float32 else np.float64
+    if isinstance(dst, basestring):
+        dst = open_array(dst, 'w+', src.shape, compute_dtype)
+    assert(dst.shape == src.shape)
+
+    # the line direction is last in array order:
+    axis = 2 - direction
+    line_length = src.shape[axis]
+    max_lines = memory_budget // bytes_per_line(line_length, compute_dtype, use_gpu)
+    if max_lines < 1:
+        raise ValueError('A memory budget of {0} bytes cannot hold a line of {1} points'.format(
+            memory_budget, line_length))
+
+    # move the line direction last (and back again):
+    other_axes = [a for a in range(3) if a != axis]
+    to_lines = other_axes + [axis]
+    from_lines = list(np.argsort(to_lines))
+
+    tiles = _tiles(src.shape, axis, max_lines)
+    # the first tile is the largest:
+    tile_lines = _extent(tiles[0], src.shape, other_axes[0])*_extent(
+            tiles[0], src.shape, other_axes[1])
+    read_buffer = np.empty([_extent(tiles[0], src.shape, a) for a in range(3)],
+            dtype=compute_dtype)
+    lines = np.zeros([tile_lines, 1, line_length], dtype=compute_dtype)
+    solver = _tile_solver(tile_lines, line_length, compute_dtype, use_gpu)
+    for index in tiles:
+        extents = [_extent(index, src.shape, a) for a in range(3)]
+        tile = read_buffer[tuple(slice(0, n) for n in extents)]
+        tile[...] = src[index]
+        nlines = extents[other_axes[0]]*extents[other_axes[1]]
+        tile_lines_shape = [extents[a] for a in to_lines]
+        # lines beyond `nlines` (in the last tiles) are
+        # solved as well, and their results ignored:
+        lines[:nlines].reshape(tile_lines_shape)[...] = tile.transpose(to_lines)
+        result = solver.dfdx(lines, spacing)
+        dst[index] = result[:nlines].reshape(tile_lines_shape).transpose(from_lines)
+    if isinstance(dst, np.memmap):
+        dst.flush()
+    return dst
+
+def bytes_per_line(line_length, dtype=np.float64, use_gpu=False):
+    '''
+    The memory used by `derivative` for every line of a tile
+    (of `line_length` points): that of the solver, as allocated
+    by a solver for a single line (the device arrays of its
+    workspace, see CompactFiniteDifferenceSolver.workspace_nbytes,
+    and the halos of its DAs), and the host copies of the tile.
+    Arrays of the solver that do not grow with the number
+    of lines are counted for every line, so this is an upper bound.
+    '''
+    solver = _tile_solver(1, line_length, dtype, use_gpu)
+    solver.dfdx(solver.da.create_global_vector(), 1.0)
+    halo_bytes = sum(_halo_nbytes(da) for da in (solver.da, solver.x_line_da))
+    return (solver.workspace_nbytes() + halo_bytes +
+            HOST_COPIES_PER_LINE*line_length*np.dtype(dtype).itemsize)
+
+def _tile_solver(nlines, line_length, dtype, use_gpu):
+    da = DA(MPI.COMM_SELF, (nlines, 1, line_length), (1, 1, 1), 1, dtype)
+    return CompactFiniteDifferenceSolver(da, use_gpu, directions=(0,))
+
+def _halo_nbytes(da):
+    return sum(getattr(da, '{0}_{1}_halo'.format(side, kind)).nbytes
+            for side in ('left', 'right', 'bottom', 'top', 'front', 'back')
+                for kind in ('send', 'recv'))
+
+def _extent(index, shape, axis):
+    start, stop, _ = index[axis].indices(shape[axis])
+    return stop - start
+
+def _tiles(shape, axis, max_lines):
+    '''
+    Split an array of `shape` into tiles that are whole along `axis`
+    and have at most `max_lines` lines. Tiles are as contiguous as
+    possible: whole along the innermost of the other two axes
+    if they can be, so that reads and writes are of whole rows.
+
+    Returns a list of index tuples (of slices).
+    '''
+    outer, inner = [a for a in range(3) if a != axis]
+    n_outer, n_inner = shape[outer], shape[inner]
+    if max_lines >= n_inner:
+        outer_step, inner_step = min(max_lines // n_inner, n_outer), n_inner
+    else:
+        outer_step, inner_step = 1, max_lines
+    tiles = []
+    for i in range(0, n_outer, outer_step):
+        for j in range(0, n_inner, inner_step):
+            index = [slice(None)]*3
+            index[outer] = slice(i, min(i+outer_step, n_outer))
+            index[inner] = slice(j, min(j+inner_step, n_inner))
+            tiles.append(tuple(index))
+    return tiles
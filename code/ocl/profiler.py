@@ -0,0 +1,241 @@
+from mpi4py import MPI
+import pyopencl as cl
+import numpy as np
+from contextlib import contextmanager
+
+class Profiler:
+
+    def __init__(self, enabled=True):
+        '''
+        Collects per-kernel device times (from OpenCL events)
+        and per-phase host times on this process.
+        If the bytes moved and flops of a kernel launch are
+        given (see costs.py), the achieved bandwidth and flop rate
+        of each kernel are reported too.
+        Nothing is synchronized across processes while timing:
+        use `reduce` to combine the statistics of all processes.
+
+        The command queue the kernels are launched on
+        must be created with profiling enabled
+        (see `create_queue`).
+
+        :param enabled: if False, nothing is recorded
+        :type enabled: bool
+        '''
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        self.kernel_times = {}
+        self.kernel_bytes = {}
+        self.kernel_flops = {}
+        self.phase_times = {}
+        self.transfer_times = {}
+        self.transfer_bytes = {}
+        self._events = []
+        self._transfers = []
+
+    def add_event(self, name, evt, cost=(0, 0)):
+        '''
+        Record the event returned by a kernel launch.
+        The event is only queried in `resolve`, so recording
+        it does not wait for the kernel to complete.
+
+        :param cost: (bytes, flops) of this launch
+        :type cost: tuple
+        '''
+        if self.enabled:
+            self._events.append((name, evt, cost))
+
+    def add_transfer(self, name, evt, nbytes):
+        '''
+        Record the event of a copy between the host and the device
+        of `nbytes` bytes, as `add_event` does for kernels.
+        '''
+        if self.enabled:
+            self._transfers.append((name, evt, nbytes))
+
+    @contextmanager
+    def phase(self, name):
+        '''
+        Time the (host) execution of a block of code:
+
+            with profiler.phase('compute_RHS'):
+                ...
+        '''
+        if not self.enabled:
+            yield
+            return
+        t1 = MPI.Wtime()
+        yield
+        t2 = MPI.Wtime()
+        self.phase_times.setdefault(name, []).append(t2-t1)
+
+    def resolve(self):
+        '''
+        Wait for the recorded events and convert them
+        to kernel (and transfer) execution times (in seconds).
+        '''
+        for name, evt, (nbytes, flops) in self._events:
+            evt.wait()
+            t = (evt.profile.end - evt.profile.start)*1e-9
+            self.kernel_times.setdefault(name, []).append(t)
+            self.kernel_bytes[name] = self.kernel_bytes.get(name, 0) + nbytes
+            self.kernel_flops[name] = self.kernel_flops.get(name, 0) + flops
+        for name, evt, nbytes in self._transfers:
+            evt.wait()
+            t = (evt.profile.end - evt.profile.start)*1e-9
+            self.transfer_times.setdefault(name, []).append(t)
+            self.transfer_bytes[name] = self.transfer_bytes.get(name, 0) + nbytes
+        self._events = []
+        self._transfers = []
+
+    def summary(self):
+        '''
+        Returns:
+            out (dict): statistics (count, total, mean, min, max)
+                of the times of every kernel, phase and transfer
+                on this process, as {'kernels': {...}, 'phases': {...},
+                'transfers': {...}}.
+                Kernels also have the total bytes and flops,
+                and the achieved bandwidth (GB/s) and flop rate (GFLOP/s);
+                transfers the total bytes and bandwidth.
+        '''
+        self.resolve()
+        kernels = _statistics(self.kernel_times)
+        for name, s in kernels.items():
+            s['bytes'] = self.kernel_bytes[name]
+            s['flops'] = self.kernel_flops[name]
+            s['bandwidth'] = s['bytes']/s['total']*1e-9
+            s['flop_rate'] = s['flops']/s['total']*1e-9
+        transfers = _statistics(self.transfer_times)
+        for name, s in transfers.items():
+            s['bytes'] = self.transfer_bytes[name]
+            s['bandwidth'] = s['bytes']/s['total']*1e-9
+        return {'kernels': kernels,
+                'phases': _statistics(self.phase_times),
+                'transfers': transfers}
+
+    def reduce(self, comm, root=0):
+        '''
+        Combine the statistics of all processes in `comm`.
+        For every kernel and phase, the root gets the min, mean
+        and max (over processes) of the total time spent in it,
+        along with the total number of calls.
+        Kernels also get the mean (over processes) bandwidth
+        and flop rate.
+        Other processes get None.
+        '''
+        summaries = comm.gather(self.summary(), root=root)
+        if comm.Get_rank() != root:
+            return None
+        result = {}
+        for kind in ('kernels', 'phases'):
+            result[kind] = {}
+            names = set()
+            for s in summaries:
+                names.update(s[kind].keys())
+            for name in sorted(names):
+                totals = np.array([s[kind][name]['total']
+                    for s in summaries if name in s[kind]])
+                result[kind][name] = {
+                    'count': sum(s[kind][name]['count'] for s in summaries if name in s[kind]),
+                    'min': totals.min(),
+                    'mean': totals.mean(),
+                    'max': totals.max()}
+                if kind == 'kernels':
+                    for rate in ('bandwidth', 'flop_rate'):
+                        result[kind][name][rate] = np.mean([s[kind][name][rate]
+                            for s in summaries if name in s[kind]])
+        return result
+
+    def roofline(self, peak_bandwidth, peak_flop_rate):
+        '''
+        Compare every kernel on this process against a roofline model.
+
+        :param peak_bandwidth: peak memory bandwidth of the device (GB/s)
+        :type peak_bandwidth: float
+        :param peak_flop_rate: peak flop rate of the device (GFLOP/s)
+        :type peak_flop_rate: float
+
+        Returns:
+            out (dict): for every kernel, its share of the
+                total kernel time, arithmetic intensity (flops/byte),
+                achieved bandwidth and flop rate, the fraction of
+                peak bandwidth achieved, the attainable flop rate
+                min(peak_flop_rate, intensity*peak_bandwidth),
+                the fraction of it achieved, and whether the
+                kernel is 'memory' or 'compute' bound.
+        '''
+        kernels = self.summary()['kernels']
+        total_time = sum(s['total'] for s in kernels.values())
+        result = {}
+        for name, s in kernels.items():
+            intensity = float(s['flops'])/s['bytes'] if s['bytes'] else np.inf
+            attainable = min(peak_flop_rate, intensity*peak_bandwidth)
+            result[name] = {
+                'time_fraction': s['total']/total_time,
+                'intensity': intensity,
+                'bandwidth': s['bandwidth'],
+                'flop_rate': s['flop_rate'],
+                'bandwidth_fraction': s['bandwidth']/peak_bandwidth,
+                'attainable_flop_rate': attainable,
+                'attainable_fraction': s['flop_rate']/attainable,
+                'bound': 'memory' if intensity*peak_bandwidth < peak_flop_rate else 'compute'}
+        return result
+
+    def report(self, comm=None, root=0):
+        '''
+        Print the statistics of this process or,
+        if `comm` is given, the statistics reduced over
+        all processes in `comm` (from `root`).
+        '''
+        if comm is None:
+            stats = self.summary()
+            columns = ('count', 'total', 'mean', 'min', 'max')
+        else:
+            stats = self.reduce(comm, root)
+            columns = ('count', 'min', 'mean', 'max')
+            if stats is None:
+                return
+        for kind in ('phases', 'kernels'):
+            if kind == 'kernels':
+                columns += ('bandwidth', 'flop_rate')
+            print '{0:<28}'.format(kind) + ''.join('{0:>14}'.format(c) for c in columns)
+            for name, s in sorted(stats[kind].items()):
+                print '{0:<28}'.format(name) + '{0:>14}'.format(s['count']) + \
+                    ''.join('{0:>14.6e}'.format(s[c]) for c in columns[1:])
+
+    def report_roofline(self, peak_bandwidth, peak_flop_rate):
+        '''
+        Print the roofline summary of this process (see `roofline`),
+        kernels sorted by the share of time spent in them.
+        '''
+        columns = ('time_fraction', 'intensity', 'bandwidth', 'bandwidth_fraction',
+                'flop_rate', 'attainable_fraction')
+        print '{0:<24}'.format('kernel') + ''.join('{0:>20}'.format(c) for c in columns) + '{0:>10}'.format('bound')
+        stats = self.roofline(peak_bandwidth, peak_flop_rate)
+        for name, s in sorted(stats.items(), key=lambda item: -item[1]['time_fraction']):
+            print '{0:<24}'.format(name) + ''.join('{0:>20.4g}'.format(s[c]) for c in columns) + \
+                '{0:>10}'.format(s['bound'])
+
+def create_queue(ctx, device=None, profile=False):
+    '''
+    Create a command queue, with profiling
+    enabled if `profile` is True.
+    '''
+    if profile:
+        return cl.CommandQueue(ctx, device,
+                properties=cl.command_queue_properties.PROFILING_ENABLE)
+    return cl.CommandQueue(ctx, device)
+
+def _statistics(times):
+    stats = {}
+    for name, t in times.items():
+        t = np.array(t)
+        stats[name] = {'count': t.size,
+                'total': t.sum(),
+                'mean': t.mean(),
+                'min': t.min(),
+                'max': t.max()}
+    return stats
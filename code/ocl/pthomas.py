@@ -1,19 +1,50 @@
 import pyopencl as cl
+import pyopencl.array as cl_array
 import numpy as np
 import kernels
+from costs import pthomas_cost
 
 class PThomas:
-    def __init__(self, ctx, queue, shape):
+    def __init__(self, ctx, queue, shape, profiler=None, dtype=np.float64,
+            index_dtype=None):
         '''
         Create context for pThomas (thread-parallel Thomas algorithm)
+        of floating-point type `dtype`, with flat indices
+        of type `index_dtype` (default: see kernels.index_dtype)
         '''
         self.ctx = ctx
         self.queue = queue
+        self.profiler = profiler
         self.platforms = self.ctx.devices[0].platform
         self.nz, self.ny, self.nx = shape 
-        self.pThomas, = kernels.get_funcs(ctx, 'kernels.cl', 'pThomasKernel')
+        self.dtype = np.dtype(dtype)
+        if index_dtype is None:
+            index_dtype = kernels.index_dtype(self.nz*self.ny*self.nx)
+        self.index_dtype = np.dtype(index_dtype)
+        self.pThomas, = kernels.get_funcs(ctx, 'kernels.cl', 'pThomasKernel', dtype=self.dtype,
+                index_dtype=self.index_dtype)
+        # chosen by the OpenCL implementation, unless tuned:
+        self.local_size = None
     
     def solve(self, a_g, b_g, c_g, c2_g, x_g):
-        evt = self.pThomas(self.queue, [self.nz*self.ny], None,
+        evt = self.pThomas(self.queue, [self.nz*self.ny], self.local_size,
              a_g.data, b_g.data, c_g.data, c2_g.data, x_g.data, np.int32(self.nx))
+        if self.profiler is not None:
+            self.profiler.add_event('pThomasKernel', evt,
+                    pthomas_cost(self.nz*self.ny, self.nx, self.dtype.itemsize))
         return evt 
+
+    def tune(self, tuner):
+        '''
+        Set `self.local_size` to the fastest for this
+        system size, as benchmarked (or recorded) by the
+        autotune.Autotuner `tuner`, on a diagonal system.
+        '''
+        a_g = cl_array.zeros(self.queue, self.nx, self.dtype)
+        b_g = a_g + 1
+        x_g = cl_array.zeros(self.queue, (self.nz, self.ny, self.nx), self.dtype)
+        def run(local_size):
+            self.local_size = local_size
+            self.solve(a_g, b_g, a_g, a_g.copy(), x_g).wait()
+        self.local_size = tuner.local_size('pThomasKernel', (self.nz*self.ny,),
+                self.dtype, self.index_dtype, run)
@@ -3,7 +3,11 @@ sys.path.append('..')
 import numpy as np
 from mpi4py import MPI
 from mpi_util import *
-from compact import CompactFiniteDifferenceSolver
+from compact import CompactFiniteDifferenceSolver, wait_all
+from autotune import Autotuner
+import json
+import os
+import tempfile
 from numpy.testing import *
 
 comm = MPI.COMM_WORLD 
@@ -72,6 +76,287 @@ def test_dfdz_xyz():
     if comm.Get_rank() == 0:
         print 'pass'
 
+def test_dfdx_profiled():
+    cfd_profiled = CompactFiniteDifferenceSolver(da_regular, profile=True)
+    x, y, z = DA_arange(da_regular, (0, 2*np.pi), (0, 2*np.pi), (0, 2*np.pi))
+    f = np.sin(x)
+    dx = x[0, 0, 1] - x[0, 0, 0]
+    dfdx = cfd_profiled.dfdx(f, dx)
+    assert_equal(cfd_regular.dfdx(f, dx), dfdx)
+    summary = cfd_profiled.profiler.summary()
+    assert(summary['phases']['compute_RHS']['count'] == 1)
+    assert(summary['kernels']['computeRHS']['count'] == 1)
+    assert(summary['kernels']['globalForwardReduction']['count'] == 3)
+    stats = cfd_profiled.profiler.reduce(comm)
+    if comm.Get_rank() == 0:
+        assert(stats['kernels']['sumSolutions']['count'] == comm.Get_size())
+        print 'pass'
+    else:
+        assert(stats is None)
+
+def test_dfdx_single_and_mixed():
+    da_single = DA(comm, (8, 32, 16), (2, 2, 2), 1, np.float32)
+    x, y, z = DA_arange(da_single, (0, 2*np.pi), (0, 2*np.pi), (0, 2*np.pi))
+    f = x*y*z
+    dfdx_true = y*z
+    dx = x[0, 0, 1] - x[0, 0, 0]
+    errs = []
+    for reduced_dtype in (np.float32, np.float64):
+        cfd = CompactFiniteDifferenceSolver(da_single, reduced_dtype=reduced_dtype)
+        dfdx = cfd.dfdx(f, dx)
+        assert(dfdx.dtype == np.float32)
+        assert_almost_equal(dfdx_true, dfdx, decimal=2)
+        errs.append(comm.allreduce(np.abs(dfdx - dfdx_true).max(), op=MPI.MAX))
+    # mixed precision is no worse than single:
+    err_single, err_mixed = errs
+    assert(err_mixed <= err_single)
+    if comm.Get_rank() == 0:
+        print 'pass'
+
+def test_streamed():
+    cfd_streamed = CompactFiniteDifferenceSolver(da_irregular, slab_size=3)
+    assert(cfd_streamed.slab_das[0].nz == 2)
+    x, y, z = DA_arange(da_irregular, (0, 2*np.pi), (0, 2*np.pi), (0, 2*np.pi))
+    f = x*y*z**2
+    dx = x[0, 0, 1] - x[0, 0, 0]
+    dy = y[0, 1, 0] - y[0, 0, 0]
+    dz = z[1, 0, 0] - z[0, 0, 0]
+    assert_allclose(cfd_irregular.dfdx(f, dx), cfd_streamed.dfdx(f, dx))
+    assert_allclose(cfd_irregular.dfdy(f, dy), cfd_streamed.dfdy(f, dy))
+    assert_allclose(cfd_irregular.dfdz(f, dz), cfd_streamed.dfdz(f, dz))
+    if comm.Get_rank() == 0:
+        print 'pass'
+
+def test_workspace_reused():
+    cfd = CompactFiniteDifferenceSolver(da_regular)
+    x, y, z = DA_arange(da_regular, (0, 2*np.pi), (0, 2*np.pi), (0, 2*np.pi))
+    f = np.sin(x)
+    dx = x[0, 0, 1] - x[0, 0, 0]
+    dfdx = cfd.dfdx(f, dx)
+    nbytes = cfd.workspace_nbytes()
+    assert(nbytes > 0)
+    assert_equal(cfd.dfdx(f, dx), dfdx)
+    assert(cfd.workspace_nbytes() == nbytes)
+    if comm.Get_rank() == 0:
+        print 'pass'
+
+def test_zero_copy():
+    x, y, z = DA_arange(da_irregular, (0, 2*np.pi), (0, 2*np.pi), (0, 2*np.pi))
+    f = x*y*z**2
+    dy = y[0, 1, 0] - y[0, 0, 0]
+    copying = CompactFiniteDifferenceSolver(da_irregular, zero_copy=False)
+    zero_copy = CompactFiniteDifferenceSolver(da_irregular, zero_copy=True)
+    assert_allclose(copying.dfdy(f, dy), zero_copy.dfdy(f, dy))
+    if comm.Get_rank() == 0:
+        print 'pass'
+
+def test_autotuned():
+    x, y, z = DA_arange(da_irregular, (0, 2*np.pi), (0, 2*np.pi), (0, 2*np.pi))
+    f = x*y*z**2
+    dx = x[0, 0, 1] - x[0, 0, 0]
+    filename = os.path.join(tempfile.mkdtemp(), 'tuning.json')
+    cfd = CompactFiniteDifferenceSolver(da_irregular)
+    cfd.tune(Autotuner(cfd.device, filename))
+    assert_allclose(cfd_irregular.dfdx(f, dx), cfd.dfdx(f, dx))
+    # the winners are recorded, and used again without benchmarking:
+    with open(filename) as tuning_file:
+        records = json.load(tuning_file)[cfd.device.name.strip()]
+    line_da = cfd.x_line_da
+    global_size = (line_da.nx, line_da.ny, line_da.nz)
+    key = 'computeRHS {0}x{1}x{2} float64 int32'.format(*global_size)
+    assert(key in records)
+    tuner = Autotuner(cfd.device, filename)
+    def run(local_size):
+        raise AssertionError('benchmarked a recorded kernel')
+    local_size = records[key]
+    assert_equal(tuner.local_size('computeRHS', global_size, np.float64, np.int32, run),
+            None if local_size is None else tuple(local_size))
+    # but not for other types:
+    assert_raises(AssertionError, tuner.local_size, 'computeRHS', global_size,
+            np.float32, np.int32, run)
+    if comm.Get_rank() == 0:
+        print 'pass'
+
+def test_64_bit_indices():
+    x, y, z = DA_arange(da_irregular, (0, 2*np.pi), (0, 2*np.pi), (0, 2*np.pi))
+    f = x*y*z**2
+    dz = z[1, 0, 0] - z[0, 0, 0]
+    assert_equal(cfd_irregular.index_dtype, np.int32)
+    cfd = CompactFiniteDifferenceSolver(da_irregular, index_dtype=np.int64)
+    assert_allclose(cfd_irregular.dfdz(f, dz), cfd.dfdz(f, dz))
+    if comm.Get_rank() == 0:
+        print 'pass'
+
+def test_hierarchical():
+    x, y, z = DA_arange(da_irregular, (0, 2*np.pi), (0, 2*np.pi), (0, 2*np.pi))
+    f = x*y*z**2
+    dx = x[0, 0, 1] - x[0, 0, 0]
+    dy = y[0, 1, 0] - y[0, 0, 0]
+    cfd = CompactFiniteDifferenceSolver(da_irregular, hierarchical=True)
+    assert_allclose(cfd.dfdx(f, dx), cfd_irregular.dfdx(f, dx))
+    assert_allclose(cfd.dfdy(f, dy), cfd_irregular.dfdy(f, dy))
+    # the node aggregator's collectives run in the same order
+    # on every process, however the futures are driven:
+    dfdx, dfdy = wait_all([cfd.dfdx_async(f, dx), cfd.dfdy_async(f, dy)])
+    assert_allclose(dfdx, cfd_irregular.dfdx(f, dx))
+    assert_allclose(dfdy, cfd_irregular.dfdy(f, dy))
+    for g, dgdy in zip([f, 2*f], cfd.pipeline(1, [f, 2*f], dy)):
+        assert_allclose(dgdy, cfd_irregular.dfdy(g, dy))
+    cfd.destroy()
+    if comm.Get_rank() == 0:
+        print 'pass'
+
+def test_async():
+    x, y, z = DA_arange(da_irregular, (0, 2*np.pi), (0, 2*np.pi), (0, 2*np.pi))
+    f = x*y*z**2
+    dx = x[0, 0, 1] - x[0, 0, 0]
+    dy = y[0, 1, 0] - y[0, 0, 0]
+    dz = z[1, 0, 0] - z[0, 0, 0]
+    futures = [cfd_irregular.dfdx_async(f, dx), cfd_irregular.dfdy_async(f, dy),
+            cfd_irregular.dfdz_async(f, dz)]
+    assert_raises(ValueError, cfd_irregular.dfdx_async, f, dx)
+    dfdx, dfdy, dfdz = wait_all(futures)
+    assert_allclose(dfdx, cfd_irregular.dfdx(f, dx))
+    assert_allclose(dfdy, cfd_irregular.dfdy(f, dy))
+    assert_allclose(dfdz, cfd_irregular.dfdz(f, dz))
+    assert_allclose(cfd_irregular.dfdx_async(f, dx).result(), dfdx)
+    # a derivative that fails does not stay in flight:
+    assert_raises(ValueError, cfd_irregular.dfdx_async, np.zeros([1, 1, 1]), dx)
+    assert_allclose(cfd_irregular.dfdx_async(f, dx).result(), dfdx)
+    # the directions are solved on queues of their own:
+    assert_equal(len(set(cfd_irregular.direction_queues)), 3)
+    if comm.Get_rank() == 0:
+        print 'pass'
+
+def test_async_concurrent_directions():
+    x, y, z = DA_arange(da_irregular, (0, 2*np.pi), (0, 2*np.pi), (0, 2*np.pi))
+    fields = [x*y*z**2, np.sin(x)*np.cos(y), np.sin(z)*x]
+    dx = x[0, 0, 1] - x[0, 0, 0]
+    dy = y[0, 1, 0] - y[0, 0, 0]
+    dz = z[1, 0, 0] - z[0, 0, 0]
+    cfd = CompactFiniteDifferenceSolver(da_irregular, profile=True)
+    # a different field in every direction, all in flight at once,
+    # and completed in the reverse order:
+    futures = [cfd.dfdx_async(fields[0], dx), cfd.dfdy_async(fields[1], dy),
+            cfd.dfdz_async(fields[2], dz)]
+    dfdz = futures[2].result()
+    dfdy = futures[1].result()
+    dfdx = futures[0].result()
+    events = list(cfd.profiler._events)
+    assert_allclose(dfdx, cfd_irregular.dfdx(fields[0], dx))
+    assert_allclose(dfdy, cfd_irregular.dfdy(fields[1], dy))
+    assert_allclose(dfdz, cfd_irregular.dfdz(fields[2], dz))
+    # every direction's kernels ran on its own queue, one after the
+    # other in the order they were enqueued (each waiting for the last):
+    for queue in cfd.direction_queues:
+        times = [(evt.profile.start, evt.profile.end)
+                for name, evt, cost in events if evt.command_queue == queue]
+        assert(len(times) > 0)
+        for (start, end), (next_start, next_end) in zip(times, times[1:]):
+            assert(next_start >= end)
+    if comm.Get_rank() == 0:
+        print 'pass'
+
+def test_pipeline():
+    x, y, z = DA_arange(da_irregular, (0, 2*np.pi), (0, 2*np.pi), (0, 2*np.pi))
+    fields = [x*y*z**2, np.sin(x)*np.cos(y), np.sin(z)]
+    spacings = [x[0, 0, 1] - x[0, 0, 0], y[0, 1, 0] - y[0, 0, 0], z[1, 0, 0] - z[0, 0, 0]]
+    derivatives = [cfd_irregular.dfdx, cfd_irregular.dfdy, cfd_irregular.dfdz]
+    for direction in range(3):
+        spacing = spacings[direction]
+        results = list(cfd_irregular.pipeline(direction, fields, spacing))
+        assert_equal(len(results), len(fields))
+        for f, result in zip(fields, results):
+            assert_allclose(result, derivatives[direction](f, spacing))
+    if comm.Get_rank() == 0:
+        print 'pass'
+
+def test_pipeline_uploads():
+    x, y, z = DA_arange(da_irregular, (0, 2*np.pi), (0, 2*np.pi), (0, 2*np.pi))
+    fields = [x*y*z**2, np.sin(x)*np.cos(y), np.sin(z)*x, x**2]
+    dx = x[0, 0, 1] - x[0, 0, 0]
+    cfd = CompactFiniteDifferenceSolver(da_irregular, profile=True, zero_copy=False,
+            directions=(0,))
+    results = list(cfd.pipeline(0, fields, dx))
+    for f, result in zip(fields, results):
+        assert_allclose(result, cfd_irregular.dfdx(f, dx))
+    queue = cfd.direction_queues[0]
+    # the kernels of every field, from its computeRHS on:
+    solves = []
+    for name, evt, cost in cfd.profiler._events:
+        assert(evt.command_queue == queue)
+        if name == 'computeRHS':
+            solves.append([])
+        solves[-1].append(evt)
+    # and the copies of the field and its two halos:
+    uploads = [evt for name, evt, nbytes in cfd.profiler._transfers]
+    assert_equal(len(solves), len(fields))
+    assert_equal(len(uploads), 3*len(fields))
+    overlaps = 0
+    for k in range(len(fields)):
+        copies = uploads[3*k:3*k+3]
+        for evt in copies:
+            assert(evt.command_queue == cfd.transfer_queue)
+            # computeRHS waits for the copies:
+            assert(solves[k][0].profile.start >= evt.profile.end)
+        if k > 0:
+            # the copies ran while field k-1 was being solved:
+            first, last = solves[k-1][0], solves[k-1][-1]
+            overlaps += any(evt.profile.start < last.profile.end and
+                    evt.profile.end > first.profile.start for evt in copies)
+    assert(overlaps > 0)
+    if comm.Get_rank() == 0:
+        print 'pass'
+
+def test_destroy():
+    da_shared = DA(comm, (8, 32, 16), (2, 2, 2), 1, shared_memory=True)
+    cfd = CompactFiniteDifferenceSolver(da_shared, slab_size=4)
+    x, y, z = DA_arange(da_shared, (0, 2*np.pi), (0, 2*np.pi), (0, 2*np.pi))
+    f = x*y*z**2
+    dx = x[0, 0, 1] - x[0, 0, 0]
+    assert_allclose(cfd.dfdx(f, dx), cfd_irregular.dfdx(f, dx))
+    line_das = [cfd.x_line_da, cfd.y_line_da, cfd.z_line_da] + cfd.slab_das
+    cfd.destroy()
+    for line_da in line_das:
+        assert(line_da.halo_win == MPI.WIN_NULL)
+    da_shared.destroy()
+    if comm.Get_rank() == 0:
+        print 'pass'
+
+def test_overlap_halos():
+    x, y, z = DA_arange(da_irregular, (0, 2*np.pi), (0, 2*np.pi), (0, 2*np.pi))
+    f = x*y*z**2
+    dx = x[0, 0, 1] - x[0, 0, 0]
+    dz = z[1, 0, 0] - z[0, 0, 0]
+    cfd = CompactFiniteDifferenceSolver(da_irregular, profile=True, zero_copy=False,
+            overlap_halos=True)
+    assert_allclose(cfd.dfdx(f, dx), cfd_irregular.dfdx(f, dx))
+    assert_allclose(cfd.dfdz_async(f, dz).result(), cfd_irregular.dfdz(f, dz))
+    summary = cfd.profiler.summary()
+    assert(summary['kernels']['computeRHSInterior']['count'] == 2)
+    assert(summary['kernels']['computeRHSBoundary']['count'] == 2)
+    assert('computeRHS' not in summary['kernels'])
+    if comm.Get_rank() == 0:
+        print 'pass'
+
+def test_fused():
+    x, y, z = DA_arange(da_irregular, (0, 2*np.pi), (0, 2*np.pi), (0, 2*np.pi))
+    f = x*y*z**2
+    dx = x[0, 0, 1] - x[0, 0, 0]
+    dy = y[0, 1, 0] - y[0, 0, 0]
+    dz = z[1, 0, 0] - z[0, 0, 0]
+    cfd = CompactFiniteDifferenceSolver(da_irregular, profile=True, fused=True)
+    assert_allclose(cfd.dfdx(f, dx), cfd_irregular.dfdx(f, dx))
+    assert_allclose(cfd.dfdy_async(f, dy).result(), cfd_irregular.dfdy(f, dy))
+    assert_allclose(cfd.dfdz(f, dz), cfd_irregular.dfdz(f, dz))
+    summary = cfd.profiler.summary()
+    assert(summary['kernels']['computeRHSForwardReduction']['count'] == 3)
+    assert(summary['kernels']['globalBackSubstitutionFaces']['count'] == 3)
+    assert('computeRHS' not in summary['kernels'])
+    assert('negateAndCopyFaces' not in summary['kernels'])
+    if comm.Get_rank() == 0:
+        print 'pass'
+
 if __name__ == "__main__":
     test_dfdx_sine_regular()
     test_dfdx_sine_irregular()
@@ -79,3 +364,18 @@ if __name__ == "__main__":
     test_dfdy_sine_regular()
     test_dfdy_xyz()
     test_dfdz_xyz()
+    test_dfdx_profiled()
+    test_dfdx_single_and_mixed()
+    test_streamed()
+    test_workspace_reused()
+    test_zero_copy()
+    test_autotuned()
+    test_64_bit_indices()
+    test_hierarchical()
+    test_async()
+    test_async_concurrent_directions()
+    test_pipeline()
+    test_pipeline_uploads()
+    test_destroy()
+    test_overlap_halos()
+    test_fused()
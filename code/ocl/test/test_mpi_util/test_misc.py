@@ -2,6 +2,7 @@ import sys
 sys.path.append('../../')
 from mpi_util import *
 import numpy as np
+import os
 from mpi4py import MPI
 from numpy.testing import *
 
@@ -18,6 +19,112 @@ def test_DA_arange():
             for j in range(5):
                 assert_equal(x[i, j, :], np.arange(6, 11))
     print 'pass'
+def test_DA_arange_sparse():
+    da = DA(comm, [5, 5, 5], [2, 2, 2], 1)
+    x, y, z = DA_arange(da, (1., 10.), (1., 10.), (1., 10.))
+    (x_s, y_s, z_s), (dx, dy, dz) = DA_arange_sparse(da, (1., 10.), (1., 10.), (1., 10.))
+    assert_equal(x_s.shape, (1, 1, 5))
+    assert_equal(y_s.shape, (1, 5, 1))
+    assert_equal(z_s.shape, (5, 1, 1))
+    assert_equal(x_s*y_s*z_s, x*y*z)
+    assert_equal((dx, dy, dz), (1., 1., 1.))
+    print 'pass'
+def test_plan_proc_sizes():
+    assert_equal(plan_proc_sizes((64, 64, 64), 8), (2, 2, 2))
+    # only x-derivatives: keep x-lines whole
+    assert_equal(plan_proc_sizes((64, 64, 64), 8, directions=(0,))[2], 1)
+    # the only grid that divides the problem and
+    # leaves x-lines of a power of 2:
+    assert_equal(plan_proc_sizes((64, 64, 12), 3, directions=(0,)), (1, 1, 3))
+    assert_raises(ValueError, plan_proc_sizes, (5, 5, 5), 8)
+    assert(decomposition_cost((64, 64, 64), (2, 2, 2)) <
+            decomposition_cost((64, 64, 64), (1, 1, 8)))
+    # x-derivatives exchange no halos in y and z:
+    assert_equal(decomposition_cost((64, 64, 64), (2, 4, 1), directions=(0,)), 0)
+    assert_equal(decomposition_cost((64, 64, 64), (1, 1, 2), directions=(0,)),
+            2*64*64 + 2*2*64*64)
+    da = create_DA(comm, (16, 32, 16))
+    assert_equal(da.proc_sizes, (2, 2, 2))
+    assert_equal((da.nz, da.ny, da.nx), (8, 16, 8))
+    assert_equal(da.comm.allreduce(da.rank), sum(range(8)))
+    da.destroy()
+    print 'pass'
+def test_shared_memory_halos():
+    da = DA(comm, [4, 5, 6], [2, 2, 2], 1)
+    da_shared = DA(comm, [4, 5, 6], [2, 2, 2], 1, shared_memory=True)
+    a = np.random.rand(4, 5, 6)
+    b = np.zeros([6, 7, 8])
+    b_shared = np.zeros([6, 7, 8])
+    for i in range(2):
+        a += rank
+        da.global_to_local(a, b)
+        da_shared.global_to_local(a, b_shared)
+        assert_equal(b_shared, b)
+    da_shared.destroy()
+    print 'pass'
+class TwoProcessNodeDA(DA):
+    # pretend that every node holds two processes (neighbours in x),
+    # so that the faces in y and z are exchanged by MPI messages:
+    def _split_node_comm(self):
+        node_comm = DA._split_node_comm(self)
+        return node_comm.Split(node_comm.Get_rank()//2, node_comm.Get_rank())
+def test_shared_memory_halos_across_nodes():
+    da = DA(comm, [4, 5, 6], [2, 2, 2], 1)
+    da_shared = TwoProcessNodeDA(comm, [4, 5, 6], [2, 2, 2], 1, shared_memory=True)
+    on_node = [shared_halo is not None for _, _, _, _, _, shared_halo in da_shared.faces]
+    assert(any(on_node) and not all(on_node))
+    a = np.random.rand(4, 5, 6)
+    b = np.zeros([6, 7, 8])
+    b_shared = np.zeros([6, 7, 8])
+    for i in range(2):
+        a += rank
+        da.global_to_local(a, b)
+        da_shared.global_to_local(a, b_shared)
+        assert_equal(b_shared, b)
+        # only the swaps with the other node are left to the end:
+        requests = da_shared.global_to_local_begin(a, b_shared)
+        assert_equal(len(requests), 2*on_node.count(False))
+        da_shared.global_to_local_end(b_shared, requests)
+        assert_equal(b_shared, b)
+        da.update_halos(a)
+        da_shared.update_halos(a)
+        for side in ['left', 'right', 'bottom', 'top', 'front', 'back']:
+            if da.has_neighbour(side):
+                assert_equal(getattr(da_shared, side + '_recv_halo'),
+                        getattr(da, side + '_recv_halo'))
+    da_shared.destroy()
+    print 'pass'
+class TwoProcessNodeAggregator(NodeAggregator):
+    def _split_node_comm(self):
+        node_comm = NodeAggregator._split_node_comm(self)
+        return node_comm.Split(node_comm.Get_rank()//2, node_comm.Get_rank())
+def test_node_aggregator():
+    for aggregator in [NodeAggregator(comm), TwoProcessNodeAggregator(comm)]:
+        # arrays of two sizes, through the same window:
+        for shape in [(4,), (3, 5, 2)]:
+            a = np.random.rand(*shape) + rank
+            arrays = aggregator.gather(a)
+            if rank == 0:
+                assert_equal(arrays.shape, (size,) + shape)
+                assert_equal(np.floor(arrays.reshape(size, -1)[:, 0]), np.arange(size))
+            else:
+                assert(arrays is None)
+            assert_equal(aggregator.scatter(arrays, shape, np.float64), a)
+        aggregator.destroy()
+    print 'pass'
+def test_update_halos():
+    da = DA(comm, [4, 5, 6], [2, 2, 2], 1)
+    a = np.random.rand(4, 5, 6)
+    b = da.create_local_vector()
+    da.global_to_local(a, b)
+    da.update_halos(a)
+    if da.has_neighbour('left'):
+        assert_equal(da.left_recv_halo, b[1:-1, 1:-1, :1])
+    if da.has_neighbour('right'):
+        assert_equal(da.right_recv_halo, b[1:-1, 1:-1, -1:])
+    if da.has_neighbour('front'):
+        assert_equal(da.front_recv_halo, b[:1, 1:-1, 1:-1])
+    print 'pass'
 def test_DA_get_line_DA():
     da = DA(comm, [5, 5, 5], [2, 2, 2], 1)
     line_da = da.get_line_DA(0)
@@ -36,7 +143,34 @@ def test_DA_gather():
     else:
         assert_equal(a_root, 0)
     print 'pass'
+def test_DA_write_read():
+    NZ, NY, NX = 8, 8, 8
+    x_global = np.arange(NZ*NY*NX, dtype=np.float64).reshape(NZ, NY, NX)
+    filename = 'test_DA_write_read.dat'
+    da = DA(comm, [4, 4, 4], [2, 2, 2], 1)
+    a = x_global[da.mz*4:(da.mz+1)*4, da.my*4:(da.my+1)*4, da.mx*4:(da.mx+1)*4]
+    da.write(filename, a)
+    # read back under a different process grid:
+    da_other = DA(comm, [1, 8, 8], [8, 1, 1], 1)
+    b = da_other.read(filename)
+    assert_equal(b, x_global[da_other.mz:da_other.mz+1])
+    # and into single precision:
+    da_single = DA(comm, [4, 4, 4], [2, 2, 2], 1, np.float32)
+    c = da_single.create_global_vector()
+    da_single.read(filename, c)
+    assert_equal(c, a)
+    comm.Barrier()
+    if rank == 0:
+        os.remove(filename)
+    print 'pass'
 if __name__ == "__main__":
     test_DA_arange()
+    test_DA_arange_sparse()
+    test_plan_proc_sizes()
+    test_shared_memory_halos()
+    test_shared_memory_halos_across_nodes()
+    test_node_aggregator()
+    test_update_halos()
     test_DA_get_line_DA()
     test_DA_gather()
+    test_DA_write_read()
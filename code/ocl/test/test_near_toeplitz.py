@@ -46,3 +46,9 @@ b[-1] = 7.
 x_true = scipy_solve_banded(a, b, c, d.ravel())
 
 assert_allclose(x.ravel(), x_true.ravel())
+
+# solvers of the same size and coefficients share their tables:
+other_solver = NearToeplitzSolver(context, queue, (4, 4, 32),
+        [1., 2., 3., 4., 5., 6., 7.])
+assert other_solver.a_d is solver.a_d
+assert other_solver.k1_last_d is solver.k1_last_d
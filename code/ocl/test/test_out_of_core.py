@@ -0,0 +1,56 @@
+import sys
+sys.path.append('..')
+import os
+import tempfile
+import numpy as np
+from mpi4py import MPI
+from out_of_core import derivative, open_array, bytes_per_line
+from numpy.testing import *
+
+N = 32
+z, y, x = np.meshgrid(*[np.linspace(0, 2*np.pi, N) for i in range(3)], indexing='ij')
+h = x[0, 0, 1] - x[0, 0, 0]
+f = np.sin(x) + np.sin(2*y) + np.sin(3*z)
+tmpdir = tempfile.mkdtemp()
+
+def test_derivatives_of_npy():
+    src = os.path.join(tmpdir, 'f.npy')
+    np.save(src, f)
+    # a budget of 5 lines, so that tiles are smaller than planes
+    # (and the last tile of every plane is padded):
+    budget = 5*bytes_per_line(N)
+    for direction, true in enumerate([np.cos(x), 2*np.cos(2*y), 3*np.cos(3*z)]):
+        dst = os.path.join(tmpdir, 'df.npy')
+        derivative(src, dst, h, direction, memory_budget=budget)
+        df = np.load(dst)
+        # the same as solving the whole array at once:
+        assert_allclose(df, derivative(f, np.empty_like(f), h, direction), rtol=1e-12)
+        # (the error of the boundary closures grows quickly
+        # with the wavenumber, 3 in z):
+        assert_almost_equal(df/(direction+1)**2, true/(direction+1)**2, decimal=2)
+    print 'pass'
+
+def test_raw_memmap():
+    src = open_array(os.path.join(tmpdir, 'f.raw'), 'w+', f.shape, np.float32)
+    src[...] = f
+    dst = derivative(src, os.path.join(tmpdir, 'dfdx.raw'), h, 0)
+    assert(dst.dtype == np.float32)
+    assert_almost_equal(dst, np.cos(x), decimal=2)
+    print 'pass'
+
+def test_unicode_path():
+    src = os.path.join(tmpdir, u'f_unicode.npy')
+    np.save(src, f)
+    dst = derivative(src, os.path.join(tmpdir, u'dfdx_unicode.npy'), h, 0)
+    assert_almost_equal(dst, np.cos(x), decimal=2)
+    print 'pass'
+
+def test_budget_too_small():
+    assert_raises(ValueError, derivative, f, np.empty_like(f), h, 0, 8*N)
+    print 'pass'
+
+if __name__ == "__main__":
+    test_derivatives_of_npy()
+    test_raw_memmap()
+    test_unicode_path()
+    test_budget_too_small()
@@ -0,0 +1,70 @@
+import sys
+sys.path.append('..')
+import numpy as np
+from mpi4py import MPI
+from mpi_util import *
+from compact import CompactFiniteDifferenceSolver
+from transpose import *
+from numpy.testing import *
+
+comm = MPI.COMM_WORLD 
+da = DA(comm, (8, 32, 16), (2, 2, 2), 1)
+cfd = CompactFiniteDifferenceSolver(da)
+
+def test_pencil_transpose():
+    line_da = da.get_line_DA(0)
+    transpose = PencilTranspose(line_da)
+    (x, y, z), spacing = DA_arange_sparse(da, (0, 1), (0, 1), (0, 1))
+    f = da.create_global_vector()
+    f[...] = x + 10*y + 100*z
+    pencils = transpose.to_pencils(f)
+    assert_equal(pencils.shape, (8*32/2, 1, 32))
+    # whole lines, in order along x:
+    assert_allclose(np.diff(pencils, axis=-1), spacing[0])
+    assert_equal(transpose.from_pencils(pencils), f)
+    if comm.Get_rank() == 0:
+        print 'pass'
+
+def test_transpose_matches_distributed():
+    (x, y, z), (dx, dy, dz) = DA_arange_sparse(da, (0, 2*np.pi), (0, 2*np.pi), (0, 2*np.pi))
+    f = y*np.cos(x*y) + np.sin(z)*y
+    solver = TransposeSolver(da)
+    assert_allclose(solver.dfdx(f, dx), cfd.dfdx(f, dx))
+    assert_allclose(solver.dfdy(f, dy), cfd.dfdy(f, dy))
+    assert_allclose(solver.dfdz(f, dz), cfd.dfdz(f, dz))
+    solver.destroy()
+    if comm.Get_rank() == 0:
+        print 'pass'
+
+def test_strategy_selection():
+    # latency-bound: the distributed solve sends more messages
+    assert_equal(choose_strategy(da, 0, latency=1., bandwidth=1e12), 'transpose')
+    # bandwidth-bound: the distributed solve sends less data,
+    # unless solving the reduced system on one process is slow
+    assert_equal(choose_strategy(da, 0, latency=0., bandwidth=1e9), 'distributed')
+    assert_equal(choose_strategy(da, 0, latency=0., bandwidth=1e9, flop_rate=1e3), 'transpose')
+    (x, y, z), (dx, dy, dz) = DA_arange_sparse(da, (0, 2*np.pi), (0, 2*np.pi), (0, 2*np.pi))
+    f = da.create_global_vector()
+    f[...] = np.sin(x)*np.cos(z)
+    solver = DerivativeSolver(da, strategy='measure')
+    assert(set(solver.strategies) <= set(STRATEGIES))
+    assert_allclose(solver.dfdz(f, dz), cfd.dfdz(f, dz))
+    solver.destroy()
+    if comm.Get_rank() == 0:
+        print 'pass'
+
+def test_line_length_not_power_of_2():
+    # whole lines of 8*12 points cannot be solved:
+    da_npx8 = DA(comm, (4, 4, 12), (1, 1, 8), 1)
+    line_da = da_npx8.get_line_DA(0)
+    assert(not can_transpose(line_da))
+    assert_raises(ValueError, PencilTranspose, line_da)
+    assert_equal(choose_strategy(da_npx8, 0, latency=1., bandwidth=1e12), 'distributed')
+    if comm.Get_rank() == 0:
+        print 'pass'
+
+if __name__ == "__main__":
+    test_pencil_transpose()
+    test_transpose_matches_distributed()
+    test_strategy_selection()
+    test_line_length_not_power_of_2()
@@ -0,0 +1,322 @@
+'''
+Derivatives by pencil transposes, as an alternative to
+the distributed solve of compact.CompactFiniteDifferenceSolver.
+
+Instead of solving every line in pieces and coupling the pieces
+through the reduced system (gathered on, solved on and scattered
+from the first process of the line), the lines are redistributed
+with an all-to-all exchange (MPI Alltoallv) so that every process
+holds whole lines (a "pencil"), solved without any communication,
+and the result is sent back to the original layout.
+
+Which is cheaper depends on the decomposition: the transpose moves
+the whole block twice, the distributed solve only the faces of the
+block, but serializes the reduced systems on one process.
+`choose_strategy` estimates both with a simple cost model,
+and `measure_strategy` times them; `DerivativeSolver`
+uses either to pick a strategy in every direction.
+
+Example:
+
+    cfd = DerivativeSolver(da, strategy='model')
+    dfdx = cfd.dfdx(f, dx)
+'''
+from mpi4py import MPI
+import numpy as np
+from collections import namedtuple
+
+from mpi_util import DA
+from compact import CompactFiniteDifferenceSolver
+
+# default machine parameters of the cost model (see `choose_strategy`):
+LATENCY = 2e-6      # seconds per message
+BANDWIDTH = 2e9     # bytes per second per process
+FLOP_RATE = 1e9     # flops per second of the reduced solve
+
+STRATEGIES = ('distributed', 'transpose')
+
+# what the cost model needs of a line DA (see `_line_shape`):
+_LineShape = namedtuple('_LineShape', ['nz', 'ny', 'nx', 'size', 'dtype'])
+
+class PencilTranspose:
+
+    def __init__(self, line_da):
+        '''
+        Redistribute the lines of the 1-d DA `line_da` (along x)
+        so that every process holds whole lines.
+        The nz*ny lines of the local block are split among
+        the processes of the line as evenly as possible.
+        Whole lines (of nx*npx points) must have a power-of-2 length,
+        as the near-Toeplitz solver requires (see `can_transpose`).
+
+        :param line_da: DA with proc_sizes (1, 1, npx)
+            (see mpi_util.DA.get_line_DA)
+        :type line_da: mpi_util.DA
+        '''
+        self.line_da = line_da
+        self.comm = line_da.comm
+        self.dtype = line_da.dtype
+        nz, ny, nx = line_da.nz, line_da.ny, line_da.nx
+        size = line_da.size
+        nlines = nz*ny
+        if nlines < size:
+            raise ValueError('Cannot split {0} lines among {1} processes'.format(
+                nlines, size))
+        if not _is_power_of_2(nx*size):
+            raise ValueError('Cannot solve whole lines of {0} points: '
+                    'not a power of 2'.format(nx*size))
+        q, r = divmod(nlines, size)
+        counts = np.array([q+1]*r + [q]*(size-r))
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        self.nlines = counts[line_da.rank]
+        self.line_length = nx*size
+
+        # the local block, as lines sent to (or received from)
+        # every process, is contiguous:
+        self.block_counts = counts*nx
+        self.block_displacements = starts*nx
+
+        # the pencil is made of blocks of nx points from every process,
+        # one after the other along the line:
+        subarray = line_da.mpi_type.Create_subarray(
+                [self.nlines, self.line_length], [self.nlines, nx], [0, 0])
+        self.pencil_type = subarray.Create_resized(0, nx*self.dtype.itemsize)
+        self.pencil_type.Commit()
+        self.pencil_counts = [1]*size
+        self.pencil_displacements = range(size)
+
+    def to_pencils(self, f):
+        '''
+        :param f: the local block, of shape (nz, ny, nx)
+        :type f: numpy.ndarray
+
+        Returns:
+            out (numpy.ndarray): this process' whole lines,
+                of shape (nlines, 1, line_length)
+        '''
+        f = np.ascontiguousarray(f, dtype=self.dtype)
+        pencils = np.empty([self.nlines, 1, self.line_length], dtype=self.dtype)
+        self.comm.Alltoallv(
+                [f, self.block_counts, self.block_displacements, self.line_da.mpi_type],
+                [pencils, self.pencil_counts, self.pencil_displacements, self.pencil_type])
+        return pencils
+
+    def from_pencils(self, pencils):
+        '''
+        The inverse of `to_pencils`.
+        '''
+        pencils = np.ascontiguousarray(pencils, dtype=self.dtype)
+        f = self.line_da.create_global_vector()
+        self.comm.Alltoallv(
+                [pencils, self.pencil_counts, self.pencil_displacements, self.pencil_type],
+                [f, self.block_counts, self.block_displacements, self.line_da.mpi_type])
+        return f
+
+class TransposeSolver:
+
+    def __init__(self, da, use_gpu=False, directions=(0, 1, 2)):
+        '''
+        Compute derivatives as CompactFiniteDifferenceSolver does,
+        but solve whole lines after a PencilTranspose.
+        The lines are solved by a CompactFiniteDifferenceSolver
+        on a single-process DA.
+
+        :param da: DA object carrying the grid information
+        :type da: mpi_util.DA
+        :param use_gpu: set True if using GPU
+        :type use_gpu: bool
+        :param directions: the derivatives (0, 1, 2 for x, y, z)
+            the solver is set up for
+        :type directions: tuple
+        '''
+        self.da = da
+        self.dtype = da.dtype
+        self.directions = tuple(directions)
+        self.transposes = [None, None, None]
+        self.solvers = [None, None, None]
+        for direction in self.directions:
+            transpose = PencilTranspose(da.get_line_DA(direction))
+            pencil_da = DA(MPI.COMM_SELF, (transpose.nlines, 1, transpose.line_length),
+                    (1, 1, 1), 1, self.dtype)
+            self.transposes[direction] = transpose
+            self.solvers[direction] = CompactFiniteDifferenceSolver(pencil_da, use_gpu,
+                    directions=(0,))
+
+    def dfdx(self, f, dx):
+        return self._line_derivative(0, f, dx)
+
+    def dfdy(self, f, dy):
+        f_T = f.transpose(0, 2, 1).copy()
+        dfdy = self._line_derivative(1, f_T, dy)
+        return dfdy.transpose(0, 2, 1).copy()
+
+    def dfdz(self, f, dz):
+        f_T = f.transpose(1, 2, 0).copy()
+        dfdz = self._line_derivative(2, f_T, dz)
+        return dfdz.transpose(2, 0, 1).copy()
+
+    def _line_derivative(self, direction, f, dx):
+        transpose = self.transposes[direction]
+        pencils = transpose.to_pencils(f)
+        return transpose.from_pencils(self.solvers[direction].dfdx(pencils, dx))
+
+    def destroy(self):
+        '''
+        Free the line DAs of the transposes and the pencil solvers
+        (see CompactFiniteDifferenceSolver.destroy).
+        This is collective, and the solver cannot be used afterwards.
+        '''
+        for direction in self.directions:
+            self.transposes[direction].line_da.destroy()
+            self.transposes[direction].pencil_type.Free()
+            self.solvers[direction].destroy()
+
+def can_transpose(line_da):
+    '''
+    True if the lines of `line_da` (a line DA, or the shape of
+    one, see `_line_shape`) can be solved whole after
+    a PencilTranspose: if there are at least as many lines as
+    processes, and whole lines have a power-of-2 length.
+    '''
+    return (line_da.nz*line_da.ny >= line_da.size and
+            _is_power_of_2(line_da.nx*line_da.size))
+
+def _is_power_of_2(n):
+    return n > 0 and n & (n-1) == 0
+
+def _line_shape(da, direction):
+    '''
+    The dimensions, number of processes and dtype of the line DA
+    of `da` in `direction` (see mpi_util.DA.get_line_dims),
+    for the cost model, without creating the DA.
+    '''
+    (nz, ny, nx), (_, _, size) = da.get_line_dims(direction)
+    return _LineShape(nz, ny, nx, size, da.dtype)
+
+def transpose_cost(line_da, latency=LATENCY, bandwidth=BANDWIDTH):
+    '''
+    Estimated time (s) of the communication of a derivative
+    by TransposeSolver: two all-to-all exchanges of the block.
+    '''
+    size = line_da.size
+    nbytes = line_da.nz*line_da.ny*line_da.nx*line_da.dtype.itemsize
+    return 2*((size-1)*latency + float(size-1)/size*nbytes/bandwidth)
+
+def distributed_cost(line_da, latency=LATENCY, bandwidth=BANDWIDTH, flop_rate=FLOP_RATE):
+    '''
+    Estimated time (s) of the reduced system of a derivative
+    by CompactFiniteDifferenceSolver (see solve_reduced_system):
+    gathering the faces of every process on the first,
+    solving nz*ny systems of size 2*npx there,
+    and scattering the solution.
+    '''
+    size = line_da.size
+    nsystems = line_da.nz*line_da.ny
+    nbytes = 2*nsystems*line_da.dtype.itemsize*size
+    # the gathers of the secondary solutions, the faces,
+    # and the scatter of the solution:
+    communication = 4*(size-1)*latency + 2*nbytes/bandwidth
+    # about 8 flops per unknown in the Thomas algorithm:
+    solve = 8.*nsystems*2*size/flop_rate
+    return communication + solve
+
+def choose_strategy(da, direction, latency=LATENCY, bandwidth=BANDWIDTH,
+        flop_rate=FLOP_RATE):
+    '''
+    The strategy ('distributed' or 'transpose') with the
+    smaller estimated cost for the derivative in `direction`.
+    Lines that are not split among processes are always
+    solved 'distributed' (which then does not communicate),
+    as are those that cannot be transposed (see `can_transpose`).
+    '''
+    line_da = _line_shape(da, direction)
+    if line_da.size == 1:
+        return 'distributed'
+    if not can_transpose(line_da):
+        return 'distributed'
+    if transpose_cost(line_da, latency, bandwidth) < \
+            distributed_cost(line_da, latency, bandwidth, flop_rate):
+        return 'transpose'
+    return 'distributed'
+
+def measure_strategy(da, direction, solvers, repeat=3):
+    '''
+    The strategy whose solver in `solvers` (a dict of
+    strategy name to solver) computes the derivative in
+    `direction` the fastest, as timed on every process;
+    the slowest process decides, so that all processes agree.
+    '''
+    f = np.random.rand(da.nz, da.ny, da.nx).astype(da.dtype)
+    times = {}
+    for name, solver in sorted(solvers.items()):
+        derivative = getattr(solver, ('dfdx', 'dfdy', 'dfdz')[direction])
+        derivative(f, 1.0)
+        t = np.inf
+        for i in range(repeat):
+            da.comm.Barrier()
+            t1 = MPI.Wtime()
+            derivative(f, 1.0)
+            t = min(t, MPI.Wtime() - t1)
+        times[name] = da.comm.allreduce(t, op=MPI.MAX)
+    return min(sorted(times), key=times.get)
+
+class DerivativeSolver:
+
+    def __init__(self, da, use_gpu=False, strategy='model', **kwargs):
+        '''
+        Compute derivatives with the strategy,
+        'distributed' (CompactFiniteDifferenceSolver)
+        or 'transpose' (TransposeSolver), that suits
+        the decomposition in each direction.
+
+        :param da: DA object carrying the grid information
+        :type da: mpi_util.DA
+        :param use_gpu: set True if using GPU
+        :type use_gpu: bool
+        :param strategy: 'model' to choose by the cost model
+            (`choose_strategy`, with the machine parameters
+            in `kwargs`), 'measure' to choose by timing both
+            (`measure_strategy`), or the strategy to use
+        :type strategy: str
+        '''
+        self.solvers = {}
+        if strategy == 'model':
+            self.strategies = [choose_strategy(da, direction, **kwargs)
+                    for direction in range(3)]
+        elif strategy == 'measure':
+            # only the directions that can be transposed are timed:
+            directions = [direction for direction in range(3)
+                    if can_transpose(_line_shape(da, direction))]
+            # keep both solvers, as they are set up already:
+            self.solvers = {'distributed': CompactFiniteDifferenceSolver(da, use_gpu),
+                    'transpose': TransposeSolver(da, use_gpu, directions)}
+            self.strategies = [measure_strategy(da, direction, self.solvers)
+                    if direction in directions else 'distributed'
+                        for direction in range(3)]
+        elif strategy in STRATEGIES:
+            self.strategies = [strategy]*3
+        else:
+            raise ValueError('Unknown strategy: {0}'.format(strategy))
+        for name in set(self.strategies) - set(self.solvers):
+            directions = [d for d in range(3) if self.strategies[d] == name]
+            if name == 'distributed':
+                self.solvers[name] = CompactFiniteDifferenceSolver(da, use_gpu,
+                        directions=directions)
+            else:
+                self.solvers[name] = TransposeSolver(da, use_gpu, directions)
+
+    def dfdx(self, f, dx):
+        return self.solvers[self.strategies[0]].dfdx(f, dx)
+
+    def dfdy(self, f, dy):
+        return self.solvers[self.strategies[1]].dfdy(f, dy)
+
+    def dfdz(self, f, dz):
+        return self.solvers[self.strategies[2]].dfdz(f, dz)
+
+    def destroy(self):
+        '''
+        Free the solvers (see CompactFiniteDifferenceSolver.destroy).
+        '''
+        for name, solver in sorted(self.solvers.items()):
+            solver.destroy()
@@ -0,0 +1,69 @@
+import numpy as np
+import pyopencl as cl
+import pyopencl.array as cl_array
+
+class Workspace:
+
+    def __init__(self, queue):
+        '''
+        Device arrays that are allocated once,
+        on first use, and reused by every later call
+        of a solver, instead of allocating (and freeing)
+        temporaries in every call.
+
+        Arrays are named by the caller and are valid
+        until they are next requested under the same name.
+        '''
+        self.queue = queue
+        self.arrays = {}
+        self.held = {}
+
+    def get(self, name, shape, dtype):
+        '''
+        The array `name`, allocated on first use
+        (or if its shape or dtype have changed).
+        Its contents are undefined.
+        '''
+        shape = tuple(shape)
+        dtype = np.dtype(dtype)
+        array = self.arrays.get(name)
+        if array is None or array.shape != shape or array.dtype != dtype:
+            array = cl_array.empty(self.queue, shape, dtype)
+            self.arrays[name] = array
+        return array
+
+    def to_device(self, name, ary):
+        '''
+        Copy the host array `ary` to the array `name`.
+        '''
+        array = self.get(name, ary.shape, ary.dtype)
+        array.set(np.ascontiguousarray(ary), queue=self.queue)
+        return array
+
+    def hold(self, name, array):
+        '''
+        Keep `array` (e.g. a device array in host memory,
+        which frees that memory with it) until another is held
+        under the same name, as kernels enqueued on it may
+        not have run yet. Returns `array`.
+        '''
+        self.held[name] = array
+        return array
+
+    def enqueue_to_device(self, name, ary, queue=None):
+        '''
+        Enqueue the copy of the host array `ary` (C-contiguous)
+        to the array `name` on `queue` (by default, that of
+        the workspace), without waiting for it to complete.
+        `ary` must not change until it has.
+        Returns the array and the event of the copy.
+        '''
+        if queue is None:
+            queue = self.queue
+        array = self.get(name, ary.shape, ary.dtype)
+        evt = cl.enqueue_copy(queue, array.data, ary, is_blocking=False)
+        return array, evt
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in self.arrays.values())
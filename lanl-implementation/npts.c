@@ -314,6 +314,7 @@ void nonperiodic_tridiagonal_solver(const MPI_Comm comm, const int NX, const int
     /* LR-sweep */
 
     t1 = MPI_Wtime();
+    #pragma omp parallel for collapse(2) private(k, i3d)
     for (i=0; i<nz; i++) {
         for (j=0; j<ny; j++) {
             for (k=0; k<nx; k++) {
@@ -326,6 +327,8 @@ void nonperiodic_tridiagonal_solver(const MPI_Comm comm, const int NX, const int
     
     MPI_Barrier(comm);
 
+    /* Each (z, y) line is independent: split the lines across threads */
+    #pragma omp parallel for collapse(2) private(k, i3d)
     for (i=0; i<nz; i++) {
         for (j=0; j<ny; j++) {
             i3d = i*(nx*ny) + j*nx + 0;
@@ -399,6 +402,7 @@ void nonperiodic_tridiagonal_solver(const MPI_Comm comm, const int NX, const int
     line_bcast(comm, u0, nz*ny, line_root);
     MPI_Barrier(comm);
 
+    #pragma omp parallel for collapse(2) private(ii, jj, i2d, i3d, product_1, product_2)
     for (i=0; i<nz; i++) {
         for (j=0; j<ny; j++) {
             if (rank != line_root) {
@@ -428,6 +432,7 @@ void nonperiodic_tridiagonal_solver(const MPI_Comm comm, const int NX, const int
 
     t1 = MPI_Wtime();
 
+    #pragma omp parallel for collapse(2) private(k, i2d, i3d)
     for (i=0; i<nz; i++) {
         for (j=0; j<ny; j++) {
             for (k=0; k<nx; k++) {
@@ -457,6 +462,7 @@ void nonperiodic_tridiagonal_solver(const MPI_Comm comm, const int NX, const int
     line_allgather(comm, &gam_global[0], gam_firsts);
     MPI_Barrier(comm);
     line_last = line_root + npx-1;
+    #pragma omp parallel for collapse(2) private(k, i3d)
     for (i=0; i<nz; i++) {
         for (j=0; j<ny; j++) {
             i3d = i*(nx*ny) + j*nx + nx-1;
@@ -515,6 +521,7 @@ void nonperiodic_tridiagonal_solver(const MPI_Comm comm, const int NX, const int
     
     MPI_Barrier(comm);
 
+    #pragma omp parallel for collapse(2) private(ii, jj, i2d, i3d, product_1, product_2)
     for (i=0; i<nz; i++) {
         for (j=0; j<ny; j++) {
             if (rank != line_last) {
@@ -551,6 +558,7 @@ void nonperiodic_tridiagonal_solver(const MPI_Comm comm, const int NX, const int
 
     t1 = MPI_Wtime();
 
+    #pragma omp parallel for collapse(2) private(k, i2d, i3d)
     for (i=0; i<nz; i++) {
         for (j=0; j<ny; j++) {
             for (k=0; k<nx; k++) {
@@ -56,3 +56,69 @@ def gather_3D(comm, x_local, x_global):
         [x_global, np.ones(size, dtype=np.int), displs, subarray], root=0)
 
     subarray.Free()
+
+# Files written by write_3D start with this header
+# (the same as that of DA.write in code/ocl/mpi_util.py),
+# followed by the global array in C order:
+FILE_MAGIC = 'DAFIELD1'
+FILE_HEADER = np.dtype([('magic', 'S8'), ('dtype', 'S8'),
+    ('shape', '<i8', (3,)), ('proc_sizes', '<i8', (3,))])
+
+def _block_subarray(comm, local_shape):
+    mz, my, mx = comm.Get_topo()[2]
+    npz, npy, npx = comm.Get_topo()[0]
+    nz, ny, nx = local_shape
+    NZ, NY, NX = npz*nz, npy*ny, npx*nx
+    subarray = MPI.DOUBLE.Create_subarray([NZ, NY, NX],
+                    [nz, ny, nx], [mz*nz, my*ny, mx*nx])
+    subarray.Commit()
+    return subarray, (NZ, NY, NX)
+
+def write_3D(comm, filename, x_local):
+    '''
+    Write the block x_local of every process to
+    the shared file `filename` with collective MPI-IO.
+    '''
+    assert (isinstance(comm, MPI.Cartcomm))
+    x_local = np.ascontiguousarray(x_local, dtype=np.float64)
+    subarray, global_shape = _block_subarray(comm, x_local.shape)
+    fh = MPI.File.Open(comm, filename, MPI.MODE_WRONLY | MPI.MODE_CREATE)
+    fh.Set_size(0)
+    if comm.Get_rank() == 0:
+        header = np.zeros(1, dtype=FILE_HEADER)
+        header['magic'] = FILE_MAGIC
+        header['dtype'] = np.dtype(np.float64).str
+        header['shape'] = global_shape
+        header['proc_sizes'] = comm.Get_topo()[0]
+        fh.Write_at(0, [header.view(np.uint8), MPI.BYTE])
+    fh.Set_view(FILE_HEADER.itemsize, MPI.DOUBLE, subarray)
+    fh.Write_all([x_local, MPI.DOUBLE])
+    fh.Close()
+    subarray.Free()
+
+def read_3D(comm, filename, x_local):
+    '''
+    Read the block x_local of every process from
+    the shared file `filename` (written by write_3D,
+    possibly under a different process grid)
+    with collective MPI-IO.
+    '''
+    assert (isinstance(comm, MPI.Cartcomm))
+    assert (x_local.dtype == np.float64 and x_local.flags['C_CONTIGUOUS'])
+    subarray, global_shape = _block_subarray(comm, x_local.shape)
+    fh = MPI.File.Open(comm, filename, MPI.MODE_RDONLY)
+    header = np.zeros(1, dtype=FILE_HEADER)
+    if comm.Get_rank() == 0:
+        fh.Read_at(0, [header.view(np.uint8), MPI.BYTE])
+    comm.Bcast([header.view(np.uint8), MPI.BYTE], root=0)
+    if (header['magic'][0] != FILE_MAGIC or
+            np.dtype(header['dtype'][0]) != np.float64 or
+                tuple(header['shape'][0]) != global_shape):
+        fh.Close()
+        subarray.Free()
+        raise ValueError('{0} does not hold a double array of shape {1}'.format(
+            filename, global_shape))
+    fh.Set_view(FILE_HEADER.itemsize, MPI.DOUBLE, subarray)
+    fh.Read_all([x_local, MPI.DOUBLE])
+    fh.Close()
+    subarray.Free()
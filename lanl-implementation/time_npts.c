@@ -8,12 +8,17 @@
 #include <stdio.h>
 #include <sys/time.h>
 #include <time.h>
+#ifdef _OPENMP
+#include <omp.h>
+#endif
 
 #define PI 3.141592653589793238462643383
 
 int main (int argc, char* argv[])
 {
-    MPI_Init(&argc, &argv);
+    /* Only the master thread makes MPI calls */
+    int provided;
+    MPI_Init_thread(&argc, &argv, MPI_THREAD_FUNNELED, &provided);
 
     MPI_Comm comm;
     int rank, nprocs;
@@ -24,6 +29,7 @@ int main (int argc, char* argv[])
     int npx, npy, npz, mx, my, mz;
     int coords[3];
     int i, j, k, i3d;
+    int nthreads, nsteps;
 
     MPI_Comm_size(MPI_COMM_WORLD, &nprocs);
 
@@ -34,6 +40,37 @@ int main (int argc, char* argv[])
     npy = atoi(argv[5]);
     npx = atoi(argv[6]);
 
+    /* Optional: number of threads for the line solves in each process
+       (by default, as set by OMP_NUM_THREADS) */
+#ifdef _OPENMP
+    if (argc > 7) {
+        omp_set_num_threads(atoi(argv[7]));
+    }
+    nthreads = omp_get_max_threads();
+#else
+    nthreads = 1;
+#endif
+
+    /* Threads other than the master need no MPI,
+       but the MPI library must allow them to exist */
+    if (provided < MPI_THREAD_FUNNELED && nthreads > 1) {
+        MPI_Comm_rank(MPI_COMM_WORLD, &rank);
+        if (rank == 0) {
+            fprintf(stderr, "Warning: MPI does not support MPI_THREAD_FUNNELED, "
+                    "running with 1 thread per process\n");
+        }
+        nthreads = 1;
+#ifdef _OPENMP
+        omp_set_num_threads(1);
+#endif
+    }
+
+    /* Optional: number of timed solves */
+    nsteps = 20;
+    if (argc > 8) {
+        nsteps = atoi(argv[8]);
+    }
+
     nx = NX/npx;
     ny = NY/npy;
     nz = NZ/npz;
@@ -64,6 +101,7 @@ int main (int argc, char* argv[])
     gamma_global = (double*) malloc(nx*sizeof(double));
     
     if (rank == 0) {
+        printf("Threads per process: %d\n", nthreads);
         printf("Precomputing coefficients \n");
     }
     MPI_Barrier(comm);
@@ -86,7 +124,7 @@ int main (int argc, char* argv[])
             }
         }
     }
-    for (i=0; i<20; i++) {
+    for (i=0; i<nsteps; i++) {
         MPI_Barrier(comm);
         t1 = MPI_Wtime();
         nonperiodic_tridiagonal_solver(comm, NX, NY, NZ, beta_global, gamma_global, d_global, u_global, phi, psi);
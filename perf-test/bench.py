@@ -0,0 +1,390 @@
+'''
+Unified benchmark runner for the CPU-runnable solvers.
+
+Backends:
+
+    ocl      -- CompactFiniteDifferenceSolver.dfdx (code/ocl) on the
+                first OpenCL device, timed per phase
+    npts-py  -- dfdx_parallel from the LANL Python implementation
+    npts-c   -- nonperiodic_tridiagonal_solver from the LANL C
+                implementation (time_npts.run)
+    dgtsv    -- LAPACK dgtsv (through SciPy) on one process,
+                solving all lines of the global problem
+
+Each case in the sweep (backend x local size x process grid)
+is run in its own process, launched with mpiexec
+when it needs more than one rank.
+The first `--warmup` runs are discarded and the next `--repeat`
+runs are kept. Every rank times itself without barriers;
+the time recorded for a run is the maximum over all ranks.
+
+Example:
+
+    python bench.py --backends ocl npts-c dgtsv --sizes 32 64 \\
+        --procs 1,1,1 2,2,2 --warmup 2 --repeat 10 -o bench.json
+
+The output is a JSON file with min/median/p95 (and mean)
+of every phase for every case. With `--kernels`, the ocl cases
+also record the device time, bytes, flops, bandwidth (GB/s) and
+flop rate (GFLOP/s) of every kernel, and with `--peak-bandwidth`
+(GB/s) and `--peak-flops` (GFLOP/s), a roofline summary of rank 0.
+'''
+import sys
+import os
+import re
+import json
+import time
+import socket
+import argparse
+import subprocess
+import tempfile
+import numpy as np
+
+THISDIR = os.path.dirname(os.path.abspath(__file__))
+OCL_DIR = os.path.join(THISDIR, '..', 'code', 'ocl')
+NPTS_DIR = os.path.join(THISDIR, '..', 'lanl-implementation')
+NPTS_PY_DIR = os.path.join(NPTS_DIR, 'python')
+
+BACKENDS = ['ocl', 'npts-py', 'npts-c', 'dgtsv']
+
+# (storage dtype, reduced-system dtype) of the ocl solver
+PRECISIONS = {'double': (np.float64, np.float64),
+        'single': (np.float32, np.float32),
+        'mixed': (np.float32, np.float64)}
+
+# phases of a single x-derivative, named as in code/cuda/compact.py
+DFDX_PHASES = ['compute_RHS', 'solve_secondary_systems',
+        'solve_primary_system', 'solve_reduced_system', 'sum_solutions']
+
+# phase timings printed by nonperiodic_tridiagonal_solver
+NPTS_C_PHASES = ['LR sweep - computing phi and psi',
+        'LR sweep - gathering phi and psi faces',
+        'LR sweep - computing u_tilda',
+        'LR sweep - computing u_globali',
+        'R-L sweep - computing phi and psi',
+        'R-L sweep - gathering phi and psi faces',
+        'R-L sweep - computing x_tilda',
+        'R-L sweep - computing x_global']
+
+
+def summarize(samples):
+    '''
+    Statistics of a list of timings (in seconds)
+    '''
+    samples = np.asarray(samples, dtype=np.float64)
+    return {'min': float(samples.min()),
+            'median': float(np.median(samples)),
+            'p95': float(np.percentile(samples, 95)),
+            'mean': float(samples.mean()),
+            'samples': samples.tolist()}
+
+
+# ============================================
+# Workers: each runs one case and writes
+# {'phases': {phase: [time of each run]}, ...}
+# to the output file
+# ============================================
+
+def _reduce_max(comm, timings, phases):
+    '''
+    Reduce the per-rank timings to the maximum
+    over all ranks, for every run of every phase.
+    '''
+    from mpi4py import MPI
+    local = np.array([timings[p] for p in phases], dtype=np.float64)
+    result = np.zeros_like(local)
+    comm.Reduce([local, MPI.DOUBLE], [result, MPI.DOUBLE], op=MPI.MAX, root=0)
+    return dict((p, result[i].tolist()) for i, p in enumerate(phases))
+
+def run_ocl(local_dims, proc_sizes, warmup, repeat, kernels=False, peaks=None,
+        precision='double', autotune=False, fused=False):
+    sys.path.append(OCL_DIR)
+    from mpi4py import MPI
+    from mpi_util import DA, DA_arange_sparse
+    from compact import CompactFiniteDifferenceSolver
+
+    comm = MPI.COMM_WORLD
+    dtype, reduced_dtype = PRECISIONS[precision]
+    da = DA(comm, local_dims, proc_sizes, 1, dtype)
+    (x, y, z), (dx, dy, dz) = DA_arange_sparse(da, (0, 2*np.pi), (0, 2*np.pi), (0, 2*np.pi))
+    f = da.create_global_vector()
+    f[...] = np.sin(x)
+    cfd = CompactFiniteDifferenceSolver(da, profile=kernels, reduced_dtype=reduced_dtype,
+            autotune=autotune, fused=fused)
+    line_da = cfd.x_line_da
+    # the queue of the x-derivative solvers:
+    queue = cfd.direction_queues[0]
+
+    def phase(timings, name, func, *args):
+        t1 = MPI.Wtime()
+        result = func(*args)
+        cfd.queue.finish()
+        queue.finish()
+        timings[name].append(MPI.Wtime() - t1)
+        return result
+
+    phases = DFDX_PHASES + ['total']
+    timings = dict((p, []) for p in phases)
+    for i in range(warmup + repeat):
+        if i == warmup:
+            cfd.profiler.reset()
+        t1 = MPI.Wtime()
+        if fused:
+            # the RHS is computed in the primary solve, which
+            # also copies the faces for the reduced system:
+            inputs = phase(timings, 'compute_RHS', cfd.prepare_RHS, line_da, f, queue)
+            x_UH, x_LH = phase(timings, 'solve_secondary_systems',
+                    cfd.solve_secondary_systems, line_da)
+            r_d, x_R_faces_d = phase(timings, 'solve_primary_system',
+                    cfd.solve_primary_system, line_da, cfd.x_primary_solver,
+                        None, queue, inputs, dx)
+        else:
+            r_d = phase(timings, 'compute_RHS', cfd.compute_RHS, line_da, f, dx)
+            x_UH, x_LH = phase(timings, 'solve_secondary_systems',
+                    cfd.solve_secondary_systems, line_da)
+            phase(timings, 'solve_primary_system', cfd.x_primary_solver.solve, r_d)
+            x_R_faces_d = None
+        alpha, beta = phase(timings, 'solve_reduced_system', cfd.solve_reduced_system,
+                line_da, x_UH, x_LH, r_d, cfd.x_reduced_solver, queue, x_R_faces_d)
+        phase(timings, 'sum_solutions', cfd.sum_solutions,
+                line_da, r_d, x_UH, x_LH, alpha, beta)
+        r_d.get()
+        timings['total'].append(MPI.Wtime() - t1)
+
+    for p in phases:
+        timings[p] = timings[p][warmup:]
+    result = {'phases': _reduce_max(da.comm, timings, phases),
+            'workspace_bytes': da.comm.reduce(cfd.workspace_nbytes(), op=MPI.MAX, root=0)}
+    if kernels:
+        stats = cfd.profiler.reduce(da.comm)
+        if stats is not None:
+            result['kernels'] = stats['kernels']
+        if peaks is not None:
+            result['roofline'] = cfd.profiler.roofline(*peaks)
+    return comm.Get_rank(), result
+
+def run_npts_py(local_dims, proc_sizes, warmup, repeat):
+    sys.path.append(NPTS_PY_DIR)
+    from mpi4py import MPI
+    from npts import precompute_beta_gam_dfdx, dfdx_parallel
+
+    comm = MPI.COMM_WORLD.Create_cart(proc_sizes, reorder=False)
+    nz, ny, nx = local_dims
+    npz, npy, npx = proc_sizes
+    beta, gamma = precompute_beta_gam_dfdx(comm, nx*npx, ny*npy, nz*npz)
+    r = np.random.rand(nz, ny, nx)
+
+    timings = {'total': []}
+    for i in range(warmup + repeat):
+        t1 = MPI.Wtime()
+        dfdx_parallel(comm, beta, gamma, r)
+        timings['total'].append(MPI.Wtime() - t1)
+
+    timings['total'] = timings['total'][warmup:]
+    return comm.Get_rank(), {'phases': _reduce_max(comm, timings, ['total'])}
+
+def run_dgtsv(global_dims, warmup, repeat):
+    from scipy.linalg.lapack import dgtsv
+
+    NZ, NY, NX = global_dims
+    dl = np.ones(NX-1, dtype=np.float64)*(1./4)
+    d = np.ones(NX, dtype=np.float64)
+    du = np.ones(NX-1, dtype=np.float64)*(1./4)
+    du[0] = 2.
+    dl[-1] = 2.
+    # one column per line, as in the MKL driver
+    rhs = np.asfortranarray(np.random.rand(NZ*NY, NX).T)
+
+    timings = {'total': []}
+    for i in range(warmup + repeat):
+        # dgtsv overwrites the RHS, so solve a copy
+        b = rhs.copy(order='F')
+        t1 = time.time()
+        dgtsv(dl, d, du, b, overwrite_b=1)
+        timings['total'].append(time.time() - t1)
+    timings['total'] = timings['total'][warmup:]
+    return timings
+
+def run_worker(args):
+    backend = args.worker
+    local_dims = tuple(args.local)
+    proc_sizes = tuple(args.procs[0])
+
+    if backend == 'dgtsv':
+        rank, result = 0, {'phases': run_dgtsv(local_dims, args.warmup, args.repeat)}
+    elif backend == 'ocl':
+        rank, result = run_ocl(local_dims, proc_sizes, args.warmup, args.repeat,
+                args.kernels, _peaks(args), args.precision, args.autotune, args.fused)
+    elif backend == 'npts-py':
+        rank, result = run_npts_py(local_dims, proc_sizes, args.warmup, args.repeat)
+
+    if rank == 0:
+        with open(args.output, 'w') as f:
+            json.dump(result, f)
+
+# ============================================
+# Driver
+# ============================================
+
+def parse_npts_c_output(text, warmup):
+    '''
+    Collect the timings printed by time_npts.run
+    (one line per phase per run, plus a "Time:" line per run)
+    '''
+    timings = {}
+    for line in text.splitlines():
+        match = re.match(r'^(.*):\s*([0-9.eE+-]+)\s*$', line)
+        if match is None:
+            continue
+        label, value = match.group(1).strip(), float(match.group(2))
+        if label == 'Time':
+            label = 'total'
+        elif label not in NPTS_C_PHASES:
+            continue
+        timings.setdefault(label, []).append(value)
+    for label in timings:
+        timings[label] = timings[label][warmup:]
+    return timings
+
+def mpiexec_command(args, nprocs):
+    return args.mpiexec.split() + args.mpiexec_flags.split() + ['-n', str(nprocs)]
+
+def run_case(args, backend, local_dims, proc_sizes):
+    nz, ny, nx = local_dims
+    npz, npy, npx = proc_sizes
+    nprocs = npz*npy*npx
+    global_dims = (nz*npz, ny*npy, nx*npx)
+
+    if backend == 'npts-c':
+        binary = os.path.join(NPTS_DIR, 'time_npts.run')
+        if not os.path.exists(binary):
+            subprocess.check_call(['make', '-C', NPTS_DIR, 'time_npts'])
+        cmd = mpiexec_command(args, nprocs) + [binary] + \
+                [str(n) for n in global_dims + proc_sizes] + \
+                [str(args.threads), str(args.warmup + args.repeat)]
+        output = subprocess.check_output(cmd)
+        return {'phases': parse_npts_c_output(output, args.warmup)}
+
+    fd, out = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    try:
+        worker = [sys.executable, os.path.abspath(__file__),
+                '--worker', backend,
+                '--warmup', str(args.warmup), '--repeat', str(args.repeat),
+                '--output', out]
+        if args.kernels:
+            worker += ['--kernels']
+        if backend == 'ocl':
+            worker += ['--precision', args.precision]
+            if args.autotune:
+                worker += ['--autotune']
+            if args.fused:
+                worker += ['--fused']
+        if _peaks(args) is not None:
+            worker += ['--peak-bandwidth', str(args.peak_bandwidth),
+                    '--peak-flops', str(args.peak_flops)]
+        if backend == 'dgtsv':
+            cmd = worker + ['--local'] + [str(n) for n in global_dims]
+        else:
+            cmd = mpiexec_command(args, nprocs) + worker + \
+                    ['--local'] + [str(n) for n in local_dims] + \
+                    ['--procs', '{0},{1},{2}'.format(npz, npy, npx)]
+        subprocess.check_call(cmd)
+        with open(out) as f:
+            return json.load(f)
+    finally:
+        os.remove(out)
+
+def run_sweep(args):
+    results = []
+    for backend in args.backends:
+        done = set()
+        for size in args.sizes:
+            for proc_sizes in args.procs:
+                local_dims = (size, size, size)
+                global_dims = tuple(n*p for n, p in zip(local_dims, proc_sizes))
+                if backend == 'dgtsv':
+                    # a single process solves the global problem:
+                    if global_dims in done:
+                        continue
+                    done.add(global_dims)
+                    local_dims, proc_sizes = global_dims, (1, 1, 1)
+                print 'Running {0}: local size {1}, processes {2}'.format(
+                        backend, local_dims, proc_sizes)
+                sys.stdout.flush()
+                case = run_case(args, backend, local_dims, proc_sizes)
+                result = {
+                    'backend': backend,
+                    'local_dims': list(local_dims),
+                    'proc_sizes': list(proc_sizes),
+                    'global_dims': list(global_dims),
+                    'phases': dict((p, summarize(t)) for p, t in case['phases'].items())}
+                for key in ('kernels', 'roofline', 'workspace_bytes'):
+                    if key in case:
+                        result[key] = case[key]
+                results.append(result)
+    return {'meta': {
+                'host': socket.gethostname(),
+                'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'warmup': args.warmup,
+                'repeat': args.repeat,
+                'threads': args.threads,
+                'precision': args.precision,
+                'autotune': args.autotune,
+                'fused': args.fused,
+                'argv': sys.argv},
+            'results': results}
+
+def _peaks(args):
+    if args.peak_bandwidth is None or args.peak_flops is None:
+        return None
+    return args.peak_bandwidth, args.peak_flops
+
+def proc_sizes_type(s):
+    sizes = tuple(int(n) for n in s.split(','))
+    if len(sizes) != 3:
+        raise argparse.ArgumentTypeError('expected npz,npy,npx')
+    return sizes
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backends', nargs='+', choices=BACKENDS, default=BACKENDS)
+    parser.add_argument('--sizes', nargs='+', type=int, default=[32, 64],
+            help='local (per process) size in each direction')
+    parser.add_argument('--procs', nargs='+', type=proc_sizes_type, default=[(1, 1, 1)],
+            help='process grids, as npz,npy,npx')
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=1,
+            help='threads per process (npts-c)')
+    parser.add_argument('--precision', choices=sorted(PRECISIONS), default='double',
+            help='float64, float32 or float32 with a float64 reduced system (ocl)')
+    parser.add_argument('--autotune', action='store_true',
+            help='launch kernels with tuned local sizes (ocl, see code/ocl/autotune.py)')
+    parser.add_argument('--fused', action='store_true',
+            help='compute the RHS and copy the faces in the primary solve (ocl)')
+    parser.add_argument('--kernels', action='store_true',
+            help='record per-kernel time, bandwidth and flop rate (ocl)')
+    parser.add_argument('--peak-bandwidth', type=float,
+            help='peak memory bandwidth of the device in GB/s, for a roofline summary')
+    parser.add_argument('--peak-flops', type=float,
+            help='peak flop rate of the device in GFLOP/s, for a roofline summary')
+    parser.add_argument('--mpiexec', default=os.environ.get('MPIEXEC', 'mpiexec'))
+    parser.add_argument('--mpiexec-flags', default=os.environ.get('MPIEXECFLAGS', ''))
+    parser.add_argument('-o', '--output', default='bench.json')
+    parser.add_argument('--worker', choices=BACKENDS, help=argparse.SUPPRESS)
+    parser.add_argument('--local', nargs=3, type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args)
+        return
+
+    report = run_sweep(args)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print 'Results written to {0}'.format(args.output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+'''
+Compare per-phase timings against a baseline.
+
+Both the baseline and the new results can be:
+
+    * a log printed by one of the run.py harnesses
+      (for example multi-GPU/PyCUDA/ref-results/1024-64.txt),
+    * a directory of such logs (for example a ref-results/ directory),
+    * a JSON file written by bench.py.
+
+Cases are matched by name: the file name (without extension) for logs,
+and "<backend>/<global size>-<processes>" for bench.py results
+("<global size>-<processes>", as in the logs, with `--backend`).
+If both sides contain a single case, the two are compared directly.
+
+For every phase present in both, the baseline and new
+statistic (median by default) is reported along with the speedup
+(baseline/new). Phases that got slower than the baseline by more than
+`--threshold` are reported as regressions,
+and the exit status is then 1.
+
+Example:
+
+    python compare.py multi-GPU/PyCUDA/ref-results multi-GPU/PyCUDA/results/templated
+'''
+import sys
+import os
+import re
+import json
+import argparse
+
+from bench import summarize
+
+# phases of a single x-derivative, in the order dfdx runs them:
+PHASES = ['compute_RHS', 'solve_secondary_systems', 'solve_primary_system',
+        'solve_reduced_system', 'sum_solutions', 'total']
+
+
+def parse_log(text, skip=1):
+    '''
+    Collect the timings printed by the run.py harnesses:
+    lines of the form "<phase> :  <seconds>", with one
+    "Total time for this run" line per run.
+    The first `skip` runs of every phase are discarded.
+
+    Returns {phase: [seconds, ...]}
+    '''
+    timings = {}
+    for line in text.splitlines():
+        match = re.match(r'^\s*([A-Za-z_][\w -]*?)\s*:\s+([0-9.eE+-]+)\s*$', line)
+        if match is None:
+            continue
+        phase, value = match.group(1), float(match.group(2))
+        if phase == 'Total time for this run':
+            phase = 'total'
+        timings.setdefault(phase, []).append(value)
+    for phase in timings:
+        timings[phase] = timings[phase][skip:]
+    return dict((p, t) for p, t in timings.items() if t)
+
+def load_cases(path, skip=1, backend=None):
+    '''
+    Load a log, a directory of logs or a bench.py JSON file.
+    If `backend` is given, only those bench.py results are loaded.
+
+    Returns {case: {phase: statistics}}
+    '''
+    cases = {}
+    if os.path.isdir(path):
+        for filename in sorted(os.listdir(path)):
+            if filename.endswith('.txt'):
+                cases.update(load_cases(os.path.join(path, filename), skip, backend))
+    elif path.endswith('.json'):
+        with open(path) as f:
+            report = json.load(f)
+        for result in report['results']:
+            if backend is not None and result['backend'] != backend:
+                continue
+            nprocs = reduce(lambda a, b: a*b, result['proc_sizes'])
+            case = '{0}-{1}'.format(result['global_dims'][-1], nprocs)
+            if backend is None:
+                case = result['backend'] + '/' + case
+            cases[case] = dict((p, summarize(s['samples']))
+                    for p, s in result['phases'].items())
+    else:
+        with open(path) as f:
+            timings = parse_log(f.read(), skip)
+        case = os.path.splitext(os.path.basename(path))[0]
+        cases[case] = dict((p, summarize(t)) for p, t in timings.items())
+    return cases
+
+def compare(baseline, new, stat='median', threshold=0.05):
+    '''
+    Compare two {case: {phase: statistics}} tables.
+
+    Returns a list of rows
+    (case, phase, baseline time, new time, speedup, status),
+    where status is 'regression', 'improvement' or 'same'.
+    '''
+    if len(baseline) == 1 and len(new) == 1:
+        (base_case, base), = baseline.items()
+        (new_case, cur), = new.items()
+        pairs = [(new_case, base, cur)]
+    else:
+        pairs = [(case, baseline[case], new[case])
+                for case in sorted(set(baseline) & set(new))]
+
+    rows = []
+    for case, base, cur in pairs:
+        phases = [p for p in PHASES if p in base and p in cur]
+        phases += sorted(p for p in set(base) & set(cur) if p not in PHASES)
+        for phase in phases:
+            t_base = base[phase][stat]
+            t_new = cur[phase][stat]
+            if t_new > t_base*(1 + threshold):
+                status = 'regression'
+            elif t_new < t_base*(1 - threshold):
+                status = 'improvement'
+            else:
+                status = 'same'
+            rows.append((case, phase, t_base, t_new, t_base/t_new, status))
+    return rows
+
+def print_table(rows):
+    header = ('case', 'phase', 'baseline (s)', 'new (s)', 'speedup', '')
+    fmt = '{0:<16} {1:<40} {2:>14} {3:>14} {4:>8}  {5}'
+    print fmt.format(*header)
+    for case, phase, t_base, t_new, speedup, status in rows:
+        print fmt.format(case, phase, '{0:.6g}'.format(t_base),
+                '{0:.6g}'.format(t_new), '{0:.3f}'.format(speedup),
+                status if status != 'same' else '')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('baseline')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=0.05,
+            help='relative change considered noise (default: 0.05)')
+    parser.add_argument('--stat', choices=['min', 'median', 'p95', 'mean'],
+            default='median')
+    parser.add_argument('--skip', type=int, default=1,
+            help='number of initial runs to discard from logs (default: 1)')
+    parser.add_argument('--backend',
+            help='only compare these bench.py results')
+    args = parser.parse_args()
+
+    baseline = load_cases(args.baseline, args.skip, args.backend)
+    new = load_cases(args.new, args.skip, args.backend)
+    rows = compare(baseline, new, args.stat, args.threshold)
+    if not rows:
+        print 'No matching cases and phases to compare'
+        sys.exit(2)
+    print_table(rows)
+    if any(row[-1] == 'regression' for row in rows):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()